@@ -29,10 +29,13 @@ from nornir_imageregistration.core import *
 from nornir_imageregistration.spatial import *
 from nornir_imageregistration.volume import Volume
 from nornir_imageregistration.overlapmasking import GetOverlapMask
+from nornir_imageregistration.phase_correlation import PhaseCorrelator, GetPhaseCorrelator
+from nornir_imageregistration.image_pyramid import ImagePyramid
 from nornir_imageregistration.local_distortion_correction import RefineMosaic, RefineStosFile, RefineTransform
 
 import nornir_imageregistration.files as files
 import nornir_imageregistration.stos_brute as stos_brute
+import nornir_imageregistration.phase_correlation as phase_correlation
 import nornir_imageregistration.tile as tile
 import nornir_imageregistration.tile_overlap as tile_overlap
 import nornir_imageregistration.tileset as tileset
@@ -6,13 +6,16 @@ Created on Jul 10, 2012
  
 import itertools
 import collections
+import hashlib
 import math
 from operator import attrgetter
 import os
+import tempfile
 
 import nornir_imageregistration
 import nornir_imageregistration.assemble 
 import nornir_imageregistration.assemble_tiles
+import nornir_imageregistration.image_cache
 import nornir_imageregistration.layout
 import nornir_imageregistration.tile 
   
@@ -50,20 +53,29 @@ def __CreateTileToOverlapsDict(tile_overlaps):
     return tile_to_overlaps_dict
 
 
-def _CalculateImageFFTs(tiles):
+def _PrecalculateTileImages(tiles, spill_dir=None):
     '''
-    Ensure all tiles have FFTs calculated and cached
+    Decode each tile's image once, in parallel, into the shared image cache.  Feature scoring and
+    tile alignment then memory-map the decoded tiles instead of decoding image files per overlap.
+    :param dict tiles: Dictionary of tile ID to Tile objects
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
+    :return: Dictionary of tile ID to image shape
     '''
     pool = nornir_pools.GetGlobalLocalMachinePool()
      
-    fft_tasks = [] 
+    tasks = [] 
     for t in tiles.values(): 
-        task = pool.add_task("Create padded image", t.PrecalculateImages)
+        task = pool.add_task("Decode tile %d" % t.ID, t.PrecalculateImages, spill_dir)
         task.tile = t
-        fft_tasks.append(task)
+        tasks.append(task)
         
-    print("Calculating FFTs\n")
-    pool.wait_completion()
+    print("Decoding tile images\n")
+    
+    tile_shapes = {}
+    for task in tasks:
+        tile_shapes[task.tile.ID] = task.wait_return()
+        
+    return tile_shapes
      
      
 def TranslateTiles(transforms, imagepaths, excess_scalar, imageScale=None, max_relax_iterations=None, max_relax_tension_cutoff=None):
@@ -106,9 +118,14 @@ def TranslateTiles2(transforms, imagepaths,
                     min_translate_iterations=None, offset_acceptance_threshold=None,
                     max_relax_iterations=None, max_relax_tension_cutoff=None,
                     min_overlap=None, 
-                    first_pass_inter_tile_distance_scale=None, inter_tile_distance_scale=None):
+                    first_pass_inter_tile_distance_scale=None, inter_tile_distance_scale=None,
+                    solve_layout=False, robust_solve_iterations=None):
     '''
     Finds the optimal translation of a set of tiles to construct a larger seemless mosaic.
+    
+    Decoded tiles are held in the process-local image_cache.ImageCache, which is limited to
+    image_cache.DefaultMaxCacheBytes (1 GB) in each process.  A run whose pool has N worker processes can use N GB.
+    Tiles are shared between processes through a temporary spill directory that is removed when the run finishes.
     :param list transforms: list of transforms for tiles
     :param list imagepaths: list of paths to tile images, must be same length as transforms list
     :param float excess_scalar: How much additional area should we pad the overlapping regions with.  Increase this value if you want larger offsets to be found.
@@ -118,9 +135,41 @@ def TranslateTiles2(transforms, imagepaths,
     :param float max_relax_tension_cutoff: Stop relaxation stage if the maximum tension vector is below this value
     :param float min_overlap: The percentage of area that two tiles must overlap before being considered by the layout model
     :param float inter_tile_distance_scale: A scalar from 0 to 1.  1 indicates to trust the overlap reported by the transforms.  0 indicates to test the entire tile for overlaps.  Use this value to increase the area searched for correlations if the stage input is not reliable. 
+    :param bool solve_layout: If True positions are found with layout.SolveLayout instead of iterating layout.RelaxLayout.  The relax iteration parameters are ignored.
+    :param int robust_solve_iterations: Number of iteratively reweighted passes used by layout.SolveLayout to reduce the influence of outlier offsets
     :return: (offsets_collection, tiles) tuple
     '''
     
+    with tempfile.TemporaryDirectory(prefix='nornir_image_cache_') as spill_dir:
+        return _TranslateTiles2(transforms, imagepaths, spill_dir,
+                                first_pass_excess_scalar=first_pass_excess_scalar,
+                                excess_scalar=excess_scalar,
+                                feature_score_threshold=feature_score_threshold,
+                                image_scale=image_scale,
+                                min_translate_iterations=min_translate_iterations,
+                                offset_acceptance_threshold=offset_acceptance_threshold,
+                                max_relax_iterations=max_relax_iterations,
+                                max_relax_tension_cutoff=max_relax_tension_cutoff,
+                                min_overlap=min_overlap,
+                                first_pass_inter_tile_distance_scale=first_pass_inter_tile_distance_scale,
+                                inter_tile_distance_scale=inter_tile_distance_scale,
+                                solve_layout=solve_layout,
+                                robust_solve_iterations=robust_solve_iterations)
+
+
+def _TranslateTiles2(transforms, imagepaths, spill_dir,
+                     first_pass_excess_scalar=None, excess_scalar=None,
+                     feature_score_threshold=None, image_scale=None,
+                     min_translate_iterations=None, offset_acceptance_threshold=None,
+                     max_relax_iterations=None, max_relax_tension_cutoff=None,
+                     min_overlap=None, 
+                     first_pass_inter_tile_distance_scale=None, inter_tile_distance_scale=None,
+                     solve_layout=False, robust_solve_iterations=None):
+    '''
+    See TranslateTiles2
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
+    '''
+    
     if max_relax_iterations is None:
         max_relax_iterations = 150
     
@@ -159,6 +208,9 @@ def TranslateTiles2(transforms, imagepaths,
         single_tile_layout.CreateNode(tiles[0].ID, np.zeros((1,2)))
         return (single_tile_layout, tiles)
     
+    #Every pass crops overlaps from the same tiles, decode each tile once up front
+    _PrecalculateTileImages(tiles, spill_dir=spill_dir)
+    
     minOffsetWeight = 0
     maxOffsetWeight = 1.0
     
@@ -197,7 +249,7 @@ def TranslateTiles2(transforms, imagepaths,
         # if (len(new_overlaps) > 0 or len(removed_overlap_IDs) > 0) and pass_count < max_passes:
         #    iPass = min_translate_iterations
         
-        ScoreTileOverlaps(distinct_overlaps)
+        ScoreTileOverlaps(distinct_overlaps, excess_scalar=excess_scalar, spill_dir=spill_dir)
         
         # If this is the second pass remove any overlaps from the layout that no longer qualify
         if translated_layout is not None:
@@ -226,7 +278,8 @@ def TranslateTiles2(transforms, imagepaths,
             
         translated_layout = _FindTileOffsets(filtered_overlaps_needing_offsets, excess_scalar=excess_scalar,
                                              imageScale=image_scale,
-                                             existing_layout=translated_layout)
+                                             existing_layout=translated_layout,
+                                             spill_dir=spill_dir)
         
         scaled_translated_layout = translated_layout.copy()
         nornir_imageregistration.layout.ScaleOffsetWeightsByPopulationRank(scaled_translated_layout,
@@ -248,7 +301,11 @@ def TranslateTiles2(transforms, imagepaths,
                 
         relaxed_layouts = []
         for layout in translated_final_layouts:
-            relaxed_layout = nornir_imageregistration.layout.RelaxLayout(layout,
+            if solve_layout:
+                relaxed_layout = nornir_imageregistration.layout.SolveLayout(layout,
+                                            robust_iterations=robust_solve_iterations)
+            else:
+                relaxed_layout = nornir_imageregistration.layout.RelaxLayout(layout,
                                             max_iter=relax_iterations,
                                             max_tension_cutoff=max_relax_tension_cutoff)
             relaxed_layouts.append(relaxed_layout)
@@ -367,10 +424,12 @@ def GenerateTileOverlaps(tiles, existing_overlaps=None, offset_epsilon=1.0, imag
     return (generated_overlaps, new_overlaps, updated_overlaps, removed_offset_IDs, nonoverlapping_tile_IDs)
 
 
-def ScoreTileOverlaps(tile_overlaps):
+def ScoreTileOverlaps(tile_overlaps, excess_scalar=None, spill_dir=None):
     '''
     Assigns feature scores to TileOverlap objects without scores.
     :param list tile_overlaps: list of TileOverlap objects
+    :param float excess_scalar: If not None, also prepare the overlap strips and spectra _FindTileOffsets uses with this excess_scalar
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
     :return: The TileOverlap object list
     '''
 
@@ -396,7 +455,7 @@ def ScoreTileOverlaps(tile_overlaps):
         
         first_overlap = list(tile_overlaps_dict.values())[0]
         tile = first_overlap.tile_overlap.Tiles[first_overlap.iTile]
-        t = pool.add_task(str(tile_ID), _CalculateTileFeatures, tile.ImagePath, params)
+        t = pool.add_task(str(tile_ID), _CalculateTileFeatures, tile.ImagePath, params, excess_scalar=excess_scalar, spill_dir=spill_dir)
         tasks.append(t)
     
     for t in tasks:
@@ -418,17 +477,24 @@ def ScoreTileOverlaps(tile_overlaps):
     return tile_overlaps
       
 
-def _CalculateTileFeatures(image_path, list_overlap_tuples, feature_coverage_score=None):
+def _CalculateTileFeatures(image_path, list_overlap_tuples, feature_coverage_score=None, excess_scalar=None, spill_dir=None):
     
     #image = nornir_imageregistration.ImageParamToImageArray(image_path, dtype=np.float32)
+    image = nornir_imageregistration.image_cache.LoadImageCached(image_path, spill_dir=spill_dir)
+    
+    #While the tile is loaded, crop the strips the alignment tasks will need and write them to the spill directory
+    #for the alignment threads in the parent process.
+    if excess_scalar is not None:
+        for (overlap_ID, iTile, overlapping_rect) in list_overlap_tuples:
+            _GetOverlapStripFFT(image_path, _OverlapStripRect(overlapping_rect, excess_scalar), spill_dir=spill_dir, spill=True)
 
     ImageDataList = [ TileOverlapFeatureScore(overlap_ID=overlap_ID,
                                               iTile=iTile,
                                               image=None,  # __get_overlapping_image(image, overlapping_rect, excess_scalar=1.0, cval=np.nan),
-                                              feature_score=nornir_imageregistration.image_stats.__CalculateFeatureScoreSciPy__(__get_overlapping_image(image_path, overlapping_rect, excess_scalar=1.0, cval=np.nan), feature_coverage_score=feature_coverage_score)) 
+                                              feature_score=nornir_imageregistration.image_stats.__CalculateFeatureScoreSciPy__(__get_overlapping_image(image, overlapping_rect, excess_scalar=1.0, cval=np.nan), feature_coverage_score=feature_coverage_score)) 
                     for (overlap_ID, iTile, overlapping_rect) in list_overlap_tuples]
     
-    #del image
+    del image
     return ImageDataList
 
 # 
@@ -503,11 +569,12 @@ def _CalculateTileFeatures(image_path, list_overlap_tuples, feature_coverage_sco
 #     return (layout, tiles)
             
             
-def _FindTileOffsets(tile_overlaps, excess_scalar, imageScale=None, existing_layout=None):
+def _FindTileOffsets(tile_overlaps, excess_scalar, imageScale=None, existing_layout=None, spill_dir=None):
     '''Populates the OffsetToTile dictionary for tiles
     :param list tile_overlaps: List of all tile overlaps or dictionary whose values are tile overlaps
     :param float imageScale: downsample level if known.  None causes it to be calculated.
     :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
     :return: A layout object describing the optimal adjustment for each tile to align with each neighboring tile
     '''
     
@@ -519,8 +586,6 @@ def _FindTileOffsets(tile_overlaps, excess_scalar, imageScale=None, existing_lay
     # idx = tileset.CreateSpatialMap([t.FixedBoundingBox for t in tiles], tiles)
 
     CalculationCount = 0
-    
-    # _CalculateImageFFTs(tiles)
   
     #pool = nornir_pools.GetGlobalSerialPool()
     pool = nornir_pools.GetGlobalMultithreadingPool()
@@ -552,7 +617,8 @@ def _FindTileOffsets(tile_overlaps, excess_scalar, imageScale=None, existing_lay
                           tile_overlap.scaled_overlapping_source_rect_A,
                           tile_overlap.scaled_overlapping_source_rect_B,
                           tile_overlap.scaled_offset,
-                          excess_scalar)
+                          excess_scalar,
+                          spill_dir=spill_dir)
         
         t.tile_overlap = tile_overlap
         tasks.append(t)
@@ -596,6 +662,16 @@ def __get_overlapping_image(image, overlapping_rect, excess_scalar, cval=None):
     if cval is None:
         cval = 'random'
     
+    scaled_rect = _OverlapStripRect(overlapping_rect, excess_scalar)
+    return nornir_imageregistration.CropImage(image, Xo=int(scaled_rect.BottomLeft[1]), Yo=int(scaled_rect.BottomLeft[0]), Width=int(scaled_rect.Width), Height=int(scaled_rect.Height), cval=cval)
+    
+    # return nornir_imageregistration.PadImageForPhaseCorrelation(cropped, MinOverlap=1.0, PowerOfTwo=True)
+
+
+def _OverlapStripRect(overlapping_rect, excess_scalar):
+    '''
+    :return: The integer rectangle, in tile image coordinates, cropped for an overlapping rectangle padded by excess_scalar
+    '''
     if excess_scalar > 3:
         excess_scalar = 3.0
     
@@ -604,13 +680,91 @@ def __get_overlapping_image(image, overlapping_rect, excess_scalar, cval=None):
     scaled_rect = nornir_imageregistration.Rectangle.CreateFromCenterPointAndArea(overlapping_rect.Center, [Height, Width])
     
     #scaled_rect = nornir_imageregistration.Rectangle.scale_on_center(overlapping_rect, excess_scalar)
-    scaled_rect = nornir_imageregistration.Rectangle.SafeRound(scaled_rect)
-    return nornir_imageregistration.CropImage(image, Xo=int(scaled_rect.BottomLeft[1]), Yo=int(scaled_rect.BottomLeft[0]), Width=int(scaled_rect.Width), Height=int(scaled_rect.Height), cval=cval)
+    return nornir_imageregistration.Rectangle.SafeRound(scaled_rect)
+
+
+def _OverlapStripKey(image_path, strip_rect):
+    '''
+    Image cache key of an overlap strip.  Strips are keyed by their position in the tile, so a strip is reused
+    by later passes as long as the overlap does not move relative to the tile.
+    '''
+    return nornir_imageregistration.image_cache.ImageKey(image_path) + ('overlap_strip',
+                                                                         int(strip_rect.BottomLeft[0]), int(strip_rect.BottomLeft[1]),
+                                                                         int(strip_rect.Height), int(strip_rect.Width))
+
+
+def _CreateOverlapStrip(image, strip_rect, seed):
+    '''
+    Crop the strip from the tile's image.  Pixels outside the tile are filled with noise matching the cropped pixels.
+    The noise is drawn from a generator seeded with seed, so the same strip is identical whenever it is created.
+    :param ndarray image: Tile image
+    :param Rectangle strip_rect: Integer rectangle to crop, see _OverlapStripRect
+    :param int seed: Seed for the noise
+    :return: float32 strip
+    '''
+    strip = nornir_imageregistration.CropImage(image, Xo=int(strip_rect.BottomLeft[1]), Yo=int(strip_rect.BottomLeft[0]),
+                                               Width=int(strip_rect.Width), Height=int(strip_rect.Height)).astype(np.float32, copy=False)
     
-    # return nornir_imageregistration.PadImageForPhaseCorrelation(cropped, MinOverlap=1.0, PowerOfTwo=True)
+    image_rect = nornir_imageregistration.Rectangle([0, 0, image.shape[0], image.shape[1]])
+    overlap_rect = nornir_imageregistration.Rectangle.overlap_rect(image_rect, strip_rect)
+    if overlap_rect is None:
+        return strip
+    
+    (startY, startX) = (overlap_rect.BottomLeft - strip_rect.BottomLeft).astype(np.int64)
+    (endY, endX) = np.array((startY, startX)) + overlap_rect.Size.astype(np.int64)
+    
+    Mask = np.zeros(strip.shape, dtype=bool)
+    Mask[startY:endY, startX:endX] = True
+    
+    NumMaskedPixels = Mask.size - np.count_nonzero(Mask)
+    if NumMaskedPixels == 0:
+        return strip
+    
+    UnmaskedPixels = strip[startY:endY, startX:endX]
+    
+    rng = np.random.default_rng(seed)
+    noise = rng.standard_normal(NumMaskedPixels, dtype=np.float32)
+    noise *= np.std(UnmaskedPixels, dtype=np.float64)
+    noise += np.median(UnmaskedPixels)
+    np.clip(noise, UnmaskedPixels.min(), UnmaskedPixels.max(), out=noise)
+    
+    strip[~Mask] = noise
+    return strip
+
+
+def _GetOverlapStrip(image_path, strip_rect, spill_dir=None, spill=False):
+    '''
+    Return the overlap strip through the image cache, cropping it from the tile only if it is not cached
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
+    :param bool spill: Write the spill file now so other processes can map the strip
+    '''
+    key = _OverlapStripKey(image_path, strip_rect)
+    
+    def CreateStrip():
+        image = nornir_imageregistration.image_cache.LoadImageCached(image_path, spill_dir=spill_dir)
+        seed = int(hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[0:8], 16)
+        return _CreateOverlapStrip(image, strip_rect, seed)
+        
+    return nornir_imageregistration.image_cache.GetArrayCached(key, CreateStrip, spill_dir=spill_dir, spill=spill)
+
+
+def _GetOverlapStripFFT(image_path, strip_rect, spill_dir=None, spill=False):
+    '''
+    Return the half-spectrum of the overlap strip, see PhaseCorrelator.FFT, through the image cache
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
+    :param bool spill: Write the spill files for the strip and spectrum now so other processes can map them
+    '''
+    key = _OverlapStripKey(image_path, strip_rect) + ('rfft2',)
+    
+    def CreateFFT():
+        strip = _GetOverlapStrip(image_path, strip_rect, spill_dir=spill_dir, spill=spill)
+        correlator = nornir_imageregistration.phase_correlation.GetPhaseCorrelator(strip.shape)
+        return correlator.FFT(strip)[0]
+        
+    return nornir_imageregistration.image_cache.GetArrayCached(key, CreateFFT, spill_dir=spill_dir, spill=spill)
  
 
-def __tile_offset_remote(A_Filename, B_Filename, scaled_overlapping_source_rect_A, scaled_overlapping_source_rect_B, OffsetAdjustment, excess_scalar):
+def __tile_offset_remote(A_Filename, B_Filename, scaled_overlapping_source_rect_A, scaled_overlapping_source_rect_B, OffsetAdjustment, excess_scalar, spill_dir=None):
     '''
     :param A_Filename: Path to tile A
     :param B_Filename: Path to tile B
@@ -618,40 +772,29 @@ def __tile_offset_remote(A_Filename, B_Filename, scaled_overlapping_source_rect_
     :param scaled_overlapping_source_rect_B: Region of overlap on tile B with tile A
     :param OffsetAdjustment: scaled_offset to account for the (center) position of tile B relative to tile A.  If the overlapping rectangles are perfectly aligned the reported offset would be (0,0).  OffsetAdjustment would be added to that (0,0) result to ensure Tile B remained in the same position. 
     :param float excess_scalar: How much additional area should we pad the overlapping rectangles with.
+    :param str spill_dir: Image cache spill directory shared by the processes of this run
     Return the offset required to align to image files.
     This function exists to minimize the inter-process communication
     '''
     
     ShowImages = False 
-    A = nornir_imageregistration.LoadImage(A_Filename)
-    B = nornir_imageregistration.LoadImage(B_Filename)
-
-# I had to add the .astype call above for DM4 support, but I recall it broke PMG input.  Leave this comment here until the tests are passing
-#    A = nornir_imageregistration.LoadImage(A_Filename) #.astype(dtype=np.float16)
-#    B = nornir_imageregistration.LoadImage(B_Filename) #.astype(dtype=np.float16)
     
     # I tried a 1.0 overlap.  It works better for light microscopy where the reported stage position is more precise
     # For TEM the stage position can be less reliable and the 1.5 scalar produces better results
     # For the latest version of the code that uses only the overlapping region 3 is appropriate because it allows the alignment point to be anywhere on the image without ambiguity
-    OverlappingRegionA = __get_overlapping_image(A, scaled_overlapping_source_rect_A, excess_scalar=excess_scalar)
-    OverlappingRegionB = __get_overlapping_image(B, scaled_overlapping_source_rect_B, excess_scalar=excess_scalar)
+    strip_rect_A = _OverlapStripRect(scaled_overlapping_source_rect_A, excess_scalar)
+    strip_rect_B = _OverlapStripRect(scaled_overlapping_source_rect_B, excess_scalar)
     
+    #Each tile overlaps several neighbors and an overlap is aligned again whenever the layout moves the tiles, 
+    #the cache returns strips and spectra already created by the scoring stage or an earlier pass 
+    OverlappingRegionA = _GetOverlapStrip(A_Filename, strip_rect_A, spill_dir=spill_dir)
+    OverlappingRegionB = _GetOverlapStrip(B_Filename, strip_rect_B, spill_dir=spill_dir)
     
     if ShowImages:
-        o_a = __get_overlapping_image(A, scaled_overlapping_source_rect_A, excess_scalar=1.0, cval=0)
-        o_b = __get_overlapping_image(B, scaled_overlapping_source_rect_B, excess_scalar=1.0, cval=0)
+        o_a = __get_overlapping_image(nornir_imageregistration.image_cache.LoadImageCached(A_Filename), scaled_overlapping_source_rect_A, excess_scalar=1.0, cval=0)
+        o_b = __get_overlapping_image(nornir_imageregistration.image_cache.LoadImageCached(B_Filename), scaled_overlapping_source_rect_B, excess_scalar=1.0, cval=0)
         
     #nornir_imageregistration.ShowGrayscale([[OverlappingRegionA, OverlappingRegionB],[o_a,o_b]])
-    OverlappingRegionA = OverlappingRegionA.astype(np.float32)
-    OverlappingRegionB = OverlappingRegionB.astype(np.float32)
-    
-    # It is fairly common to underflow when dividing float16 images, so just warn and move on. 
-    # I spent a day debugging why a mosaic was not building correctly to find the underflow 
-    # issue, so don't remove it.  The underflow error removes one of the ties between a tile
-    # and its neighbors.
-    
-    # Note error levelshould now be set in nornir_imageregistration.__init__
-    # old_float_err_settings = np.seterr(under='warn')
     
     # If the entire region is a solid color, then return an alignment record with no offset and a weight of zero
     if (OverlappingRegionA.min() == OverlappingRegionA.max()) or \
@@ -659,23 +802,20 @@ def __tile_offset_remote(A_Filename, B_Filename, scaled_overlapping_source_rect_
         (OverlappingRegionB.min() == OverlappingRegionB.max()) or \
         (OverlappingRegionB.max() == 0):
         return nornir_imageregistration.AlignmentRecord(peak=OffsetAdjustment, weight=0)
-            
-    OverlappingRegionA -= OverlappingRegionA.min()
-    OverlappingRegionA /= OverlappingRegionA.max()
     
-    OverlappingRegionB -= OverlappingRegionB.min()
-    OverlappingRegionB /= OverlappingRegionB.max()
+    # The strips are not rescaled to 0-1.  The phase correlation subtracts the mean and normalizes the 
+    # cross-power spectrum, so the peak does not depend on the intensity scale of either strip.
+    FFT_A = _GetOverlapStripFFT(A_Filename, strip_rect_A, spill_dir=spill_dir)
+    FFT_B = _GetOverlapStripFFT(B_Filename, strip_rect_B, spill_dir=spill_dir)
     
-    # nornir_imageregistration.ShowGrayscale([OverlappingRegionA, OverlappingRegionB]) nornir_imageregistration.ShowGrayscale([[o_a, o_b],[OverlappingRegionA, OverlappingRegionB]])
-    
-    record = nornir_imageregistration.FindOffset(OverlappingRegionA, OverlappingRegionB, FFT_Required=True)#, FixedImageShape=scaled_overlapping_source_rect_A.shape, MovingImageShape=scaled_overlapping_source_rect_B.shape)
+    correlator = nornir_imageregistration.phase_correlation.GetPhaseCorrelator(OverlappingRegionA.shape)
+    record = correlator.FindOffsets(FFT_A, FFT_B, FFT_Required=False)[0]
     
     #overlapping_rect_B_AdjustedToPeak = nornir_imageregistration.Rectangle.translate(scaled_overlapping_source_rect_B, -record.peak) 
     #overlapping_rect_B_AdjustedToPeak = nornir_imageregistration.Rectangle.change_area(overlapping_rect_B_AdjustedToPeak, scaled_overlapping_source_rect_A.Size)
     #median_diff = __AlignmentScoreRemote(A, B, scaled_overlapping_source_rect_A, overlapping_rect_B_AdjustedToPeak)
     #nornir_imageregistration.ShowGrayscale([[OverlappingRegionA, OverlappingRegionB], [overlapping_rect_B_AdjustedToPeak, median_diff]])
     #diff_weight = 1.0 - median_diff
-    #np.seterr(**old_float_err_settings)
     
     #nornir_imageregistration.views.plot_aligned_images(record, o_a, o_b)
     adjusted_record = nornir_imageregistration.AlignmentRecord(np.array(record.peak) + OffsetAdjustment, record.weight)
@@ -685,8 +825,6 @@ def __tile_offset_remote(A_Filename, B_Filename, scaled_overlapping_source_rect_
         del o_a
         del o_b
         
-    del A
-    del B
     del OverlappingRegionA
     del OverlappingRegionB
     
@@ -699,8 +837,14 @@ def BuildOverlappingTileDict(list_tiles, minOverlap=0.05):
     for tile in list_tiles:
         list_rects.append(tile.FixedBoundingBox)
         
-    rset = nornir_imageregistration.RectangleSet.Create(list_rects)
-    return rset.BuildTileOverlapDict()
+    rindex = nornir_imageregistration.RectangleIndex.Create(list_rects)
+    
+    OverlapDict = {tile.ID: set() for tile in list_tiles}
+    for (A, B) in rindex.EnumerateOverlapping():
+        OverlapDict[list_tiles[A].ID].add(list_tiles[B].ID)
+        OverlapDict[list_tiles[B].ID].add(list_tiles[A].ID)
+        
+    return OverlapDict
     
 
 def ScoreMosaicQuality(transforms, imagepaths, imageScale=None):
@@ -756,10 +900,10 @@ def __AlignmentScoreRemote(A_Filename, B_Filename, scaled_overlapping_source_rec
     '''Returns the difference between the images'''
     
     try: 
-        OverlappingRegionA = __get_overlapping_image(nornir_imageregistration.ImageParamToImageArray(A_Filename, dtype=np.float16),
+        OverlappingRegionA = __get_overlapping_image(nornir_imageregistration.image_cache.LoadImageCached(A_Filename, dtype=np.float16),
                                                      scaled_overlapping_source_rect_A,
                                                      excess_scalar=1.0)
-        OverlappingRegionB = __get_overlapping_image(nornir_imageregistration.ImageParamToImageArray(B_Filename, dtype=np.float16),
+        OverlappingRegionB = __get_overlapping_image(nornir_imageregistration.image_cache.LoadImageCached(B_Filename, dtype=np.float16),
                                                      scaled_overlapping_source_rect_B,
                                                      excess_scalar=1.0)
         
@@ -9,11 +9,12 @@ import os
 
 from matplotlib.pyplot import imsave
 from nornir_imageregistration.files.stosfile import StosFile
-from   nornir_imageregistration.transforms import factory, triangulation
+from   nornir_imageregistration.transforms import factory, triangulation, rigid
 from   nornir_imageregistration.transforms.utils import InvalidIndicies
 from scipy.ndimage import interpolation
 
 import nornir_imageregistration
+import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
 import nornir_imageregistration.transforms.base as transformbase
 import nornir_pools
 import nornir_shared.images as images
@@ -21,6 +22,10 @@ import nornir_shared.prettyoutput as PrettyOutput
 import numpy as np
 
 
+#Default maximum number of pixels in each row block when warping a region, see ROIRowBlocks
+DefaultMaxROIBlockPixels = 1 << 20
+
+
 def GetROICoords(botleft, area):
     x_range = np.arange(botleft[1], botleft[1] + area[1], dtype=np.float32)
     y_range = np.arange(botleft[0], botleft[0] + area[0], dtype=np.float32)
@@ -32,18 +37,33 @@ def GetROICoords(botleft, area):
     if len(y_range) > area[0]:
         y_range = y_range[:int(area[0])]
 
-    i_y, i_x = np.meshgrid(y_range, x_range, sparse=False, indexing='ij')
-
-    coordArray = np.vstack((i_y.astype(np.float32).flat, i_x.astype(np.float32).flat)).transpose()
-    
-    del i_y
-    del i_x
-    del x_range
-    del y_range
+    # Fill a single preallocated array instead of stacking copies of a meshgrid
+    coordArray = np.empty((len(y_range) * len(x_range), 2), dtype=np.float32)
+    coordGrid = coordArray.reshape((len(y_range), len(x_range), 2))
+    coordGrid[:, :, 0] = y_range[:, np.newaxis]
+    coordGrid[:, :, 1] = x_range[np.newaxis, :]
 
     return coordArray
 
-def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False):
+def ROIRowBlocks(botleft, area, max_block_pixels=None):
+    '''
+    Divide a region of interest into blocks of whole rows
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
+    :param 1x2_array area: The (Height, Width) of the region of interest
+    :param int max_block_pixels: Maximum number of pixels in a block, at least one row is always returned.  Defaults to DefaultMaxROIBlockPixels
+    :return: Yields (first_row, block_botleft, block_area) for each block
+    '''
+    if max_block_pixels is None:
+        max_block_pixels = DefaultMaxROIBlockPixels
+        
+    (height, width) = (int(area[0]), int(area[1]))
+    block_rows = max(1, int(max_block_pixels) // max(1, width))
+    
+    for first_row in range(0, height, block_rows):
+        num_rows = min(block_rows, height - first_row)
+        yield (first_row, (botleft[0] + first_row, botleft[1]), (num_rows, width))
+
+def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False, coordinate_cache=None):
     ''' 
     Apply a transform to a region of interest within an image. Center and area are in fixed space
     
@@ -51,9 +71,16 @@ def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False):
     :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
     :param 1x2_array area: The (Height, Width) of the region of interest
     :param bool exrapolate: If true map points that fall outside the bounding box of the transform
+    :param CoordinateMapCache coordinate_cache: Optional cache of coordinate maps used instead of transforming every pixel
     :return: Tuple of arrays.  First array is fixed space coordinates.  Second array is warped space coordinates.
     :rtype: tuple(Nx2 array,Nx2 array)
     '''
+    
+    if coordinate_cache is not None:
+        return coordinate_cache.DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=extrapolate)
+    
+    if getattr(transform, 'InverseCoordinateMap', None) is not None:
+        return coordinate_map_cache.CoordinateMapToROICoords(transform.InverseCoordinateMap(botleft, area, extrapolate=extrapolate))
 
     DstSpace_coordArray = GetROICoords(botleft, area)
 
@@ -62,8 +89,15 @@ def DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=False):
 
     del SrcSpace_coordArray
 
-    valid_DstSpace_coordArray = np.delete(DstSpace_coordArray, InvalidIndiciesList, axis=0)
-    valid_DstSpace_coordArray = valid_DstSpace_coordArray - botleft
+    if len(InvalidIndiciesList) > 0:
+        valid = np.ones(DstSpace_coordArray.shape[0], dtype=bool)
+        valid[InvalidIndiciesList] = False
+        valid_DstSpace_coordArray = DstSpace_coordArray[valid]
+    else:
+        valid_DstSpace_coordArray = DstSpace_coordArray
+        
+    del DstSpace_coordArray
+    valid_DstSpace_coordArray -= np.asarray(botleft, dtype=np.float32)
 
     return (valid_DstSpace_coordArray, valid_SrcSpace_coordArray)
 
@@ -125,6 +159,13 @@ def __ExtractRegion(image, botleft, area):
     return ExtractRegion(image, botleft, area)
 
 
+def __CoordinateBounds(coordinates):
+    '''Return the minimum and maximum of an Nx2 coordinate array.  Reducing each column separately is much faster than reducing along axis 0.'''
+    minCoord = np.array([np.min(coordinates[:, 0]), np.min(coordinates[:, 1])], dtype=np.float64)
+    maxCoord = np.array([np.max(coordinates[:, 0]), np.max(coordinates[:, 1])], dtype=np.float64)
+    return (minCoord, maxCoord)
+
+
 def __CropImageToFitCoords(input_image, coordinates, cval=0):
     '''For large images we only need a specific range of coordinates from the image.  However Scipy calls such as map_coordinates will 
        send the entire image through a spline_filter first.  To avoid this we crop the image with a padding of one and adjust the 
@@ -134,8 +175,9 @@ def __CropImageToFitCoords(input_image, coordinates, cval=0):
        :param float cval: Value to use for regions outside the existing image when padding
        :return: (cropped_image, translated_coordinates)
        '''
-    minCoord = np.floor(np.min(coordinates, 0)) - np.array([1, 1])
-    maxCoord = np.ceil(np.max(coordinates, 0)) + np.array([1, 1])
+    (minCoord, maxCoord) = __CoordinateBounds(coordinates)
+    minCoord = np.floor(minCoord) - np.array([1, 1])
+    maxCoord = np.ceil(maxCoord) + np.array([1, 1])
     
     if minCoord[0] < 0:
         minCoord[0] = 0
@@ -234,6 +276,208 @@ def __WarpedImageUsingCoords(fixed_coords, warped_coords, FixedImageArea, Warped
         return transformedImage
        
 
+def __SampleImageAtCoords(WarpedImage, warped_coords, cval=0):
+    '''Sample the image at the coordinates, cropping the image to the coordinates first.  Unlike __WarpedImageUsingCoords the values are not clipped.'''
+    
+    (subroi_warpedImage, warped_coords) = __CropImageToFitCoords(WarpedImage, warped_coords, cval=cval)
+    if subroi_warpedImage.shape[0] == 0 or subroi_warpedImage.shape[1] == 0:
+        return np.full(warped_coords.shape[0], cval, dtype=WarpedImage.dtype)
+    
+    warped_coords = np.around(warped_coords, 3)
+    return interpolation.map_coordinates(subroi_warpedImage, warped_coords.transpose(), mode='constant', order=0, cval=cval)
+
+
+def __WeightsUsingCoords(fixed_coords, warped_coords, area, weight_function, cval=0):
+    '''Create an image of the weights of the warped space coordinates each fixed space pixel maps to
+    :Param fixed_coords: 2D coordinates in fixed space
+    :Param warped_coords: 2D coordinates in warped space
+    :Param area: Dimensions of output
+    :Param weight_function: Function returning a weight for each row of an Nx2 array of warped space coordinates
+    :Param cval: Weight of unmappable pixels'''
+    
+    area = (int(area[0]), int(area[1]))
+    weights = np.full(area, cval, dtype=np.float32)
+    if warped_coords.shape[0] == 0:
+        return weights
+    
+    # Round as the coordinates are when the image is sampled so weights agree with the pixel sampled
+    values = weight_function(np.around(warped_coords, 3))
+    if fixed_coords.shape[0] == np.prod(area):
+        weights[:] = values.reshape(area)
+    else:
+        fixed_coords_rounded = np.round(fixed_coords).astype(dtype=np.int32)
+        weights[fixed_coords_rounded[:, 0], fixed_coords_rounded[:, 1]] = values
+        
+    return weights
+
+
+def __WarpedImagesInRowBlocks(transform, ImagesToTransform, botleft, area, cval, extrapolate=False, max_block_pixels=None, weight_function=None, weight_cval=0):
+    '''Warp the images one block of rows at a time, writing each block into preallocated outputs.
+       Only one block of coordinates exists at a time.  The result matches calling __WarpedImageUsingCoords on the whole region.
+    :Param list ImagesToTransform: Images to read pixel values from
+    :Param list cval: Value to place in unmappable regions for each image
+    :Param weight_function: Optional function returning a weight for each row of an Nx2 array of warped space coordinates, see WarpedImageToFixedSpace
+    :Param weight_cval: Weight of unmappable pixels
+    :return: List of warped images, followed by the weight image if a weight_function was passed'''
+    
+    area = (int(area[0]), int(area[1]))
+    outputImages = [np.full(area, cval[i], dtype=wi.dtype) for (i, wi) in enumerate(ImagesToTransform)]
+    weights = None if weight_function is None else np.full(area, weight_cval, dtype=np.float32)
+    
+    # Pixels the transform could not map keep cval without clipping, so remember them if there are any
+    mapped = None
+    num_mapped = 0
+    minCoord = np.full(2, np.inf)
+    maxCoord = np.full(2, -np.inf)
+    
+    for (first_row, block_botleft, block_area) in ROIRowBlocks(botleft, area, max_block_pixels):
+        (DstSpace_coords, SrcSpace_coords) = DestinationROI_to_SourceROI(transform, block_botleft, block_area, extrapolate=extrapolate)
+        
+        all_mapped = SrcSpace_coords.shape[0] == np.prod(block_area)
+        if not all_mapped and mapped is None:
+            mapped = np.ones(area, dtype=bool)
+            
+        if SrcSpace_coords.shape[0] == 0:
+            mapped[first_row:first_row + block_area[0], :] = False
+            continue
+        
+        num_mapped += SrcSpace_coords.shape[0]
+        (blockMin, blockMax) = __CoordinateBounds(SrcSpace_coords)
+        minCoord = np.minimum(minCoord, blockMin)
+        maxCoord = np.maximum(maxCoord, blockMax)
+        
+        if all_mapped:
+            rows = None
+        else:
+            rows = np.round(DstSpace_coords[:, 0]).astype(np.int32) + first_row
+            cols = np.round(DstSpace_coords[:, 1]).astype(np.int32)
+            mapped[first_row:first_row + block_area[0], :] = False
+            mapped[rows, cols] = True
+        
+        for (i, wi) in enumerate(ImagesToTransform):
+            samples = __SampleImageAtCoords(wi, SrcSpace_coords, cval=cval[i])
+            if rows is None:
+                outputImages[i][first_row:first_row + block_area[0], :] = samples.reshape(block_area)
+            else:
+                outputImages[i][rows, cols] = samples
+                
+        if weights is not None:
+            block_weights = weight_function(np.around(SrcSpace_coords, 3))
+            if rows is None:
+                weights[first_row:first_row + block_area[0], :] = block_weights.reshape(block_area)
+            else:
+                weights[rows, cols] = block_weights
+                
+        del DstSpace_coords
+        del SrcSpace_coords
+    
+    if num_mapped == 0:
+        return outputImages if weights is None else outputImages + [weights]
+    
+    # Clip to the range of the part of the image that was sampled, as __WarpedImageUsingCoords does.
+    # The cropped region lies inside the image so a view is used instead of copying it.
+    cropMin = np.maximum(np.floor(minCoord) - 1, 0).astype(np.int64)
+    cropMax = np.maximum(np.ceil(maxCoord) + 1, 0).astype(np.int64)
+    for (i, wi) in enumerate(ImagesToTransform):
+        if np.prod(wi.shape) > num_mapped:
+            subroi_warpedImage = wi[cropMin[0]:cropMax[0], cropMin[1]:cropMax[1]]
+            if subroi_warpedImage.shape[0] == 0 or subroi_warpedImage.shape[1] == 0:
+                outputImages[i][:] = cval[i]
+                continue
+        else:
+            subroi_warpedImage = wi
+            
+        (a_min, a_max) = (subroi_warpedImage.min(), subroi_warpedImage.max())
+        if mapped is None:
+            np.clip(outputImages[i], a_min=a_min, a_max=a_max, out=outputImages[i])
+        else:
+            outputImages[i][mapped] = np.clip(outputImages[i][mapped], a_min, a_max)
+    
+    return outputImages if weights is None else outputImages + [weights]
+
+
+def _InverseAffineParameters(transform, botleft):
+    '''
+    For transforms that are affine, return the matrix and offset mapping output pixel indices to warped space.
+    :return: (2x2 matrix, offset) such that warped = matrix * [row, col] + offset, or None if the transform is not affine
+    '''
+    if not isinstance(transform, rigid.RigidNoRotation):
+        return None
+
+    botleft = np.asarray(botleft, dtype=np.float64)
+
+    if type(transform) == rigid.RigidNoRotation:
+        # RigidNoRotation ignores any angle it was created with
+        return (np.identity(2), botleft - transform.target_offset)
+
+    corners = np.vstack((botleft, botleft + (1, 0), botleft + (0, 1)))
+    warped = np.asarray(transform.InverseTransform(corners), dtype=np.float64)
+    matrix = np.vstack((warped[1] - warped[0], warped[2] - warped[0])).transpose()
+    return (matrix, warped[0])
+
+
+def __WarpedImageUsingAffine(matrix, offset, WarpedImage, area, cval=0):
+    '''Create a warped image for an affine transform without building coordinate arrays.
+       Produces the same result as __WarpedImageUsingCoords with nearest neighbor sampling.
+    :Param matrix: 2x2 matrix mapping output pixel indices to warped space
+    :Param offset: Warped space position of output pixel [0,0]
+    :Param WarpedImage: Image to read pixel values from while creating fixed space images
+    :Param area: Dimensions of output
+    :Param cval: Value to place in unmappable regions, defaults to zero.'''
+
+    area = (int(area[0]), int(area[1]))
+
+    # Only the part of the warped image under the output region is needed, crop it as __WarpedImageUsingCoords does
+    corners = np.array([[0, 0], [0, area[1] - 1], [area[0] - 1, 0], [area[0] - 1, area[1] - 1]], dtype=np.float64)
+    warped_corners = np.dot(corners, matrix.transpose()) + offset
+    (subroi_warpedImage, translated_corners) = __CropImageToFitCoords(WarpedImage, warped_corners, cval=cval)
+    if subroi_warpedImage.shape[0] == 0 or subroi_warpedImage.shape[1] == 0:
+        return np.full(area, cval, dtype=WarpedImage.dtype)
+
+    offset = translated_corners[0]
+
+    if np.array_equal(matrix, np.identity(2)):
+        # A translation samples the same nearest pixel for every output pixel, so copy the overlapping slice
+        offset = np.around(offset, 3)
+        shift = np.floor(offset + 0.5).astype(np.int64)
+        first = np.maximum(np.ceil(-offset), 0).astype(np.int64)
+        last = np.minimum(np.floor(np.array(subroi_warpedImage.shape) - 1 - offset), np.array(area) - 1).astype(np.int64)
+
+        outputImage = np.full(area, cval, dtype=subroi_warpedImage.dtype)
+        if np.all(last >= first):
+            outputImage[first[0]:last[0] + 1, first[1]:last[1] + 1] = subroi_warpedImage[first[0] + shift[0]:last[0] + shift[0] + 1,
+                                                                                         first[1] + shift[1]:last[1] + shift[1] + 1]
+    else:
+        outputImage = interpolation.affine_transform(subroi_warpedImage, matrix, offset=offset, output_shape=area, mode='constant', order=0, cval=cval)
+
+    np.clip(outputImage, a_min=subroi_warpedImage.min(), a_max=subroi_warpedImage.max(), out=outputImage)
+    return outputImage
+
+
+def __WeightsUsingAffine(matrix, offset, area, weight_function, max_block_pixels=None):
+    '''Create an image of the weights of the warped space coordinates each output pixel maps to for an affine transform.
+       Coordinates are computed one block of rows at a time.
+    :Param matrix: 2x2 matrix mapping output pixel indices to warped space
+    :Param offset: Warped space position of output pixel [0,0]
+    :Param area: Dimensions of output
+    :Param weight_function: Function returning a weight for each row of an Nx2 array of warped space coordinates'''
+    
+    area = (int(area[0]), int(area[1]))
+    weights = np.empty(area, dtype=np.float32)
+    columns = np.arange(area[1], dtype=np.float64)
+    
+    for (first_row, block_botleft, block_area) in ROIRowBlocks((0, 0), area, max_block_pixels):
+        rows = np.arange(first_row, first_row + block_area[0], dtype=np.float64)
+        warped_coords = np.empty((block_area[0], block_area[1], 2), dtype=np.float64)
+        for iAxis in range(2):
+            np.add.outer(matrix[iAxis, 0] * rows + offset[iAxis], matrix[iAxis, 1] * columns, out=warped_coords[:, :, iAxis])
+            
+        np.around(warped_coords, 3, out=warped_coords)
+        weights[first_row:first_row + block_area[0], :] = weight_function(warped_coords.reshape((-1, 2))).reshape(block_area)
+        
+    return weights
+
+
 def _ReplaceFilesWithImages(listImages):
     '''Replace any filepath strings in the passed parameter with loaded images.'''
     
@@ -288,7 +532,8 @@ def FixedImageToWarpedSpace(transform, WarpedImageArea, DataToTransform, botleft
 
         
 
-def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False):
+def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=None, area=None, cval=None, extrapolate=False, coordinate_cache=None, max_block_pixels=None,
+                            weight_function=None, weight_cval=0):
 
     '''Warps every image in the DataToTransform list using the provided transform.
     :Param transform: transform to pass warped space coordinates through to obtain fixed space coordinates
@@ -298,6 +543,12 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
     :Param area: Expected dimensions of output
     :Param cval: Value to place in unmappable regions, defaults to zero.
     :param bool extrapolate: If true map points that fall outside the bounding box of the transform
+    :param CoordinateMapCache coordinate_cache: Optional cache of coordinate maps, reused when the same transform is warped into the same region again
+    :param int max_block_pixels: When no coordinate_cache is passed the region is warped in blocks of rows with at most this many pixels.  Defaults to DefaultMaxROIBlockPixels.
+    :param function weight_function: Optional function returning a weight for each row of an Nx2 array of warped space coordinates.  Used to compute
+                                      a weight image from the coordinate each pixel was sampled from without warping a second image.
+    :param float weight_cval: Weight of unmappable pixels
+    :return: The warped image, or list of warped images if a list was passed.  If a weight_function is passed a tuple of (warped images, float32 weight image) is returned.
     '''
     
     ImagesToTransform = _ReplaceFilesWithImages(DataToTransform)  
@@ -320,23 +571,49 @@ def WarpedImageToFixedSpace(transform, FixedImageArea, DataToTransform, botleft=
     if cval is None:
         cval = 0
         
-    (DstSpace_coords, SrcSpace_coords) = DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=extrapolate)
-    
-    if isinstance(ImagesToTransform, list):
-        if not isinstance(cval, list):
-            cval = [cval] * len(DataToTransform)    
+    is_list = isinstance(ImagesToTransform, list)
+    if not is_list:
+        ImagesToTransform = [ImagesToTransform]
+        cval = [cval]
+    elif not isinstance(cval, list):
+        cval = [cval] * len(ImagesToTransform)
+        
+    weights = None
+        
+    affine = _InverseAffineParameters(transform, botleft)
+    if affine is not None:
+        # Rigid and similarity transforms do not need per-pixel coordinates
+        (matrix, offset) = affine
+        FixedImageList = [__WarpedImageUsingAffine(matrix, offset, wi, area, cval=cval[i]) for (i, wi) in enumerate(ImagesToTransform)]
+        if weight_function is not None:
+            weights = __WeightsUsingAffine(matrix, offset, area, weight_function, max_block_pixels=max_block_pixels)
+    elif coordinate_cache is None:
+        # Warp blocks of rows so the coordinate arrays for the entire region are never allocated at once
+        FixedImageList = __WarpedImagesInRowBlocks(transform, ImagesToTransform, botleft, area, cval, extrapolate=extrapolate, max_block_pixels=max_block_pixels,
+                                                   weight_function=weight_function, weight_cval=weight_cval)
+        if weight_function is not None:
+            weights = FixedImageList.pop()
+    else:
+        (DstSpace_coords, SrcSpace_coords) = DestinationROI_to_SourceROI(transform, botleft, area, extrapolate=extrapolate, coordinate_cache=coordinate_cache)
         
         FixedImageList = []
         for i, wi in enumerate(ImagesToTransform):
             fi = __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, wi, area, cval=cval[i])
             FixedImageList.append(fi)
             
+        if weight_function is not None:
+            weights = __WeightsUsingCoords(DstSpace_coords, SrcSpace_coords, area, weight_function, cval=weight_cval)
+            
         del SrcSpace_coords
         del DstSpace_coords
         
-        return FixedImageList
-    else:
-        return __WarpedImageUsingCoords(DstSpace_coords, SrcSpace_coords, FixedImageArea, ImagesToTransform, area, cval=cval)
+    output = FixedImageList if is_list else FixedImageList[0]
+    
+    if weight_function is None:
+        return output
+    
+    return (output, weights)
+
 
 def ParameterToStosTransform(transformData):
     '''
@@ -13,6 +13,8 @@ import threading
 
 import nornir_imageregistration
 import nornir_imageregistration.assemble  as assemble
+import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
+import nornir_imageregistration.shared_buffers as shared_buffers
 import nornir_imageregistration.spatial as spatial
 import nornir_imageregistration.tileset as tiles
 import nornir_imageregistration.transforms.utils as tutils
@@ -28,6 +30,12 @@ import numpy as np
 # import nornir_imageregistration.transforms.triangulation as triangulation
 DistanceImageCache = {}
 
+#Rows in each band of the output image when workers composite into shared memory
+CanvasBandHeight = 256
+
+#Maximum number of locks guarding the bands of the output image
+MaxCanvasLocks = 64
+
 # TODO: Use atexit to delete the temporary files
 # TODO: use_memmap does not work when assembling tiles on a cluster, disable for now.  Specific test is IDOCTests.test_AssembleTilesIDoc
 use_memmap = True
@@ -84,6 +92,248 @@ def CompositeImageWithZBuffer(FullImage, FullZBuffer, SubImage, SubZBuffer, offs
 
     return
 
+
+def __CompositeRegion(FullImage, SubImage, offset):
+    '''Return the slices of the full image covered by the sub image, raising ValueError if the sub image is empty'''
+    minX = int(offset[1])
+    minY = int(offset[0])
+    maxX = int(minX + SubImage.shape[1])
+    maxY = int(minY + SubImage.shape[0])
+    
+    if minY == maxY or minX == maxX:
+        raise ValueError("Buffers have zero dimensions")
+    
+    return (slice(minY, maxY), slice(minX, maxX))
+
+
+def CompositeImageWithWeights(FullImage, FullWeights, SubImage, SubWeights, offset):
+    '''Add the weighted sub image to a running weighted sum.  Divide FullImage by FullWeights to obtain the weighted average.'''
+    
+    if SubImage.shape != SubWeights.shape:
+        raise ValueError("Buffers do not have the same dimensions")
+    
+    region = __CompositeRegion(FullImage, SubImage, offset)
+    SubWeights = SubWeights.astype(np.float32)
+    FullImage[region] += SubImage * SubWeights
+    FullWeights[region] += SubWeights
+    return
+
+
+def CompositeImageWithMax(FullImage, FullCoverage, SubImage, SubCoverage, offset):
+    '''Keep the maximum of the covered pixels of the full and sub images.  Coverage is non-zero where an image has data.'''
+    
+    if SubImage.shape != SubCoverage.shape:
+        raise ValueError("Buffers do not have the same dimensions")
+    
+    region = __CompositeRegion(FullImage, SubImage, offset)
+    covered = SubCoverage > 0
+    iUpdate = covered & ((FullCoverage[region] == 0) | (SubImage > FullImage[region]))
+    FullImage[region][iUpdate] = SubImage[iUpdate]
+    FullCoverage[region][covered] = 1
+    return
+
+
+def CenterDistanceProfiles(shape):
+    '''
+    The distance of each row and column from the center of an image, matching the distances used by CreateDistanceImage2.
+    The distance of pixel (i,j) from the center is sqrt(y_profile[i]^2 + x_profile[j]^2)
+    :return: (y_profile, x_profile)
+    '''
+    profiles = []
+    for length in shape:
+        length = int(length)
+        if length % 2 == 0:
+            half = length // 2
+            half_profile = np.linspace(0.5, half + 0.5, num=half)
+            profiles.append(np.hstack((half_profile[::-1], half_profile)))
+        else:
+            half = (length + 1) // 2
+            half_profile = np.linspace(0, half - 1, num=half)
+            profiles.append(np.hstack((half_profile[:0:-1], half_profile)))
+            
+    return tuple(profiles)
+
+
+def _SourcePixelIndicies(source_coords, source_shape):
+    '''
+    Return which coordinates fall inside the source image and the index of the nearest pixel, matching nearest neighbor sampling of the image
+    :param ndarray source_coords: Nx2 array of source space coordinates
+    :return: (inside, rows, columns) where rows and columns are the nearest pixel indicies, clipped to the image for coordinates outside it
+    '''
+    inside = None
+    indicies = []
+    for iAxis in range(2):
+        axis_coords = source_coords[:, iAxis]
+        axis_inside = (axis_coords >= 0) & (axis_coords <= source_shape[iAxis] - 1)
+        inside = axis_inside if inside is None else np.logical_and(inside, axis_inside, out=inside)
+        
+        # Truncating non-negative values rounds down, so clip before converting to indicies
+        axis_indicies = axis_coords + 0.5
+        np.clip(axis_indicies, 0, source_shape[iAxis] - 1, out=axis_indicies)
+        indicies.append(axis_indicies.astype(np.intp))
+        
+    return (inside, indicies[0], indicies[1])
+
+
+class BlendMode(object):
+    '''
+    A way of combining warped tiles into an output image.  Each warped tile carries a weight image computed
+    analytically from the source space coordinate each pixel was sampled from, see TileWeights.  Tiles are
+    combined into an output image and weight buffer with Composite, and Finish converts the buffers into the final image and mask.
+    '''
+    
+    #Name used to select the mode with GetBlendMode
+    Name = None
+    
+    #dtypes of the output image and weight buffers
+    BufferDtypes = (np.float16, np.float16)
+    
+    @classmethod
+    def EmptyTileWeight(cls):
+        '''Weight of tile pixels without image data'''
+        return 0
+    
+    @classmethod
+    def EmptyBufferWeight(cls):
+        '''Initial value of the weight buffer'''
+        return 0
+    
+    @classmethod
+    def CreateBuffers(cls, shape):
+        ''':return: (image, weights) output buffers of the passed shape'''
+        image = np.zeros(shape, dtype=cls.BufferDtypes[0])
+        weights = np.full(shape, cls.EmptyBufferWeight(), dtype=cls.BufferDtypes[1])
+        return (image, weights)
+    
+    @classmethod
+    def InitializeBuffers(cls, image, weights):
+        '''Reset existing output buffers, such as views of shared memory'''
+        image[:] = 0
+        weights[:] = cls.EmptyBufferWeight()
+    
+    @classmethod
+    def TileWeights(cls, source_coords, source_shape):
+        '''
+        :param ndarray source_coords: Nx2 array of the source space coordinates pixels were sampled from
+        :param tuple source_shape: Shape of the source image
+        :return: Weight of each coordinate
+        '''
+        raise NotImplementedError()
+    
+    @classmethod
+    def Composite(cls, FullImage, FullWeights, SubImage, SubWeights, offset):
+        '''Combine a warped tile and its weights into the output buffers at offset'''
+        raise NotImplementedError()
+    
+    @classmethod
+    def Finish(cls, FullImage, FullWeights):
+        ''':return: (image, mask) of the final image and the pixels that have image data'''
+        raise NotImplementedError()
+    
+    
+class ZBufferBlend(BlendMode):
+    '''Each output pixel is taken from the tile whose center is nearest in source space'''
+    
+    Name = 'zbuffer'
+    
+    @classmethod
+    def EmptyTileWeight(cls):
+        return np.finfo(np.float16).max
+    
+    @classmethod
+    def EmptyBufferWeight(cls):
+        return np.finfo(np.float16).max
+    
+    @classmethod
+    def TileWeights(cls, source_coords, source_shape):
+        (inside, rows, cols) = _SourcePixelIndicies(source_coords, source_shape)
+        (y_profile, x_profile) = CenterDistanceProfiles(source_shape)
+        
+        weights = (y_profile * y_profile)[rows]
+        weights += (x_profile * x_profile)[cols]
+        weights = np.sqrt(weights.astype(np.float32))
+        weights[~inside] = cls.EmptyTileWeight()
+        return weights
+    
+    @classmethod
+    def Composite(cls, FullImage, FullWeights, SubImage, SubWeights, offset):
+        CompositeImageWithZBuffer(FullImage, FullWeights, SubImage, SubWeights, offset)
+    
+    @classmethod
+    def Finish(cls, FullImage, FullWeights):
+        return (FullImage, FullWeights < cls.EmptyBufferWeight())
+    
+    
+class FeatherBlend(BlendMode):
+    '''Output pixels are the average of overlapping tiles weighted by distance from the tile edge, which hides seams'''
+    
+    Name = 'feather'
+    
+    BufferDtypes = (np.float32, np.float32)
+    
+    @classmethod
+    def TileWeights(cls, source_coords, source_shape):
+        weights = None
+        for iAxis in range(2):
+            axis_coords = source_coords[:, iAxis]
+            edge_distance = np.minimum(axis_coords + 0.5, (source_shape[iAxis] - 0.5) - axis_coords)
+            weights = edge_distance if weights is None else np.minimum(weights, edge_distance, out=weights)
+        
+        # Coordinates outside the image have a distance below 0.5, those between -0.5 and 0 round to the edge pixel but are not sampled
+        weights[weights < 0.5] = 0
+        return weights.astype(np.float32)
+    
+    @classmethod
+    def Composite(cls, FullImage, FullWeights, SubImage, SubWeights, offset):
+        CompositeImageWithWeights(FullImage, FullWeights, SubImage, SubWeights, offset)
+    
+    @classmethod
+    def Finish(cls, FullImage, FullWeights):
+        mask = FullWeights > 0
+        image = np.zeros(FullImage.shape, dtype=np.float16)
+        image[mask] = FullImage[mask] / FullWeights[mask]
+        return (image, mask)
+    
+    
+class MaxBlend(BlendMode):
+    '''Output pixels are the maximum of overlapping tiles'''
+    
+    Name = 'max'
+    
+    @classmethod
+    def TileWeights(cls, source_coords, source_shape):
+        inside = (source_coords[:, 0] >= 0) & (source_coords[:, 0] <= source_shape[0] - 1) & \
+                 (source_coords[:, 1] >= 0) & (source_coords[:, 1] <= source_shape[1] - 1)
+        return inside.astype(np.float32)
+    
+    @classmethod
+    def Composite(cls, FullImage, FullWeights, SubImage, SubWeights, offset):
+        CompositeImageWithMax(FullImage, FullWeights, SubImage, SubWeights, offset)
+    
+    @classmethod
+    def Finish(cls, FullImage, FullWeights):
+        return (FullImage, FullWeights > 0)
+    
+    
+BlendModes = {mode.Name: mode for mode in (ZBufferBlend, FeatherBlend, MaxBlend)}
+
+
+def GetBlendMode(blend_mode=None):
+    '''
+    :param blend_mode: Name of a blend mode in BlendModes, a BlendMode class, or None for the z-buffer
+    :rtype: BlendMode
+    '''
+    if blend_mode is None:
+        return ZBufferBlend
+    
+    if isinstance(blend_mode, type) and issubclass(blend_mode, BlendMode):
+        return blend_mode
+    
+    try:
+        return BlendModes[str(blend_mode).lower()]
+    except KeyError:
+        raise ValueError("Unknown blend mode %s, expected one of %s" % (str(blend_mode), ', '.join(sorted(BlendModes.keys()))))
+
     
 def CreateDistanceImage(shape, dtype=None):
 
@@ -108,59 +358,18 @@ def CreateDistanceImage(shape, dtype=None):
     return distance
 
 def CreateDistanceImage2(shape, dtype=None):
-
-    #TODO, this has some obvious optimizations available
+    '''
+    Create an image of the distance of each pixel from the center of the image.  Images with an even dimension have no center pixel,
+    so the two center rows or columns are 0.5 from the center.
+    '''
     if dtype is None:
         dtype = np.float32
-          
-    #center = [shape[0] / 2.0, shape[1] / 2.0]
-    shape = np.asarray(shape, dtype=np.int64)
-    is_odd_shape = np.fmod(shape, 2) > 0
-    
-    half_shape = None
-    if True:
-        even_shape = shape.copy()
-        even_shape[is_odd_shape] = even_shape[is_odd_shape] - 1
-        half_shape = even_shape / 2
-        half_shape = half_shape.astype(np.int64)
-    
-    y_range = None
-    if not is_odd_shape[0]:
-        y_range = np.linspace(0.5, half_shape[0]+0.5, num=half_shape[0])  
-    else:
-        half_shape[0] = half_shape[0] + 1
-        y_range = np.linspace(0, half_shape[0]-1, num=half_shape[0])
-        
-    x_range = None
-    if not is_odd_shape[1]:
-        x_range = np.linspace(0.5, half_shape[1]+0.5, num=half_shape[1])  
-    else:
-        half_shape[1] = half_shape[1] + 1
-        x_range = np.linspace(0, half_shape[1]-1, num=half_shape[1])
         
+    (y_profile, x_profile) = CenterDistanceProfiles(shape)
     
-    x_range = x_range * x_range
-    y_range = y_range * y_range
-
-    distance = np.empty(half_shape, dtype=dtype)
-
-    for i in range(0, half_shape[0]):
-        distance[i, :] = x_range + y_range[i]
-
-    distance = np.sqrt(distance)
-    
-    #OK, mirror the array as needed to build the final image
-    if not is_odd_shape[1]:
-        distance = np.hstack((np.fliplr(distance), distance))
-    else:
-        distance = np.hstack((np.fliplr(distance[:,1:]), distance))
-
-    if not is_odd_shape[0]:
-        distance = np.vstack((np.flipud(distance), distance))
-    else:
-        distance = np.vstack((np.flipud(distance[1:,:]),distance))
-    
-    return distance
+    distance = np.empty((len(y_profile), len(x_profile)), dtype=dtype)
+    np.add.outer(y_profile * y_profile, x_profile * x_profile, out=distance)
+    return np.sqrt(distance, out=distance)
 
 
 def __MaxZBufferValue(dtype):
@@ -212,12 +421,17 @@ def EmptyDistanceBuffer(shape, dtype=np.float16):
 #     return (fullImage, fullImageZbuffer)
 
 
-def __CreateOutputBufferForArea(Height, Width, target_space_scale=None):
+def __CreateOutputBufferForArea(Height, Width, target_space_scale=None, blend=None):
     '''Create output images using the passed width and height
+    :param BlendMode blend: Blend mode the buffers are created for, the z-buffer if None
+    :return: (fullImage, weights)
     '''
     global use_memmap
     fullImage = None
     fullImage_shape = (int(Height), int(Width)) #(int(np.ceil(target_space_scale * Height)), int(np.ceil(target_space_scale * Width)))
+    
+    if blend is not None and blend is not ZBufferBlend:
+        return blend.CreateBuffers(fullImage_shape)
 
     if False: #use_memmap:
         try:
@@ -280,16 +494,41 @@ def __GetOrCreateDistanceImage(distanceImage, imageShape):
     return __GetOrCreateCachedDistanceImage(imageShape)
 
 
-def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=None, source_space_scale=None):
+def __TransformsInRegion(transforms, targetRect, spatial_index=None):
+    '''
+    Return the indices of transforms whose fixed space bounding boxes may overlap the region.
+    Rounding can grow a transform's bounds by up to two pixels, so the region is padded and callers must still test the exact intersection.
+    :param list transforms: Transforms to test
+    :param Rectangle targetRect: Region in fixed space
+    :param RectangleIndex spatial_index: Index of the transform fixed bounding boxes, in the same order as transforms.  Created if None.
+    :rtype: ndarray
+    '''
+    if spatial_index is None:
+        spatial_index = spatial.RectangleIndex.Create([transform.FixedBoundingBox for transform in transforms])
+    elif len(spatial_index) != len(transforms):
+        raise ValueError("Spatial index does not match the list of transforms")
+    
+    query_rect = spatial.Rectangle.CreateFromBounds(targetRect.ToArray() + np.array((-2, -2, 2, 2)))
+    return spatial_index.Intersect(query_rect)
+
+
+def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=None, source_space_scale=None, spatial_index=None, blend_mode=None,
+                 use_coordinate_cache=False, coordinate_cache_bytes=None):
     '''
     Generate an image of the TargetRegion.
     :param tuple TargetRegion: (MinX, MinY, Width, Height) or Rectangle class.  Specifies the SourceSpace to render from
     :param float target_space_scale: Scalar for the target space coordinates.  Used to downsample or upsample the output image.  Changes the coordinates of the target space control points of the transform. 
     :param float target_space_scale: Scalar for the source space coordinates.  Must match the change in scale of input images relative to the transform source space coordinates.  So if downsampled by
     4 images are used, this value should be 0.25.  Calculated to be correct if None.  Specifying is an optimization to reduce I/O of reading image files to calculate.
+    :param RectangleIndex spatial_index: Optional index of the transform fixed bounding boxes, in the same order as transforms.  Used to find the transforms overlapping TargetRegion.
+    :param blend_mode: How overlapping tiles are combined, a name in BlendModes or a BlendMode class.  Defaults to the z-buffer.
+    :param bool use_coordinate_cache: Keep each process's coordinate maps so warping the same tile into the same region again, for example when the mosaic is assembled more than once, does not pass every pixel through the transform.  Off by default because a single assembly warps each tile into a region once.
+    :param int coordinate_cache_bytes: Memory limit of each process's coordinate map cache.  Defaults to coordinate_map_cache.DefaultMaxCacheBytes.
     '''
 
     assert(len(transforms) == len(imagepaths))
+    
+    blend = GetBlendMode(blend_mode)
 
     # logger = logging.getLogger(__name__ + '.TilesToImage')
     if source_space_scale is None:
@@ -298,7 +537,6 @@ def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=N
     if target_space_scale is None:
         target_space_scale = source_space_scale
 
-    distanceImage = None 
     original_fixed_rect_floats = None
     
     if not TargetRegion is None:
@@ -312,9 +550,10 @@ def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=N
     scaled_targetRect = nornir_imageregistration.Rectangle.scale_on_origin(original_fixed_rect_floats, target_space_scale)
     scaled_targetRect = nornir_imageregistration.Rectangle.SafeRound(scaled_targetRect)  
     targetRect = nornir_imageregistration.Rectangle.scale_on_origin(scaled_targetRect, 1.0 / target_space_scale)
-    (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(scaled_targetRect.Height, scaled_targetRect.Width, target_space_scale)
+    (fullImage, fullImageWeights) = __CreateOutputBufferForArea(scaled_targetRect.Height, scaled_targetRect.Width, target_space_scale, blend)
 
-    for i, transform in enumerate(transforms): 
+    for i in __TransformsInRegion(transforms, targetRect, spatial_index):
+        transform = transforms[i]
         regionToRender = None
         original_transform_fixed_rect = spatial.Rectangle(transform.FixedBoundingBox)
         transform_target_rect = nornir_imageregistration.Rectangle.SafeRound(original_transform_fixed_rect)
@@ -331,9 +570,8 @@ def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=N
                       
         imagefullpath = imagepaths[i]
         
-        distanceImage = __GetOrCreateDistanceImage(distanceImage, nornir_imageregistration.GetImageSize(imagefullpath))
-        
-        transformedImageData = TransformTile(transform, imagefullpath, distanceImage, target_space_scale=target_space_scale, TargetRegion=regionToRender, SingleThreadedInvoke=True)
+        transformedImageData = TransformTile(transform, imagefullpath, target_space_scale=target_space_scale, TargetRegion=regionToRender, SingleThreadedInvoke=True,
+                                             blend_mode=blend, use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
         if transformedImageData.image is None:
             logger = logging.getLogger('TilesToImageParallel')
             logger.error('Convert task failed: ' + str(transformedImageData))
@@ -344,14 +582,14 @@ def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=N
         CompositeOffset = scaled_region_rendered.BottomLeft - scaled_targetRect.BottomLeft
         CompositeOffset = CompositeOffset.astype(np.int64)
         
-        CompositeImageWithZBuffer(fullImage, fullImageZbuffer,
-                                  transformedImageData.image, transformedImageData.centerDistanceImage,
-                                  CompositeOffset)
+        blend.Composite(fullImage, fullImageWeights,
+                        transformedImageData.image, transformedImageData.centerDistanceImage,
+                        CompositeOffset)
 
         del transformedImageData
 
-    mask = fullImageZbuffer < __MaxZBufferValue(fullImageZbuffer.dtype)
-    del fullImageZbuffer
+    (fullImage, mask) = blend.Finish(fullImage, fullImageWeights)
+    del fullImageWeights
 
     fullImage[fullImage < 0] = 0
     # Checking for > 1.0 makes sense for floating point images.  During the DM4 migration
@@ -364,15 +602,24 @@ def TilesToImage(transforms, imagepaths, TargetRegion=None, target_space_scale=N
     return (fullImage, mask)
 
 
-def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space_scale=None, source_space_scale=None, pool=None):
+def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space_scale=None, source_space_scale=None, pool=None, spatial_index=None, use_shared_memory=True,
+                         composite_in_workers=False, blend_mode=None, use_coordinate_cache=False, coordinate_cache_bytes=None):
     '''Assembles a set of transforms and imagepaths to a single image using parallel techniques.
     :param tuple TargetRegion: (MinX, MinY, Width, Height) or Rectangle class.  Specifies the SourceSpace to render from
     :param float target_space_scale: Scalar for the target space coordinates.  Used to downsample or upsample the output image.  Changes the coordinates of the target space control points of the transform. 
     :param float target_space_scale: Scalar for the source space coordinates.  Must match the change in scale of input images relative to the transform source space coordinates.  So if downsampled by
     4 images are used, this value should be 0.25.  Calculated to be correct if None.  Specifying is an optimization to reduce I/O of reading image files to calculate.
+    :param RectangleIndex spatial_index: Optional index of the transform fixed bounding boxes, in the same order as transforms.  Used to find the transforms overlapping TargetRegion.
+    :param bool use_shared_memory: Return warped tiles from workers through shared memory instead of temporary files.  Pools whose workers run on other machines should pass False.
+    :param bool composite_in_workers: Workers composite warped tiles into an output image in shared memory themselves instead of returning them.  Requires use_shared_memory.
+    :param blend_mode: How overlapping tiles are combined, a name in BlendModes or a BlendMode class.  Defaults to the z-buffer.
+    :param bool use_coordinate_cache: Keep each process's coordinate maps so warping the same tile into the same region again, for example when the mosaic is assembled more than once, does not pass every pixel through the transform.  Off by default because a single assembly warps each tile into a region once.
+    :param int coordinate_cache_bytes: Memory limit of each process's coordinate map cache.  Defaults to coordinate_map_cache.DefaultMaxCacheBytes.
     '''
 
     assert(len(transforms) == len(imagepaths))
+    
+    blend = GetBlendMode(blend_mode)
 
     logger = logging.getLogger('TilesToImageParallel')
   
@@ -401,11 +648,20 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
     scaled_targetRect = nornir_imageregistration.Rectangle.scale_on_origin(original_fixed_rect_floats, target_space_scale)
     scaled_targetRect = nornir_imageregistration.Rectangle.SafeRound(scaled_targetRect)  
     targetRect = nornir_imageregistration.Rectangle.scale_on_origin(scaled_targetRect, 1.0 / target_space_scale)
-    (fullImage, fullImageZbuffer) = __CreateOutputBufferForArea(scaled_targetRect.Height, scaled_targetRect.Width, target_space_scale)
+    
+    if composite_in_workers and use_shared_memory and shared_buffers.IsSupported():
+        return __TilesToSharedCanvas(transforms, imagepaths, targetRect, scaled_targetRect, target_space_scale, pool, spatial_index, blend,
+                                     use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
+    
+    (fullImage, fullImageWeights) = __CreateOutputBufferForArea(scaled_targetRect.Height, scaled_targetRect.Width, target_space_scale, blend)
+    
+    # Workers write warped tiles into shared memory slabs we read in place, falling back to temporary files if unavailable
+    slab_pool = shared_buffers.GetSlabPool() if use_shared_memory else None
 
     CheckTaskInterval = 16
 
-    for i, transform in enumerate(transforms):
+    for iQueued, i in enumerate(__TransformsInRegion(transforms, targetRect, spatial_index)):
+        transform = transforms[i]
         regionToRender = None
         original_transform_target_rect = spatial.Rectangle(transform.FixedBoundingBox)
         transform_target_rect = nornir_imageregistration.Rectangle.SafeRound(original_transform_target_rect)
@@ -421,19 +677,27 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
         scaled_region_rendered = nornir_imageregistration.Rectangle.SafeRound(scaled_region_rendered)
                       
         imagefullpath = imagepaths[i]
+        
+        shared_slab = None
+        if slab_pool is not None:
+            # Leave a pixel of slack on each axis for rounding differences in TransformTile
+            tile_shape = np.ceil(scaled_region_rendered.shape).astype(np.int64) + 1
+            shared_slab = slab_pool.Acquire(shared_buffers.PackedSize((tile_shape, tile_shape), (np.float16, np.float16)))
 
         task = pool.add_task("TransformTile" + imagefullpath,
                               TransformTile, transform=transform, 
                               imagefullpath=imagefullpath, distanceImage=None,
                               target_space_scale=target_space_scale, TargetRegion=regionToRender,
-                              SingleThreadedInvoke=False)
+                              SingleThreadedInvoke=False, shared_slab=shared_slab, blend_mode=blend,
+                              use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
+        task.shared_slab = shared_slab
         task.transform = transform
         task.regionToRender = regionToRender
         task.scaled_region_rendered = scaled_region_rendered
         task.transform_fixed_rect = transform_target_rect
         tasks.append(task)
 
-        if not i % CheckTaskInterval == 0:
+        if not iQueued % CheckTaskInterval == 0:
             continue
         
         if len(tasks) > multiprocessing.cpu_count():
@@ -442,7 +706,7 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
                 t = tasks[iTask]
                 if t.iscompleted:
                     transformedImageData = t.wait_return()
-                    __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageZbuffer, scaled_targetRect)
+                    __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageWeights, scaled_targetRect, blend)
                     del transformedImageData 
                     del tasks[iTask]
                 
@@ -453,7 +717,7 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
     while len(tasks) > 0:
         t = tasks.pop(0)
         transformedImageData = t.wait_return()     
-        __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageZbuffer, scaled_targetRect)
+        __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageWeights, scaled_targetRect, blend)
         del transformedImageData
         del t
         
@@ -463,7 +727,7 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
             t = tasks[iTask]
             if t.iscompleted:
                 transformedImageData = t.wait_return()
-                __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageZbuffer, scaled_targetRect)
+                __AddTransformedTileTaskToComposite(t, transformedImageData, fullImage, fullImageWeights, scaled_targetRect, blend)
                 del transformedImageData 
                 del tasks[iTask]
             
@@ -471,8 +735,8 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
             
     logger.info('Final image complete, building mask')
 
-    mask = fullImageZbuffer < __MaxZBufferValue(fullImageZbuffer.dtype)
-    del fullImageZbuffer
+    (fullImage, mask) = blend.Finish(fullImage, fullImageWeights)
+    del fullImageWeights
 
     fullImage[fullImage < 0] = 0
     # Checking for > 1.0 makes sense for floating point images.  During the DM4 migration
@@ -487,7 +751,154 @@ def TilesToImageParallel(transforms, imagepaths, TargetRegion=None, target_space
     return (fullImage, mask)
 
 
-def __AddTransformedTileTaskToComposite(task, transformedImageData, fullImage, fullImageZBuffer, scaled_fixedRect=None):
+def __TilesToSharedCanvas(transforms, imagepaths, targetRect, scaled_targetRect, target_space_scale, pool, spatial_index=None, blend=ZBufferBlend,
+                          use_coordinate_cache=False, coordinate_cache_bytes=None):
+    '''
+    Assemble the region with workers compositing directly into an output image and weight buffer in shared memory.
+    The output is divided into bands of CanvasBandHeight rows.  Each band is guarded by one of a fixed set of locks,
+    so workers writing to different bands do not wait on each other.  This process only queues work.
+    '''
+    logger = logging.getLogger('TilesToImageParallel')
+    
+    canvas_shape = (int(scaled_targetRect.Height), int(scaled_targetRect.Width))
+    canvas_dtypes = blend.BufferDtypes
+    
+    slab_pool = shared_buffers.GetSlabPool()
+    canvas_slab = slab_pool.Acquire(shared_buffers.PackedSize((canvas_shape, canvas_shape), canvas_dtypes))
+    
+    # The manager's lock proxies can be passed to pool workers.  Its server process is shut down once compositing is done.
+    lock_manager = None
+    
+    try:
+        (canvas_image, canvas_weights) = canvas_slab.Views((canvas_shape, canvas_shape), canvas_dtypes)
+        blend.InitializeBuffers(canvas_image, canvas_weights)
+        
+        lock_manager = multiprocessing.Manager()
+        num_bands = int(np.ceil(canvas_shape[0] / CanvasBandHeight))
+        band_locks = [lock_manager.Lock() for i in range(min(num_bands, MaxCanvasLocks))]
+        
+        tasks = []
+        for i in __TransformsInRegion(transforms, targetRect, spatial_index):
+            transform = transforms[i]
+            transform_target_rect = nornir_imageregistration.Rectangle.SafeRound(spatial.Rectangle(transform.FixedBoundingBox))
+            
+            regionToRender = nornir_imageregistration.Rectangle.Intersect(targetRect, transform_target_rect)
+            if regionToRender is None or regionToRender.Area == 0:
+                continue
+            
+            scaled_region_rendered = nornir_imageregistration.Rectangle.scale_on_origin(regionToRender, target_space_scale)
+            scaled_region_rendered = nornir_imageregistration.Rectangle.SafeRound(scaled_region_rendered)
+            
+            CompositeOffset = (scaled_region_rendered.BottomLeft - scaled_targetRect.BottomLeft).astype(np.int64)
+            
+            task = pool.add_task("TransformTileIntoCanvas" + imagepaths[i],
+                                 TransformTileIntoCanvas, transform=transform,
+                                 imagefullpath=imagepaths[i],
+                                 canvas_slab=canvas_slab, canvas_shape=canvas_shape,
+                                 band_locks=band_locks, offset=CompositeOffset,
+                                 target_space_scale=target_space_scale, TargetRegion=regionToRender,
+                                 blend_mode=blend, use_coordinate_cache=use_coordinate_cache,
+                                 coordinate_cache_bytes=coordinate_cache_bytes)
+            tasks.append(task)
+            
+        logger.info('All warps queued, waiting for workers to composite')
+        
+        for t in tasks:
+            errormsg = t.wait_return()
+            if errormsg is not None:
+                logger.error('Convert task failed: ' + errormsg)
+        
+        (fullImage, mask) = blend.Finish(canvas_image, canvas_weights)
+        fullImage = np.array(fullImage, dtype=np.float16)
+        del canvas_image
+        del canvas_weights
+    finally:
+        if lock_manager is not None:
+            lock_manager.shutdown()
+            
+        slab_pool.Release(canvas_slab)
+    
+    fullImage[fullImage < 0] = 0
+    
+    logger.info('Assemble complete')
+    
+    return (fullImage, mask)
+
+
+def TransformTileIntoCanvas(transform, imagefullpath, canvas_slab, canvas_shape, band_locks, offset, target_space_scale=None, TargetRegion=None, blend_mode=None,
+                            use_coordinate_cache=False, coordinate_cache_bytes=None):
+    '''
+    Transform the image and composite it into an output image and weight buffer held in shared memory.  See TransformTile.
+    :param SharedSlab canvas_slab: Slab containing the output image and weight buffer, with the BufferDtypes of the blend mode
+    :param tuple canvas_shape: Shape of the output image
+    :param list band_locks: Locks guarding bands of CanvasBandHeight rows, band i is guarded by band_locks[i % len(band_locks)]
+    :param array offset: (Y,X) position of the transformed tile in the output image
+    :param blend_mode: How overlapping tiles are combined, see GetBlendMode
+    :param bool use_coordinate_cache: See TransformTile
+    :param int coordinate_cache_bytes: See TransformTile
+    :return: None on success, otherwise an error message
+    :rtype: str
+    '''
+    blend = GetBlendMode(blend_mode)
+    
+    transformedImageData = TransformTile(transform, imagefullpath, distanceImage=None,
+                                         target_space_scale=target_space_scale, TargetRegion=TargetRegion,
+                                         SingleThreadedInvoke=True, blend_mode=blend,
+                                         use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
+    
+    if transformedImageData.image is None:
+        return str(transformedImageData.errormsg)
+    
+    (canvas_image, canvas_weights) = canvas_slab.Views((canvas_shape, canvas_shape), blend.BufferDtypes)
+    
+    image = transformedImageData.image
+    weights = transformedImageData.centerDistanceImage
+    
+    minY = int(offset[0])
+    maxY = minY + image.shape[0]
+    
+    errormsg = None
+    
+    # Composite one band at a time so only one lock is held at once
+    iBand = minY // CanvasBandHeight
+    while iBand * CanvasBandHeight < maxY:
+        band_start = max(minY, iBand * CanvasBandHeight)
+        band_end = min(maxY, (iBand + 1) * CanvasBandHeight)
+        rows = slice(band_start - minY, band_end - minY)
+        
+        try:
+            with band_locks[iBand % len(band_locks)]:
+                blend.Composite(canvas_image, canvas_weights,
+                                image[rows, :], weights[rows, :],
+                                (band_start, offset[1]))
+        except ValueError:
+            # This usually indicates the input transform passed to assemble mapped to negative coordinates.
+            errormsg = 'Transformed tile mapped to negative coordinates ' + str(transformedImageData)
+            break
+        
+        iBand += 1
+    
+    del image
+    del weights
+    del canvas_image
+    del canvas_weights
+    transformedImageData.Clear()
+    
+    return errormsg
+
+
+def __AddTransformedTileTaskToComposite(task, transformedImageData, fullImage, fullImageWeights, scaled_fixedRect=None, blend=ZBufferBlend):
+    
+    try:
+        __CompositeTransformedTileTask(task, transformedImageData, fullImage, fullImageWeights, scaled_fixedRect, blend)
+    finally:
+        shared_slab = getattr(task, 'shared_slab', None)
+        if shared_slab is not None:
+            shared_buffers.GetSlabPool().Release(shared_slab)
+            task.shared_slab = None
+
+
+def __CompositeTransformedTileTask(task, transformedImageData, fullImage, fullImageWeights, scaled_fixedRect=None, blend=ZBufferBlend):
     
     if transformedImageData is None:
             logger = logging.getLogger('TilesToImageParallel')
@@ -499,15 +910,15 @@ def __AddTransformedTileTaskToComposite(task, transformedImageData, fullImage, f
         logger.error('Convert task failed: ' + str(transformedImageData))
         if not transformedImageData.errormsg is None:
             logger.error(transformedImageData.errormsg)
-            return (fullImage, fullImageZBuffer)
+            return (fullImage, fullImageWeights)
 
     CompositeOffset = task.scaled_region_rendered.BottomLeft - scaled_fixedRect.BottomLeft 
     CompositeOffset = CompositeOffset.astype(np.int64)
     
     try:
-        CompositeImageWithZBuffer(fullImage, fullImageZBuffer,
-                                  transformedImageData.image, transformedImageData.centerDistanceImage,
-                                  CompositeOffset)
+        blend.Composite(fullImage, fullImageWeights,
+                        transformedImageData.image, transformedImageData.centerDistanceImage,
+                        CompositeOffset)
     except ValueError:
         # This is frustrating and usually indicates the input transform passed to assemble mapped to negative coordinates.
         logger = logging.getLogger('TilesToImageParallel')
@@ -519,17 +930,24 @@ def __AddTransformedTileTaskToComposite(task, transformedImageData, fullImage, f
     return 
 
 
-def TransformTile(transform, imagefullpath, distanceImage=None, target_space_scale=None, TargetRegion=None, SingleThreadedInvoke=False):
-    '''Transform the passed image.  DistanceImage is an existing image recording the distance to the center of the
-       image for each pixel.  target_space_scale is used when the image size does not match the image size encoded in the
+def TransformTile(transform, imagefullpath, distanceImage=None, target_space_scale=None, TargetRegion=None, SingleThreadedInvoke=False, shared_slab=None, use_coordinate_cache=False,
+                  blend_mode=None, coordinate_cache_bytes=None):
+    '''Transform the passed image.  The centerDistanceImage of the result holds the blend weight of each pixel, for the
+       default z-buffer the distance to the center of the source image.  target_space_scale is used when the image size does not match the image size encoded in the
        transform.  A scale will be calculated in this case and if it does not match the required scale the tile will 
        not be transformed.
        :param transform transform: Transformation used to map pixels from source image to output image
        :param str imagefullpath: Full path to the image on disk
-       :param ndarray distanceImage: Optional pre-allocated array to contain the distance of each pixel from the center for use as a depth mask
+       :param ndarray distanceImage: Unused, weights are computed from the source space coordinate of each pixel.  Retained for existing callers.
        :param float target_space_scale: Optional pre-calculated scalar to apply to the transforms target space control points.  If None the scale is calculated based on the difference
                                    between input image size and the image size of the transform. i.e.  If the source_space is downsampled by 4 then the target_space will be downsampled to match
-       :param array TargetRegion: [MinY MinX MaxY MaxX] If specified only the specified region is populated.  Otherwise transform the entire image.'''
+       :param array TargetRegion: [MinY MinX MaxY MaxX] If specified only the specified region is populated.  Otherwise transform the entire image.
+       :param SharedSlab shared_slab: Optional shared memory slab the result is written into when SingleThreadedInvoke is False
+       :param bool use_coordinate_cache: Reuse this process's coordinate map if the same transform was warped into the same region before
+       :param blend_mode: Blend mode the weights are computed for, see GetBlendMode
+       :param int coordinate_cache_bytes: Memory limit of this process's coordinate map cache, used if use_coordinate_cache is True.  Defaults to coordinate_map_cache.DefaultMaxCacheBytes.'''
+
+    blend = GetBlendMode(blend_mode)
 
     TargetRegionRect = None
     if not TargetRegion is None:
@@ -606,24 +1024,33 @@ def TransformTile(transform, imagefullpath, distanceImage=None, target_space_sca
     height = np.ceil(height)
     width = np.ceil(width)
 
-    distanceImage = __GetOrCreateDistanceImage(distanceImage, warpedImage.shape[0:2])
-
-    (fixedImage, centerDistanceImage) = assemble.WarpedImageToFixedSpace(transform,
-                                                                         (height, width),
-                                                                         [warpedImage, distanceImage],
-                                                                         botleft=(minY, minX),
-                                                                         area=(height, width),
-                                                                         cval=[0, __MaxZBufferValue(np.float16)])
+    # Weights are computed from the coordinates each pixel is sampled from, so only the tile itself is interpolated
+    source_shape = warpedImage.shape[0:2]
+    weight_function = lambda source_coords: blend.TileWeights(source_coords, source_shape)
+    
+    coordinate_cache = None
+    if use_coordinate_cache:
+        coordinate_cache = coordinate_map_cache.GetCoordinateMapCache(max_bytes=coordinate_cache_bytes)
+
+    (fixedImage, weightImage) = assemble.WarpedImageToFixedSpace(transform,
+                                                                 (height, width),
+                                                                 warpedImage,
+                                                                 botleft=(minY, minX),
+                                                                 area=(height, width),
+                                                                 cval=0,
+                                                                 coordinate_cache=coordinate_cache,
+                                                                 weight_function=weight_function,
+                                                                 weight_cval=blend.EmptyTileWeight())
 
     del warpedImage
-    del distanceImage
 
     return nornir_imageregistration.transformed_image_data.TransformedImageData.Create(fixedImage.astype(np.float16),
-                                       centerDistanceImage.astype(np.float16),
+                                       weightImage.astype(np.float16),
                                        transform,
                                        source_space_scale,
                                        target_space_scale,
-                                       SingleThreadedInvoke=SingleThreadedInvoke)
+                                       SingleThreadedInvoke=SingleThreadedInvoke,
+                                       shared_slab=shared_slab)
 
 if __name__ == '__main__':
     pass
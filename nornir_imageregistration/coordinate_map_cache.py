@@ -0,0 +1,283 @@
+'''
+Created on Oct 18, 2026
+
+A process-local cache of inverse coordinate maps.  A coordinate map records,
+for every pixel of a region in fixed space, the position in warped space the
+transform maps it from.  Warping the same tile into the same region again,
+for example when a mosaic is assembled more than once, reuses the map instead
+of passing every pixel through transform.InverseTransform.  A single assembly
+warps each tile into a region once, so the assembly functions only use the
+cache when asked to with use_coordinate_cache.
+
+Maps are keyed by a checksum of the transform, the region and whether points
+are extrapolated.  Transforms are scaled before warping at a different
+target_space_scale, so the scale is part of the transform checksum.
+
+Maps are stored as (Height, Width, 2) float32 arrays with NaN for pixels that
+do not map into warped space.  Optionally the transform is evaluated on a
+coarse grid and bilinearly upsampled when the result stays within a tolerance.
+'''
+
+import collections
+import threading
+
+import numpy as np
+import scipy.ndimage
+
+import nornir_imageregistration
+import nornir_imageregistration.transforms.utils as tutils
+
+#Default limit on the memory used by the process-local cache, in bytes
+DefaultMaxCacheBytes = 1 << 28
+
+#Default maximum error, in warped space pixels, allowed when upsampling a coarse map
+DefaultTolerance = 0.1
+
+#The cache for this process, created on first use by GetCoordinateMapCache
+__coordinate_map_cache = None
+
+
+def GetCoordinateMapCache(max_bytes=None):
+    '''
+    :param int max_bytes: If not None, the memory limit this process's cache should use from now on.  Least recently used maps are
+                          removed if the cache is over the new limit.
+    :return: The CoordinateMapCache for this process
+    :rtype: CoordinateMapCache
+    '''
+    global __coordinate_map_cache
+
+    if __coordinate_map_cache is None:
+        __coordinate_map_cache = CoordinateMapCache(max_bytes=max_bytes)
+    elif max_bytes is not None:
+        __coordinate_map_cache.max_bytes = max_bytes
+
+    return __coordinate_map_cache
+
+
+def _InverseTransformPoints(transform, points, extrapolate):
+    return transform.InverseTransform(points, extrapolate=extrapolate).astype(np.float32)
+
+
+def InverseCoordinateMap(transform, botleft, area, extrapolate=False, grid_spacing=None, tolerance=None):
+    '''
+    Return the warped space position of every pixel in a fixed space region.
+    :param transform transform: The transform used to map points between fixed and mapped space
+    :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
+    :param 1x2_array area: The (Height, Width) of the region of interest
+    :param bool extrapolate: If true map points that fall outside the bounding box of the transform
+    :param int grid_spacing: If not None the transform is evaluated every grid_spacing pixels and bilinearly upsampled
+    :param float tolerance: Maximum error allowed when upsampling, otherwise every pixel is evaluated.  Defaults to DefaultTolerance.
+    :return: (Height, Width, 2) float32 array of (Y,X) warped space coordinates, NaN where the pixel cannot be mapped
+    :rtype: ndarray
+    '''
+    shape = (int(area[0]), int(area[1]))
+
+    if getattr(transform, 'InverseCoordinateMap', None) is not None:
+        #The transform can produce the map directly, for example by rasterizing triangles
+        return transform.InverseCoordinateMap(botleft, shape, extrapolate=extrapolate)
+
+    if grid_spacing is not None and grid_spacing > 1 and shape[0] > grid_spacing and shape[1] > grid_spacing:
+        coord_map = _UpsampledInverseCoordinateMap(transform, botleft, shape, extrapolate, int(grid_spacing), tolerance)
+        if coord_map is not None:
+            return coord_map
+
+    coords = nornir_imageregistration.assemble.GetROICoords(botleft, shape)
+    return _InverseTransformPoints(transform, coords, extrapolate).reshape((shape[0], shape[1], 2))
+
+
+def _GridIndices(length, spacing):
+    '''Pixel indices of the coarse grid along an axis, always including the last pixel'''
+    indices = np.arange(0, length, spacing)
+    if indices[-1] != length - 1:
+        indices = np.append(indices, length - 1)
+
+    return indices
+
+
+def _UpsampledInverseCoordinateMap(transform, botleft, shape, extrapolate, grid_spacing, tolerance):
+    '''
+    Evaluate the transform on a coarse grid and upsample it.  Pixels interpolated from an unmappable grid point are evaluated directly.
+    :return: The coordinate map, or None if the upsampled map exceeds the tolerance
+    '''
+    if tolerance is None:
+        tolerance = DefaultTolerance
+
+    botleft = np.asarray(botleft, dtype=np.float32)
+
+    grid_y = _GridIndices(shape[0], grid_spacing)
+    grid_x = _GridIndices(shape[1], grid_spacing)
+    (g_y, g_x) = np.meshgrid(grid_y, grid_x, indexing='ij')
+    grid_points = np.vstack((g_y.flat, g_x.flat)).transpose().astype(np.float32) + botleft
+
+    grid_map = _InverseTransformPoints(transform, grid_points, extrapolate).reshape((len(grid_y), len(grid_x), 2))
+
+    # Fractional position of each pixel on the coarse grid
+    f_y = np.interp(np.arange(shape[0]), grid_y, np.arange(len(grid_y)))
+    f_x = np.interp(np.arange(shape[1]), grid_x, np.arange(len(grid_x)))
+    (i_y, i_x) = np.meshgrid(f_y, f_x, indexing='ij')
+
+    coord_map = np.empty((shape[0], shape[1], 2), dtype=np.float32)
+    for iAxis in range(2):
+        coord_map[:, :, iAxis] = scipy.ndimage.map_coordinates(grid_map[:, :, iAxis], (i_y, i_x), order=1, mode='nearest')
+
+    del i_y
+    del i_x
+
+    # Bilinear interpolation is least accurate at the center of each grid cell, check the error there
+    sample_y = (grid_y[:-1] + grid_y[1:]) // 2
+    sample_x = (grid_x[:-1] + grid_x[1:]) // 2
+    (s_y, s_x) = np.meshgrid(sample_y, sample_x, indexing='ij')
+    sample_points = np.vstack((s_y.flat, s_x.flat)).transpose()
+    expected = _InverseTransformPoints(transform, sample_points.astype(np.float32) + botleft, extrapolate)
+    interpolated = coord_map[sample_points[:, 0], sample_points[:, 1], :]
+
+    expected_invalid = np.isnan(expected).any(axis=1)
+    interpolated_invalid = np.isnan(interpolated).any(axis=1)
+    if np.any(expected_invalid & ~interpolated_invalid):
+        # A pixel inside the grid cannot be mapped even though the grid points around it can
+        return None
+
+    both_valid = ~(expected_invalid | interpolated_invalid)
+    if np.any(both_valid) and np.max(np.abs(expected[both_valid] - interpolated[both_valid])) > tolerance:
+        return None
+
+    # Pixels next to an unmappable grid point are NaN after interpolation, evaluate them directly
+    invalid = np.isnan(coord_map).any(axis=2)
+    if np.any(invalid):
+        invalid_pixels = np.argwhere(invalid)
+        coord_map[invalid] = _InverseTransformPoints(transform, invalid_pixels.astype(np.float32) + botleft, extrapolate)
+
+    return coord_map
+
+
+def CoordinateMapToROICoords(coord_map):
+    '''
+    Convert a coordinate map into the arrays returned by assemble.DestinationROI_to_SourceROI
+    :return: (Nx2 fixed space coordinates relative to the region origin, Nx2 warped space coordinates) for pixels that map into warped space
+    :rtype: tuple
+    '''
+    valid = ~np.isnan(coord_map).any(axis=2)
+    return (np.argwhere(valid).astype(np.float32), coord_map[valid])
+
+
+class CoordinateMapCache(object):
+    '''
+    Least recently used cache of inverse coordinate maps keyed by transform checksum, region and extrapolation.
+
+    :param int max_bytes: Maximum number of bytes of coordinate maps held in memory by this process
+    :param int grid_spacing: If not None maps are evaluated on a coarse grid with this spacing and upsampled.  See InverseCoordinateMap.
+    :param float tolerance: Maximum upsampling error in warped space pixels
+    '''
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    @property
+    def nbytes(self):
+        '''Bytes of coordinate maps currently held in memory'''
+        return self._nbytes
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, value):
+        with self._lock:
+            self._max_bytes = value
+            self._Trim()
+
+    def __init__(self, max_bytes=None, grid_spacing=None, tolerance=None):
+
+        if max_bytes is None:
+            max_bytes = DefaultMaxCacheBytes
+
+        self._max_bytes = max_bytes
+        self._grid_spacing = grid_spacing
+        self._tolerance = tolerance
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def __str__(self):
+        return "CoordinateMapCache {0} maps {1:.1f}MB hits: {2} misses: {3}".format(len(self._entries),
+                                                                                  self._nbytes / float(1 << 20),
+                                                                                  self._hits,
+                                                                                  self._misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _CreateKey(transform, botleft, area, extrapolate):
+        return (tutils.TransformChecksum(transform),
+                (float(botleft[0]), float(botleft[1])),
+                (int(area[0]), int(area[1])),
+                bool(extrapolate))
+
+    def _Add(self, key, coord_map):
+        '''Add the map to the cache and return the cached copy, which may have been added by another thread'''
+        existing = self._entries.get(key, None)
+        if existing is not None:
+            self._entries.move_to_end(key)
+            return existing
+
+        if coord_map.nbytes > self._max_bytes:
+            return coord_map
+
+        self._entries[key] = coord_map
+        self._nbytes += coord_map.nbytes
+
+        self._Trim()
+        return coord_map
+
+    def _Trim(self):
+        '''Remove least recently used maps until the cache is within max_bytes.  The caller must hold the lock.'''
+        while self._nbytes > self._max_bytes:
+            (_, evicted) = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+
+    def GetMap(self, transform, botleft, area, extrapolate=False):
+        '''
+        Return the inverse coordinate map for the region, calculating it only if it is not cached.  See InverseCoordinateMap.
+        :return: A read-only (Height, Width, 2) float32 array
+        :rtype: ndarray
+        '''
+        key = CoordinateMapCache._CreateKey(transform, botleft, area, extrapolate)
+
+        with self._lock:
+            coord_map = self._entries.get(key, None)
+            if coord_map is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return coord_map
+
+        #Maps are calculated outside the lock so threads warping different tiles do not wait on each other
+        coord_map = InverseCoordinateMap(transform, botleft, area, extrapolate=extrapolate,
+                                         grid_spacing=self._grid_spacing, tolerance=self._tolerance)
+        coord_map.setflags(write=False)
+
+        with self._lock:
+            self._misses += 1
+            return self._Add(key, coord_map)
+
+    def DestinationROI_to_SourceROI(self, transform, botleft, area, extrapolate=False):
+        '''
+        Cached equivalent of assemble.DestinationROI_to_SourceROI
+        :return: Tuple of arrays.  First array is fixed space coordinates relative to botleft.  Second array is warped space coordinates.
+        :rtype: tuple(Nx2 array,Nx2 array)
+        '''
+        return CoordinateMapToROICoords(self.GetMap(transform, botleft, area, extrapolate=extrapolate))
+
+    def Clear(self):
+        '''Remove all coordinate maps from memory'''
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
@@ -1228,13 +1228,15 @@ def FFTPhaseCorrelation(FFTFixed, FFTMoving, delete_input=False):
 
 
 # @profile
-def FindPeak(image, OverlapMask=None, Cutoff=None):
+def FindPeak(image, OverlapMask=None, Cutoff=None, SearchMask=None):
     '''
     Find the offset of the strongest response in a phase correlation image
     
     :param ndimage image: grayscale image
     :param float Cutoff: Percentile used to threshold image.  Values below the percentile are ignored
     :param ndimage OverlapMask: Mask describing which pixels are eligible
+    :param ndimage SearchMask: Optional mask restricting which pixels may contain the peak.  Unlike OverlapMask 
+                               it does not change the threshold, so weights remain comparable to unrestricted searches.
     :return: scaled_offset of peak from image center and sum of pixels values at peak
     :rtype: (tuple, float)
     '''
@@ -1259,14 +1261,21 @@ def FindPeak(image, OverlapMask=None, Cutoff=None):
         CutoffValue = np.percentile(image, q=Cutoff*100.0 )
 
     ThresholdImage[ThresholdImage < CutoffValue] = 0
+    
+    if SearchMask is not None:
+        SearchThresholdImage = np.where(SearchMask, ThresholdImage, 0)
+        # If nothing in the search window passed the threshold the search window is ignored
+        if np.any(SearchThresholdImage):
+            ThresholdImage = SearchThresholdImage
         
     #ThresholdImage = scipy.stats.threshold(image, threshmin=CutoffValue, threshmax=None, newval=0)
     # nornir_imageregistration.ShowGrayscale([image,ThresholdImage])
 
     [LabelImage, NumLabels] = scipy.ndimage.measurements.label(ThresholdImage)
-    LabelSums = scipy.ndimage.measurements.sum(ThresholdImage, LabelImage, list(range(0, NumLabels)))
+    # Label zero is the thresholded background, labels of peaks run from 1 to NumLabels
+    LabelSums = scipy.ndimage.measurements.sum(ThresholdImage, LabelImage, list(range(1, NumLabels + 1)))
     PeakValueIndex = LabelSums.argmax()
-    PeakCenterOfMass = scipy.ndimage.measurements.center_of_mass(ThresholdImage, LabelImage, PeakValueIndex)
+    PeakCenterOfMass = scipy.ndimage.measurements.center_of_mass(ThresholdImage, LabelImage, PeakValueIndex + 1)
     PeakStrength = LabelSums[PeakValueIndex]
 
     del LabelImage
@@ -1315,11 +1324,13 @@ def FindOffset(FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FFT_Requ
     if MovingImageShape is None:
         MovingImageShape = MovingImage.shape
     
-    CorrelationImage = None
     if FFT_Required:
-        CorrelationImage = ImagePhaseCorrelation(FixedImage, MovingImage)
-    else:
-        CorrelationImage = FFTPhaseCorrelation(FixedImage, MovingImage, delete_input=False)
+        # Reuse the process-local correlator for this shape so repeated calls do not reallocate FFT buffers
+        correlator = nornir_imageregistration.phase_correlation.GetPhaseCorrelator(FixedImage.shape)
+        return correlator.FindOffset(FixedImage, MovingImage, MinOverlap=MinOverlap, MaxOverlap=MaxOverlap,
+                                     FixedImageShape=FixedImageShape, MovingImageShape=MovingImageShape)
+    
+    CorrelationImage = FFTPhaseCorrelation(FixedImage, MovingImage, delete_input=False)
         
     CorrelationImage = fftpack.fftshift(CorrelationImage)
 
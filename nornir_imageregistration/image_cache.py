@@ -0,0 +1,316 @@
+'''
+Created on Oct 18, 2026
+
+A process-local cache of decoded images.  Images are kept in memory in least
+recently used order up to a size limit.  Images evicted from memory are spilled
+to .npy files, so later requests, from this process or other worker processes
+sharing the spill directory, memory-map the decoded pixels instead of decoding
+the image file again.  Callers that decode images for other processes to use,
+such as a precompute stage, can ask for the spill file to be written at once.
+Arrays derived from images, such as overlap crops and their spectra, share the
+same memory budget and spill directory.
+
+Cached arrays are read-only.  Copy them before modifying pixels.
+'''
+
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+import nornir_imageregistration
+
+#Default limit on the memory used by the process-local cache, in bytes
+DefaultMaxCacheBytes = 1 << 30
+
+#The cache for this process, created on first use by GetImageCache
+__image_cache = None
+
+
+def GetImageCache(spill_dir=None):
+    '''
+    :param str spill_dir: If not None, the spill directory this process's cache should use from now on.  Passed
+                          by callers that share a spill directory between the processes of one run.
+    :return: The ImageCache for this process
+    :rtype: ImageCache
+    '''
+    global __image_cache
+
+    if __image_cache is None:
+        __image_cache = ImageCache()
+
+    if spill_dir is not None:
+        __image_cache.spill_dir = spill_dir
+
+    return __image_cache
+
+
+def LoadImageCached(ImageFullPath, dtype=None, spill_dir=None, spill=False):
+    '''
+    Load an image through this process's ImageCache.  The returned array is read-only.
+    :param str spill_dir: Spill directory shared by the processes of this run, see GetImageCache
+    :param bool spill: Write the spill file now instead of when the image is evicted, so other processes can map it
+    '''
+    return GetImageCache(spill_dir).GetImage(ImageFullPath, dtype=dtype, spill=spill)
+
+
+def GetArrayCached(key, create_func, spill_dir=None, spill=False):
+    '''
+    Return an array derived from an image through this process's ImageCache.  See ImageCache.GetArray.
+    :param str spill_dir: Spill directory shared by the processes of this run, see GetImageCache
+    :param bool spill: Write the spill file now instead of when the array is evicted, so other processes can map it
+    '''
+    return GetImageCache(spill_dir).GetArray(key, create_func, spill=spill)
+
+
+def ImageKey(ImageFullPath, dtype=None):
+    ''':return: The cache key of the image, the prefix for keys of arrays derived from the image'''
+    return ImageCache._CreateKey(ImageFullPath, dtype)
+
+
+class ImageCache(object):
+    '''
+    Least recently used cache of decoded images keyed by path, modification time and dtype.  Arrays derived
+    from an image are cached under keys that extend the image's key.
+
+    :param int max_bytes: Maximum number of bytes of image data held in memory by this process
+    :param str spill_dir: Existing directory shared between processes for decoded .npy files.  None creates a private directory with
+                          tempfile.mkdtemp when the first image is spilled.  The private directory is removed by Close or
+                          when the cache is garbage collected.  Pass False to disable spill files.
+    '''
+
+    @property
+    def hits(self):
+        '''Number of requests returned from memory'''
+        return self._hits
+
+    @property
+    def spill_hits(self):
+        '''Number of requests returned by memory-mapping a spill file'''
+        return self._spill_hits
+
+    @property
+    def misses(self):
+        '''Number of requests that decoded the image file'''
+        return self._misses
+
+    @property
+    def nbytes(self):
+        '''Bytes of image data currently held in memory'''
+        return self._nbytes
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def spill_dir(self):
+        '''The spill directory, None if spill files are disabled or the private directory has not been created yet'''
+        return self._spill_dir
+
+    @spill_dir.setter
+    def spill_dir(self, value):
+        if value == self._spill_dir:
+            return
+
+        self._RemovePrivateSpillDir()
+        self._spill_dir = value if value else None
+        self._private_spill = value is None
+
+    def __init__(self, max_bytes=None, spill_dir=None):
+
+        if max_bytes is None:
+            max_bytes = DefaultMaxCacheBytes
+
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir if spill_dir else None
+        self._private_spill = spill_dir is None
+        self._private_spill_finalizer = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self._hits = 0
+        self._spill_hits = 0
+        self._misses = 0
+
+    def __str__(self):
+        return "ImageCache {0} images {1:.1f}MB hits: {2} spill hits: {3} misses: {4}".format(len(self._entries),
+                                                                                           self._nbytes / float(1 << 20),
+                                                                                           self._hits,
+                                                                                           self._spill_hits,
+                                                                                           self._misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _CreateKey(ImageFullPath, dtype):
+        fullpath = os.path.abspath(ImageFullPath)
+        mtime = os.stat(fullpath).st_mtime_ns
+        dtype_str = np.dtype(dtype).str if dtype is not None else 'native'
+        return (fullpath, mtime, dtype_str)
+
+    def _SpillPath(self, key, create=False):
+        '''
+        :param bool create: Create the private spill directory if it does not exist yet
+        :return: Path of the key's spill file, or None if spill files are disabled
+        '''
+        if self._spill_dir is None:
+            if not (create and self._private_spill):
+                return None
+
+            with self._lock:
+                if self._spill_dir is None:
+                    self._spill_dir = tempfile.mkdtemp(prefix='nornir_image_cache_')
+                    self._private_spill_finalizer = weakref.finalize(self, shutil.rmtree, self._spill_dir, True)
+
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._spill_dir, name + '.npy')
+
+    def _Add(self, key, image):
+        '''
+        Add the image to the cache.  The caller must hold the lock.
+        :return: (cached image, which may have been added by another thread, list of (key, image) evicted from memory)
+        '''
+        existing = self._entries.get(key, None)
+        if existing is not None:
+            self._entries.move_to_end(key)
+            return (existing, [])
+
+        if image.nbytes > self._max_bytes:
+            return (image, [(key, image)])
+
+        self._entries[key] = image
+        self._nbytes += image.nbytes
+
+        evicted = []
+        while self._nbytes > self._max_bytes:
+            (evicted_key, evicted_image) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_image.nbytes
+            evicted.append((evicted_key, evicted_image))
+
+        return (image, evicted)
+
+    def _Spill(self, key, image):
+        '''Write the image to its spill file unless it was already spilled'''
+        SpillPath = self._SpillPath(key, create=True)
+        if SpillPath is None or os.path.exists(SpillPath):
+            return
+
+        self._WriteSpillFile(SpillPath, image)
+
+    def _WriteSpillFile(self, SpillPath, image):
+        '''Write the spill file to a temporary name and rename it so readers never see a partial file'''
+        spill_dir = os.path.dirname(SpillPath)
+        if not os.path.isdir(spill_dir):
+            #The run that shared this directory has finished and removed it
+            return
+
+        try:
+            (handle, TempPath) = tempfile.mkstemp(suffix='.npy.tmp', dir=spill_dir)
+            with os.fdopen(handle, 'wb') as hFile:
+                np.save(hFile, image)
+
+            os.replace(TempPath, SpillPath)
+        except OSError as e:
+            logging.getLogger(__name__).warning("Unable to write image cache spill file {0}: {1}".format(SpillPath, str(e)))
+
+    def GetImage(self, ImageFullPath, dtype=None, spill=False):
+        '''
+        Return the decoded image, loading it only if it is not already in memory or in a spill file.
+        :param str ImageFullPath: Path to the image
+        :param dtype dtype: dtype passed to LoadImage
+        :param bool spill: Write the spill file now instead of when the image is evicted from memory
+        :return: A read-only image array
+        :rtype: ndarray
+        '''
+
+        key = ImageCache._CreateKey(ImageFullPath, dtype)
+        return self.GetArray(key, lambda: nornir_imageregistration.LoadImage(ImageFullPath, dtype=dtype), spill=spill)
+
+    def GetArray(self, key, create_func, spill=False):
+        '''
+        Return a cached array, calling create_func only if the array is not already in memory or in a spill file.
+        Used for arrays derived from an image, such as crops or spectra, which share the image memory budget.
+        :param tuple key: Key identifying the array.  Start it with ImageKey of the source image so the entry
+                          is not reused after the image file changes.
+        :param function create_func: Called without arguments to create the array on a miss
+        :param bool spill: Write the spill file now instead of when the array is evicted from memory
+        :return: A read-only array
+        :rtype: ndarray
+        '''
+
+        #Arrays are created outside the lock so threads loading different arrays do not wait on each other
+        with self._lock:
+            array = self._entries.get(key, None)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+
+        if array is not None:
+            if spill:
+                self._Spill(key, array)
+
+            return array
+
+        SpillPath = self._SpillPath(key)
+        if SpillPath is not None and os.path.exists(SpillPath):
+            try:
+                array = np.load(SpillPath, mmap_mode='r')
+                with self._lock:
+                    self._spill_hits += 1
+            except (OSError, ValueError):
+                array = None
+
+        if array is None:
+            array = create_func()
+            array.setflags(write=False)
+            with self._lock:
+                self._misses += 1
+
+            if spill:
+                self._Spill(key, array)
+
+        with self._lock:
+            (array, evicted) = self._Add(key, array)
+
+        #Spill files are written outside the lock so other threads are not blocked by the disk
+        for (evicted_key, evicted_array) in evicted:
+            self._Spill(evicted_key, evicted_array)
+
+        return array
+
+    def Clear(self):
+        '''Remove all images from memory.  Spill files are not removed.'''
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def Close(self):
+        '''Remove all images from memory and delete the private spill directory, if one was created'''
+        self.Clear()
+        self._RemovePrivateSpillDir()
+
+    def _RemovePrivateSpillDir(self):
+        if self._private_spill_finalizer is not None:
+            self._private_spill_finalizer()
+            self._private_spill_finalizer = None
+            self._spill_dir = None
+
+    def RemoveSpillFiles(self):
+        '''Delete all spill files in the spill directory'''
+        if self._spill_dir is None or not os.path.isdir(self._spill_dir):
+            return
+
+        for filename in os.listdir(self._spill_dir):
+            if filename.endswith('.npy') or filename.endswith('.npy.tmp'):
+                try:
+                    os.remove(os.path.join(self._spill_dir, filename))
+                except OSError:
+                    pass
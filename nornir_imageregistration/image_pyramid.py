@@ -0,0 +1,87 @@
+'''
+Created on Oct 18, 2026
+
+An image pyramid for coarse-to-fine searches.  Each level is half the size of
+the level below it.  Level 0 is the original image.
+
+scipy image arrays are indexed [y,x]
+'''
+
+import numpy as np
+
+import nornir_imageregistration
+
+
+def DownsampleByTwo(image):
+    '''
+    Returns an image with half the dimensions of the input.  Each output pixel is the mean of a 2x2 block
+    of input pixels.  A trailing odd row or column is dropped.
+    :param ndarray image: Input image
+    :rtype: ndarray
+    '''
+
+    Height = (image.shape[0] // 2) * 2
+    Width = (image.shape[1] // 2) * 2
+
+    if Height == 0 or Width == 0:
+        raise ValueError("Image of shape {0} is too small to downsample".format(str(image.shape)))
+
+    dtype = image.dtype
+    if not nornir_imageregistration.IsFloatArray(dtype):
+        dtype = np.float32
+
+    blocks = image[0:Height, 0:Width].reshape(Height // 2, 2, Width // 2, 2)
+    return blocks.mean(axis=(1, 3), dtype=np.float64).astype(dtype, copy=False)
+
+
+class ImagePyramid(object):
+    '''
+    A list of progressively downsampled copies of an image.  Level 0 is the
+    input image, each additional level is downsampled by a factor of two.
+
+    :param ndarray image: Image for level 0
+    :param int NumLevels: Number of levels to create.  If None levels are added until the largest dimension is no greater than MinDimension
+    :param int MinDimension: Do not create levels whose largest dimension is smaller than this value
+    '''
+
+    @property
+    def NumLevels(self):
+        return len(self._levels)
+
+    @property
+    def CoarsestLevel(self):
+        '''Index of the smallest level'''
+        return len(self._levels) - 1
+
+    def __init__(self, image, NumLevels=None, MinDimension=128):
+
+        if MinDimension is None:
+            MinDimension = 1
+
+        self._levels = [image]
+
+        while NumLevels is None or len(self._levels) < NumLevels:
+            previous = self._levels[-1]
+            if (max(previous.shape) // 2) < MinDimension:
+                break
+
+            self._levels.append(DownsampleByTwo(previous))
+
+    def __getitem__(self, level):
+        return self._levels[level]
+
+    def __len__(self):
+        return len(self._levels)
+
+    def __iter__(self):
+        return iter(self._levels)
+
+    @staticmethod
+    def Downsample(level):
+        '''The downsample factor of a level relative to level 0'''
+        return 1 << level
+
+    @staticmethod
+    def Scale(level):
+        '''The scale of a level relative to level 0'''
+        return 1.0 / (1 << level)
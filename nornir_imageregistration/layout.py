@@ -1,12 +1,17 @@
+import copy
+import itertools
 import logging
 import os
 
 import collections
+import collections.abc
 import nornir_imageregistration.tile
 
 import nornir_imageregistration.transforms.factory as tfactory
 import nornir_pools
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 from . import alignment_record
 from . import core
@@ -15,6 +20,9 @@ from operator import itemgetter
 
 ID_Value = collections.namedtuple('ID_Magnitude', ['ID', 'Value'])
 
+#Source of LayoutPosition.OffsetStamp values.  Stamps are never reused, so equal stamps mean the same node with the same offset rows.
+_offset_stamps = itertools.count()
+
 def _sort_array_on_column(a, iCol, ascending=False):
     '''Sort the numpy array on the specfied column'''
     
@@ -29,7 +37,7 @@ def CreatePairID(A,B=None):
     :return: A tuple where the lowest ID number is in the first position and IDs are cast to integers
     '''
     
-    if isinstance(A, collections.Iterable) and B is None:
+    if isinstance(A, collections.abc.Iterable) and B is None:
         B = A[1]
         A = A[0]
         
@@ -81,6 +89,11 @@ class LayoutPosition(object):
         '''Read-only use please'''
         return self._OffsetArray
     
+    @property
+    def OffsetStamp(self):
+        '''Changes whenever an offset is added or removed.  Used by Layout to reuse the structure of its LayoutEdges snapshot.'''
+        return self._offset_stamp
+    
     @property
     def IsIsolated(self):
         '''Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no offsets'''
@@ -132,7 +145,7 @@ class LayoutPosition(object):
             self._OffsetArray[iKnown] = new_row            
         else:
             # Insert a new row
-            
+            self._offset_stamp = next(_offset_stamps)
             self._OffsetArray = np.vstack((self._OffsetArray, new_row))
             if self._OffsetArray.ndim == 1:
                 self._OffsetArray = np.reshape(self._OffsetArray, (1, self._OffsetArray.shape[0]))
@@ -140,6 +153,13 @@ class LayoutPosition(object):
                 self._OffsetArray = _sort_array_on_column(self._OffsetArray, 0, ascending=True)
         return
     
+    def SetOffsetArray(self, offsets):
+        '''
+        Replace all offsets with an array of [[ID Y X Weight]] rows sorted by ID
+        '''
+        self._OffsetArray = np.array(offsets, dtype=np.float64).reshape((-1, 4))
+        self._offset_stamp = next(_offset_stamps)
+    
     def RemoveOffset(self, ID):
         '''
         Remove the offset to the other tile entirely
@@ -148,6 +168,7 @@ class LayoutPosition(object):
         iKnown = self.ConnectedIDs == ID
         if np.any(iKnown):
             self._OffsetArray = self._OffsetArray[iKnown == False,:]
+            self._offset_stamp = next(_offset_stamps)
         
         Warning('Removing non-existent offset: {0}->{1}'.format(self.ID, ID))
         return 
@@ -286,6 +307,7 @@ class LayoutPosition(object):
         self._ID = ID 
         self.Position =position
         self._OffsetArray = np.empty((0, 4), dtype=np.float64)  # dtype=LayoutPosition.offset_dtype)
+        self._offset_stamp = next(_offset_stamps)
         self._dims = dims
         
     def __eq__(self, other):
@@ -306,13 +328,179 @@ class LayoutPosition(object):
     def copy(self):
         ''':return: A copy of the object'''
         c = LayoutPosition(self._ID, 
-                              position=self.Position.copy())
+                              position=self.Position.copy(),
+                              dims=copy.deepcopy(self._dims))
         c._OffsetArray = self._OffsetArray.copy()
         return c
         
     def _str_(self):
-        return "%d y:%g x:%g" % (self._ID, self.Position[0], self.Position[1]) 
-        
+        return "%d y:%g x:%g" % (self._ID, self.Position[0], self.Position[1])
+
+
+class LayoutEdges(object):
+    '''
+    A compact, array based snapshot of a layout.  Node positions are an Nx2 array and every offset
+    stored on a node is one row of the edge arrays.  Edges are grouped by the node that stores them
+    in compressed sparse row order, so the edges of node i are rows indptr[i]:indptr[i+1].
+
+    Tension calculations over the whole layout are vectorized over these arrays instead of looping
+    over LayoutPosition objects.  Changes are copied back to the layout with WritePositions and WriteWeights.
+
+    IDs, indptr, source and target describe which nodes are linked and are read-only.  They can be shared
+    between snapshots of a layout whose offsets were not added or removed in between, see Layout.ToLayoutEdges.
+    '''
+
+    @property
+    def IDs(self):
+        '''Node IDs, in the order nodes appear in the layout's node dictionary'''
+        return self._IDs
+
+    @property
+    def positions(self):
+        '''Nx2 array of node positions'''
+        return self._positions
+
+    @positions.setter
+    def positions(self, value):
+        self._positions = value
+
+    @property
+    def indptr(self):
+        '''Edges of node i are rows indptr[i]:indptr[i+1]'''
+        return self._indptr
+
+    @property
+    def source(self):
+        '''Index of the node storing each edge'''
+        return self._source
+
+    @property
+    def target(self):
+        '''Index of the node each edge connects to'''
+        return self._target
+
+    @property
+    def offsets(self):
+        '''Ex2 array of expected target - source positions'''
+        return self._offsets
+
+    @property
+    def weights(self):
+        '''Weight of each edge'''
+        return self._weights
+
+    @weights.setter
+    def weights(self, value):
+        self._weights = value
+
+    @property
+    def num_nodes(self):
+        return len(self._IDs)
+
+    @property
+    def num_edges(self):
+        return self._target.shape[0]
+
+    @property
+    def structure(self):
+        '''(IDs, indptr, source, target), the read-only arrays describing which nodes are linked'''
+        return (self._IDs, self._indptr, self._source, self._target)
+
+    def __init__(self, layout_obj, structure=None):
+        '''
+        :param Layout layout_obj: Layout to copy positions and offsets from
+        :param tuple structure: The structure of an earlier snapshot of the same nodes, made when they had the same offset stamps
+        '''
+        nodes = list(layout_obj.nodes.values())
+
+        if len(nodes) > 0:
+            self._positions = np.vstack([node.Position for node in nodes])
+        else:
+            self._positions = np.empty((0, 2), dtype=np.float64)
+
+        if structure is not None:
+            (self._IDs, self._indptr, self._source, self._target) = structure
+        else:
+            self._IDs = np.array([node.ID for node in nodes], dtype=np.int64)
+            counts = np.array([node.OffsetArray.shape[0] for node in nodes], dtype=np.int64)
+            self._indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+            np.cumsum(counts, out=self._indptr[1:])
+            self._source = np.repeat(np.arange(len(nodes), dtype=np.int64), counts)
+
+        if self._indptr[-1] > 0:
+            edges = np.vstack([node.OffsetArray for node in nodes if not node.IsIsolated])
+        else:
+            edges = np.empty((0, 4), dtype=np.float64)
+
+        if structure is None:
+            ID_to_index = {node.ID: i for (i, node) in enumerate(nodes)}
+            self._target = np.array([ID_to_index[int(ID)] for ID in edges[:, LayoutPosition.iOffsetID]], dtype=np.int64)
+            for a in self.structure:
+                a.setflags(write=False)
+
+        self._offsets = edges[:, LayoutPosition.iOffsetY:LayoutPosition.iOffsetX + 1]
+        self._weights = edges[:, LayoutPosition.iOffsetWeight]
+
+    def _SumEdgesPerNode(self, values):
+        '''Sum per-edge values into per-node totals'''
+        output = np.zeros((self.num_nodes,) + values.shape[1:], dtype=np.float64)
+        np.add.at(output, self._source, values)
+        return output
+
+    def TensionVectors(self, positions=None):
+        '''
+        :return: Ex2 array, the difference between each edge's current and expected offset
+        '''
+        if positions is None:
+            positions = self._positions
+
+        return (positions[self._target, :] - positions[self._source, :]) - self._offsets
+
+    def NetTensionVectors(self, positions=None):
+        '''
+        :return: Nx2 array, the sum of the tension vectors of each node
+        '''
+        return self._SumEdgesPerNode(self.TensionVectors(positions))
+
+    def WeightedNetTensionVectors(self, positions=None):
+        '''
+        :return: Nx2 array, the direction each node wants to move.  Each node's edge weights are normalized to sum to one
+        '''
+        assert(np.all(self._weights >= 0))
+        assert(np.all(self._weights <= 1.0))
+
+        total_weights = self._SumEdgesPerNode(self._weights)
+        edge_totals = total_weights[self._source]
+        normalized_weights = np.divide(self._weights, edge_totals, out=self._weights.copy(), where=edge_totals != 0)
+
+        return self._SumEdgesPerNode(self.TensionVectors(positions) * normalized_weights[:, np.newaxis])
+
+    def SortedIDVectors(self, vectors):
+        '''
+        :param ndarray vectors: Nx2 per-node array
+        :return: Nx3 array of [ID, Y, X] rows sorted by ID
+        '''
+        iSorted = np.argsort(self._IDs, kind='stable')
+        return np.hstack((self._IDs[iSorted, np.newaxis].astype(np.float64), vectors[iSorted, :]))
+
+    def UniqueEdges(self):
+        ''':return: Boolean mask of edges where the source ID is lower than the target ID.  Each linked pair is selected once'''
+        return self._IDs[self._source] < self._IDs[self._target]
+
+    def WritePositions(self, layout_obj):
+        '''Copy positions back into the layout's nodes'''
+        for (i, ID) in enumerate(self._IDs):
+            layout_obj.nodes[ID].Position = self._positions[i, :]
+
+    def WriteWeights(self, layout_obj):
+        '''Copy edge weights back into the layout's nodes'''
+        for (i, ID) in enumerate(self._IDs):
+            node = layout_obj.nodes[ID]
+            if node.IsIsolated:
+                continue
+
+            node.OffsetArray[:, LayoutPosition.iOffsetWeight] = self._weights[self._indptr[i]:self._indptr[i + 1]]
+
 
 class Layout(object):
     ''' Records the optimal offset from each tile in a mosaic tile to overlapping tiles. 
@@ -508,31 +696,31 @@ class Layout(object):
                                          
         return nodes
     
+    def ToLayoutEdges(self):
+        '''
+        :return: A LayoutEdges array snapshot of the layout's positions and offsets.  Positions, offsets and weights are copied
+                 on every call.  Which nodes are linked is only recalculated after an offset or node is added or removed.
+        :rtype: LayoutEdges
+        '''
+        stamps = tuple(node.OffsetStamp for node in self._nodes.values())
+        if self._edges_structure is not None and self._edges_structure[0] == stamps:
+            return LayoutEdges(self, structure=self._edges_structure[1])
+        
+        edges = LayoutEdges(self)
+        self._edges_structure = (stamps, edges.structure)
+        return edges
+    
     def GetOffsetWeightExtrema(self):
         '''
         :return: A tuple with the (min,max) weight values of offsets in the layout
         '''
         
-        maxWeight = np.NaN
-        minWeight = np.NaN
-        
-        first = True
-        for node in self._nodes.values():
-            # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
-            if node.IsIsolated:
-                continue
-            
-            weights = node.OffsetArray[:, LayoutPosition.iOffsetWeight]
-            
-            if first:
-                first = False
-                minWeight = np.min(weights)
-                maxWeight = np.max(weights)
-            else:
-                minWeight = min((minWeight, np.min(weights)))
-                maxWeight = max((maxWeight, np.max(weights)))
+        # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
+        weights = self.ToLayoutEdges().weights
+        if weights.shape[0] == 0:
+            return (np.NaN, np.NaN)
                 
-        return (minWeight, maxWeight)
+        return (np.min(weights), np.max(weights))
     
     def NetTensionVector(self, ID):
         '''Return the net tension vector of the specified ID'''
@@ -543,15 +731,9 @@ class Layout(object):
         return node.NetTensionVector(linked_nodes)
     
     def NetTensionVectors(self):
-        '''Return all net tension vectors for our nodes'''
-        IDs = list(self.nodes.keys())
-        IDs.sort()
-        output = np.zeros((len(IDs), 3))
-        for (i, ID) in enumerate(IDs):
-            output[i, 0] = ID
-            output[i, 1:] = self.NetTensionVector(ID)
-            
-        return output
+        '''Return all net tension vectors for our nodes as [ID Y X] rows sorted by ID'''
+        edges = self.ToLayoutEdges()
+        return edges.SortedIDVectors(edges.NetTensionVectors())
     
     def PairTensionVector(self, A, B):
         '''Return the tension vector between A and B
@@ -586,15 +768,9 @@ class Layout(object):
         return node.WeightedNetTensionVector(linked_node_positions)
         
     def WeightedNetTensionVectors(self):
-        '''Return all net tension vectors for our nodes'''
-        IDs = list(self.nodes.keys())
-        IDs.sort()
-        output = np.zeros((len(IDs), 3))
-        for i, TileID in enumerate(IDs):
-            output[i, 0] = TileID
-            output[i, 1:] = self.WeightedNetTensionVector(TileID)
-            
-        return output
+        '''Return all weighted net tension vectors for our nodes as [ID Y X] rows sorted by ID'''
+        edges = self.ToLayoutEdges()
+        return edges.SortedIDVectors(edges.WeightedNetTensionVectors())
     
     @property
     def MaxTensionVectors(self):
@@ -663,9 +839,11 @@ class Layout(object):
         self.ID = Layout.NextLayoutID
         Layout.NextLayoutID = Layout.NextLayoutID + 1
         self._nodes = {}
+        self._edges_structure = None  # (offset stamps of the nodes, LayoutEdges.structure) of the last snapshot
         return
         
     def copy(self):
+        ''':return: A copy of the layout.  Nodes are copied, so changes to the copy do not affect this layout.'''
         c = Layout()
         c._nodes = {n.ID: n.copy() for n in self._nodes.values()}
         return c
@@ -691,29 +869,24 @@ class Layout(object):
         
         # TODO: Get rid of vector scalar.  Instead calculate the net tension vector at the new position.  Then add them and apply the merged vector. 
         
-        node_movement = np.zeros((len(layout_obj.nodes), 3))
+        edges = layout_obj.ToLayoutEdges()
+        vectors = Layout._RelaxEdges(edges, vector_scalar)
+        edges.WritePositions(layout_obj)
         
+        return np.hstack((edges.IDs[:, np.newaxis].astype(np.float64), vectors))
+    
+    @classmethod
+    def _RelaxEdges(cls, edges, vector_scalar=None):
+        '''
+        Move each position in a LayoutEdges object along its weighted net tension vector
+        :return: Nx2 array of node movement
+        '''
         if vector_scalar is None:
             vector_scalar = 0.95
-        
-        # vectors = {}
-        
-        i = 0
-        nodes = layout_obj.nodes.values()
-        
-        for (i, node) in enumerate(nodes):
-            vector = layout_obj.WeightedNetTensionVector(node.ID) * vector_scalar
-            # vectors[ID] = vector
-            row = np.array([node.ID, vector[0], vector[1]])
-            node_movement[i, :] = row
-            i += 1
             
-        #OK, move all of the nodes according to the net movement
-        for (i,node) in enumerate(nodes): 
-            # Skip the first node, the others can move around it
-            node.Position = node.Position + (node_movement[i,1:])
-        
-        return node_movement
+        vectors = edges.WeightedNetTensionVectors() * vector_scalar
+        edges.positions = edges.positions + vectors
+        return vectors
     
     @classmethod
     def MergeLayouts(cls, layoutA, layoutB, offset):
@@ -817,19 +990,15 @@ def OffsetsSortedByWeight(layout):
     Return all of a layouts offsets sorted by weight.  
     :return: An array [[TileA_ID, TileB_ID, OffsetY, OffsetX, Weight]] To prevent duplicates we only report offsets where TileA_ID < TileB_ID
     ''' 
-    ret_array = np.empty((0, 5))
-    for node in layout.nodes.values():
-        if node.IsIsolated:
-            continue
-        
-        # Prevent duplicates by skipping IDs less than the nodes
-        iNewRows = node.OffsetArray[:, 0] > node.ID 
-        if not np.any(iNewRows):
-            continue 
-        
-        new_column = np.ones((np.sum(iNewRows), 1)) * node.ID
-        new_rows = np.hstack((new_column, node.OffsetArray[iNewRows, :]))
-        ret_array = np.vstack((ret_array, new_rows))
+    edges = layout.ToLayoutEdges()
+    
+    # Prevent duplicates by skipping IDs less than the nodes
+    iNewRows = edges.UniqueEdges()
+    
+    ret_array = np.hstack((edges.IDs[edges.source[iNewRows], np.newaxis].astype(np.float64),
+                           edges.IDs[edges.target[iNewRows], np.newaxis].astype(np.float64),
+                           edges.offsets[iNewRows, :],
+                           edges.weights[iNewRows, np.newaxis]))
         
     return _sort_array_on_column(ret_array, 4)  
 
@@ -848,27 +1017,22 @@ def NormalizeOffsetWeights(original_layout):
     Proportionally scale offset weights so the highest weight is 1.0
     '''
     
-    (minWeight, maxWeight) = original_layout.GetOffsetWeightExtrema()
+    edges = original_layout.ToLayoutEdges()
+    if edges.num_edges == 0:
+        return
+    
+    minWeight = np.min(edges.weights)
+    maxWeight = np.max(edges.weights)
     
     # All the weights are equal... odd
     if maxWeight == minWeight:
-        for node in original_layout.nodes.values():
-            if node.IsIsolated:
-                continue
-            
-            node.OffsetArray[:, LayoutPosition.iOffsetWeight] = 1.0
-    
-        return
-    
-    for node in original_layout.nodes.values():
-        # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
-        if node.IsIsolated:
-            continue
+        edges.weights = np.ones(edges.num_edges)
+    else:
+        edges.weights = edges.weights / maxWeight
+        assert(np.alltrue(edges.weights >= 0))
+        assert(np.alltrue(edges.weights <= 1.0))
         
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] = node.OffsetArray[:, LayoutPosition.iOffsetWeight] / maxWeight
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] >= 0))
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] <= 1.0))
-                
+    edges.WriteWeights(original_layout)
     return 
 
 
@@ -880,35 +1044,42 @@ def ScaleOffsetWeightsByPopulationRank(original_layout, min_allowed_weight=0, ma
     if min_allowed_weight >= max_allowed_weight:
         raise ValueError("Min allowed weight must be below the max allowed weight")
     
-    (minWeight, maxWeight) = original_layout.GetOffsetWeightExtrema()
+    edges = original_layout.ToLayoutEdges()
+    if edges.num_edges == 0:
+        return
+    
+    minWeight = np.min(edges.weights)
+    maxWeight = np.max(edges.weights)
     
     # All the weights are equal... odd
     if maxWeight == minWeight:
-        for node in original_layout.nodes.values():
-            if node.IsIsolated:
-                continue
-            
-            node.OffsetArray[:, LayoutPosition.iOffsetWeight] = max_allowed_weight
+        edges.weights = np.full(edges.num_edges, max_allowed_weight, dtype=np.float64)
+        edges.WriteWeights(original_layout)
         return
     
     maxWeight -= minWeight
     
     allowed_weight_range = max_allowed_weight - min_allowed_weight
     
-    for node in original_layout.nodes.values():
-        # Sometimes we have tiles which end up isolated, usually due to prune.  When this occurs they have no scores
-        if node.IsIsolated:
-            continue
-        
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] = (node.OffsetArray[:, LayoutPosition.iOffsetWeight] - minWeight) / maxWeight
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] *= allowed_weight_range
-        node.OffsetArray[:, LayoutPosition.iOffsetWeight] += min_allowed_weight
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] >= min_allowed_weight))
-        assert(np.alltrue(node.OffsetArray[:, LayoutPosition.iOffsetWeight] <= max_allowed_weight))
-                
+    weights = (edges.weights - minWeight) / maxWeight
+    weights *= allowed_weight_range
+    weights += min_allowed_weight
+    assert(np.alltrue(weights >= min_allowed_weight))
+    assert(np.alltrue(weights <= max_allowed_weight))
+    
+    edges.weights = weights
+    edges.WriteWeights(original_layout)
     return 
 
     
+def _MaxMagnitude(vectors):
+    '''The largest magnitude in an Nx2 array of vectors, 0 if the array is empty'''
+    if vectors.shape[0] == 0:
+        return 0
+    
+    return np.max(core.array_distance(vectors))
+
+    
 def RelaxLayout(layout_obj, max_tension_cutoff=None, max_iter=None, vector_scale=None, 
                 plotting_output_path=None, plotting_interval=None):
     ''' 
@@ -917,7 +1088,8 @@ def RelaxLayout(layout_obj, max_tension_cutoff=None, max_iter=None, vector_scale
     :param int max_iter: Maximum number of iterations
     '''
      
-    max_tension = layout_obj.MaxWeightedNetTensionMagnitude[1]
+    edges = layout_obj.ToLayoutEdges()
+    max_tension = _MaxMagnitude(edges.WeightedNetTensionVectors())
     
     if max_tension_cutoff is None:
         max_tension_cutoff = 0.1
@@ -944,12 +1116,13 @@ def RelaxLayout(layout_obj, max_tension_cutoff=None, max_iter=None, vector_scale
     
     while max_tension > max_tension_cutoff and i < max_iter:
         print("\t%d %g" % (i, max_tension))
-        Layout.RelaxNodes(layout_obj, vector_scalar=vector_scale)
-        max_tension = layout_obj.MaxWeightedNetTensionMagnitude[1]
+        Layout._RelaxEdges(edges, vector_scalar=vector_scale)
+        max_tension = _MaxMagnitude(edges.WeightedNetTensionVectors())
         
         plotting_max_tension = max(min_plotting_tension, max_tension)
         
         if plotting_output_path is not None and (i % plotting_interval == 0 or i < 10):
+            edges.WritePositions(layout_obj)
             filename = os.path.join(plotting_output_path, "%d.svg" % i)
 #             nornir_imageregistration.views.plot_layout( 
 #                            layout_obj=layout_obj.copy(),
@@ -967,77 +1140,251 @@ def RelaxLayout(layout_obj, max_tension_cutoff=None, max_iter=None, vector_scale
         
         # nornir_shared.plot.VectorField(layout_obj.GetPositions(), layout_obj.NetTensionVectors(), OutputFilename=filename)
         # pool.add_task("Plot step #%d" % (i), nornir_shared.plot.VectorField,layout_obj.GetPositions(), layout_obj.WeightedNetTensionVectors(), OutputFilename=filename)
-        
+
+    edges.WritePositions(layout_obj)
     return layout_obj
-        
+
+
+def _SolveWeightedLayoutPositions(num_nodes, iA, iB, offsets, weights, initial_positions, epsilon):
+    '''
+    Solve the weighted least-squares problem min sum(w * |(pB - pA) - offset|^2) for all node positions.
+    The weighted graph Laplacian is singular because moving every node by the same amount does not
+    change the result.  A small penalty on moving away from the initial positions, scaled by epsilon,
+    anchors each connected group of nodes near its current location.
+    '''
+
+    edge_weights = np.hstack((weights, weights, -weights, -weights))
+    rows = np.hstack((iA, iB, iA, iB))
+    cols = np.hstack((iA, iB, iB, iA))
+
+    laplacian = scipy.sparse.coo_matrix((edge_weights, (rows, cols)), shape=(num_nodes, num_nodes)).tocsc()
+
+    weighted_offsets = offsets * weights[:, np.newaxis]
+    rhs = np.zeros((num_nodes, 2), dtype=np.float64)
+    np.add.at(rhs, iB, weighted_offsets)
+    np.subtract.at(rhs, iA, weighted_offsets)
+
+    anchor = epsilon * np.max(weights, initial=0)
+    if anchor <= 0:
+        anchor = epsilon
+    system = laplacian + scipy.sparse.identity(num_nodes, format='csc') * anchor
+    rhs += initial_positions * anchor
+
+    solver = scipy.sparse.linalg.splu(system)
+    return solver.solve(rhs)
+
+
+def SolveLayout(layout_obj, robust_iterations=None, robust_scale=None, min_robust_scale=1.0, epsilon=None):
+    '''
+    Position all nodes at once by solving the weighted least-squares system built from every offset
+    in the layout.  This is the position RelaxLayout converges towards, found with a single sparse
+    factorization instead of iterating over nodes.
+    :param layout_obj: Layout to refine
+    :param int robust_iterations: Number of iteratively reweighted passes.  Each pass scales offset weights down
+                                  by the offset's residual so outlier offsets have less influence.  Defaults to 0.
+    :param float robust_scale: Residual distance at which an offset's weight is halved.  Defaults to 1.4826 times the median residual of each pass,
+                               but no less than min_robust_scale.
+    :param float min_robust_scale: Lower limit of the default robust_scale, in pixels.  Prevents offsets from being discarded for sub-pixel disagreements once outliers are removed.
+    :param float epsilon: Strength of the penalty anchoring the layout to its current position, relative to the largest weight.
+    :return: The layout_obj with updated node positions
+    '''
+
+    if robust_iterations is None:
+        robust_iterations = 0
+
+    if epsilon is None:
+        epsilon = 1e-9
+
+    edges = layout_obj.ToLayoutEdges()
+
+    # Each pair is stored on both nodes, only take one copy
+    iUnique = edges.UniqueEdges()
+    if not np.any(iUnique):
+        return layout_obj
+
+    iA = edges.source[iUnique]
+    iB = edges.target[iUnique]
+    offsets = edges.offsets[iUnique, :]
+    weights = edges.weights[iUnique]
+
+    initial_positions = edges.positions
+    positions = initial_positions
+    solve_weights = weights
+
+    for iPass in range(0, robust_iterations + 1):
+        positions = _SolveWeightedLayoutPositions(edges.num_nodes, iA, iB, offsets, solve_weights, initial_positions, epsilon)
+
+        if iPass == robust_iterations:
+            break
+
+        residuals = core.array_distance((positions[iB, :] - positions[iA, :]) - offsets)
+        scale = robust_scale
+        if scale is None:
+            scale = max(1.4826 * np.median(residuals), min_robust_scale)
+
+        if scale <= 0:
+            break
+
+        # Cauchy weighting, an offset whose residual equals the scale keeps half of its weight
+        solve_weights = weights / (1.0 + (residuals / scale) ** 2)
+
+    edges.positions = positions
+    edges.WritePositions(layout_obj)
+
+    return layout_obj
+
+
+class _PlacementForest(object):
+    '''
+    Union-find over node indices used to place nodes as offsets are accepted.  Each set is one layout.
+    The root of a set stores its absolute position, every other node stores its position relative to
+    its parent, so translating an entire set when it is merged only updates the root.
+    Members of each set are kept as a linked list in the order they were placed.
+    '''
+
+    def __init__(self, num_nodes):
+        self.parent = np.arange(num_nodes, dtype=np.int64)
+        self.delta = np.zeros((num_nodes, 2), dtype=np.float64)
+        self.size = np.ones(num_nodes, dtype=np.int64)
+        self.placed = np.zeros(num_nodes, dtype=bool)
+        self.order = np.zeros(num_nodes, dtype=np.int64)
+        self.head = np.arange(num_nodes, dtype=np.int64)
+        self.tail = np.arange(num_nodes, dtype=np.int64)
+        self.next = np.full(num_nodes, -1, dtype=np.int64)
+        self._num_sets = 0
+
+    def Find(self, i):
+        ''':return: The root of i's set.  Compresses the path so every node visited points directly to the root'''
+        path = []
+        while self.parent[i] != i:
+            path.append(i)
+            i = self.parent[i]
+
+        root = i
+        # Walk back from the node nearest the root, accumulating positions relative to the root
+        relative = np.zeros(2)
+        for node in reversed(path):
+            relative = relative + self.delta[node]
+            self.delta[node] = relative
+            self.parent[node] = root
+
+        return root
+
+    def Position(self, i):
+        root = self.Find(i)
+        if root == i:
+            return self.delta[i].copy()
+
+        return self.delta[root] + self.delta[i]
+
+    def CreateSet(self, i, position):
+        self.placed[i] = True
+        self.delta[i] = position
+        self.order[i] = self._num_sets
+        self._num_sets += 1
+
+    def AddToSet(self, existing, i, offset):
+        '''Place i at the position of existing plus offset, in the same set'''
+        root = self.Find(existing)
+        self.placed[i] = True
+        self.parent[i] = root
+        self.delta[i] = (self.Position(existing) + offset) - self.delta[root]
+        self.size[root] += 1
+        self.next[self.tail[root]] = i
+        self.tail[root] = i
+
+    def Merge(self, A, B, offset):
+        '''
+        Translate B's set so B is at A's position plus offset, then merge it into A's set.
+        The merged set keeps A's creation order and lists A's members before B's.
+        '''
+        rootA = self.Find(A)
+        rootB = self.Find(B)
+
+        translation = (self.Position(A) + offset) - self.Position(B)
+        self.delta[rootB] = self.delta[rootB] + translation
+
+        (head, tail, order) = (self.head[rootA], self.tail[rootB], self.order[rootA])
+        self.next[self.tail[rootA]] = self.head[rootB]
+
+        # Attach the smaller set to the larger
+        (parent, child) = (rootA, rootB) if self.size[rootA] >= self.size[rootB] else (rootB, rootA)
+        self.delta[child] = self.delta[child] - self.delta[parent]
+        self.parent[child] = parent
+        self.size[parent] += self.size[child]
+        (self.head[parent], self.tail[parent], self.order[parent]) = (head, tail, order)
+
+    def Members(self, root):
+        i = self.head[root]
+        while i >= 0:
+            yield i
+            i = self.next[i]
+
 
 def BuildLayoutWithHighestWeightsFirst(original_layout):
     '''
-    Constructs a mosaic by sorting all of the match results according to strength. 
+    Constructs a mosaic by sorting all of the match results according to strength.  This is a maximum
+    spanning forest, each offset is accepted in order of weight and places any node not already positioned
+    by a stronger offset.  Every offset with a valid weight is included in the layout of its nodes.
     
-    :param dict tiles: Dictionary of tile objects containing alignment records to other tiles
+    :param Layout original_layout: Layout containing offsets between nodes
+    :return: List of layouts, one for each connected set of nodes
     '''
 
-    placedTiles = dict()
-    
-    sorted_offsets = OffsetsSortedByWeight(original_layout) 
+    sorted_offsets = OffsetsSortedByWeight(original_layout)
+    sorted_offsets = sorted_offsets[np.isfinite(sorted_offsets[:, 4]), :]
+
+    if sorted_offsets.shape[0] == 0:
+        return []
+
+    (IDs, pair_indicies) = np.unique(sorted_offsets[:, 0:2].astype(np.int64), return_inverse=True)
+    pair_indicies = pair_indicies.reshape((sorted_offsets.shape[0], 2))
+
+    forest = _PlacementForest(len(IDs))
 
-    LayoutList = [] 
     for iRow in range(0, sorted_offsets.shape[0]):
-        row = sorted_offsets[iRow, :]      
-        A_ID = int(row[0])
-        B_ID = int(row[1])
-        YOffset = row[2]
-        XOffset = row[3]
-        Weight = row[4]
-        offset = row[2:4]
-        
-        print("%d -> %d (%g,%g w: %g)" % (A_ID, B_ID, YOffset, XOffset, Weight))
-
-        if np.isnan(Weight):
-            print("Skip: Invalid weight, not a number")
-            continue
+        (iA, iB) = pair_indicies[iRow, :]
+        offset = sorted_offsets[iRow, 2:4]
 
-        ALayout = GetLayoutForID(LayoutList, A_ID)
-        BLayout = GetLayoutForID(LayoutList, B_ID)
-
-        if ALayout is None and BLayout is None:
-            new_layout = Layout()
-            A_pos = original_layout.GetPosition(A_ID)
-            new_layout.CreateNode(A_ID, A_pos)
-            new_layout.CreateNode(B_ID, A_pos + offset)
-            new_layout.SetOffset(A_ID, B_ID, offset, Weight) 
-            LayoutList.append(new_layout)
-            print("New layout")
-
-        elif (not ALayout is None) and (not BLayout is None):
-            # Need to merge the layouts? See if they are the same
-            if ALayout == BLayout:
-                # Already mapped
-                if B_ID in ALayout.nodes[A_ID].ConnectedIDs: 
-                    print("Skip: Already mapped")
-                else:
-                    ALayout.SetOffset(A_ID, B_ID, offset, Weight)
-            else:
-                MergeLayoutsWithNodeOffset(ALayout, BLayout, A_ID, B_ID, offset, Weight)
-                print("Merged")
-                LayoutList.remove(BLayout)
+        if not forest.placed[iA] and not forest.placed[iB]:
+            forest.CreateSet(iA, original_layout.GetPosition(int(IDs[iA])))
+            forest.AddToSet(iA, iB, offset)
+        elif forest.placed[iA] and forest.placed[iB]:
+            if forest.Find(iA) != forest.Find(iB):
+                forest.Merge(iA, iB, offset)
+        elif forest.placed[iB]:
+            forest.AddToSet(iB, iA, -offset)
         else:
-            
-            if ALayout is None and not BLayout is  None:
-                BLayout.CreateOffsetNode(B_ID, A_ID, -offset, Weight)
-                # We'll pick it up on the next pass
-                # print("Skip: Getting it next time")
-                # continue
-                
-            else:
-                ALayout.CreateOffsetNode(A_ID, B_ID, offset, Weight)
+            forest.AddToSet(iA, iB, offset)
 
-    # OK, we should have a single list of layouts
-    #LargestLayout = LayoutList[0]
+    # Each node stores every offset to its neighbors, sorted by the neighbor's ID
+    source = np.hstack((pair_indicies[:, 0], pair_indicies[:, 1]))
+    target = np.hstack((pair_indicies[:, 1], pair_indicies[:, 0]))
+    offsets = np.vstack((sorted_offsets[:, 2:4], -sorted_offsets[:, 2:4]))
+    weights = np.hstack((sorted_offsets[:, 4], sorted_offsets[:, 4]))
+
+    iSorted = np.lexsort((IDs[target], source))
+    offset_rows = np.hstack((IDs[target[iSorted], np.newaxis].astype(np.float64), offsets[iSorted, :], weights[iSorted, np.newaxis]))
+    row_starts = np.searchsorted(source[iSorted], np.arange(len(IDs) + 1))
+
+    roots = [i for i in range(len(IDs)) if forest.Find(i) == i]
+    roots.sort(key=lambda root: forest.order[root])
+
+    LayoutList = []
+    for root in roots:
+        new_layout = Layout()
+        for i in forest.Members(root):
+            ID = int(IDs[i])
+            new_layout.CreateNode(ID, forest.Position(i))
+            new_layout.nodes[ID].SetOffsetArray(offset_rows[row_starts[i]:row_starts[i + 1], :])
+
+        LayoutList.append(new_layout)
+
+    print("Built %d layouts from %d offsets" % (len(LayoutList), sorted_offsets.shape[0]))
 
     return LayoutList
 
+
 def MergeDisconnectedLayouts(layout_list):
     '''Given a list of layouts, generate a single layout with all nodes in the same positions'''
     if len(layout_list) == 1:
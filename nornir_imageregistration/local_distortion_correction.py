@@ -8,6 +8,7 @@ This module performs local distortions of images to refine alignments of mosaics
 
 import nornir_pools
 import nornir_imageregistration
+import nornir_imageregistration.shared_buffers as shared_buffers
 import nornir_imageregistration.views.grid_data
 
 from nornir_imageregistration.transforms.triangulation import Triangulation
@@ -15,6 +16,10 @@ from nornir_imageregistration.transforms.triangulation import Triangulation
 
 import numpy as np
 import os
+import scipy.ndimage
+
+#Number of grid cells each worker task aligns together with AlignCellStacks
+AlignmentCellsPerTask = 16
 
 
 class DistortionCorrection:
@@ -221,6 +226,7 @@ def RefineStosFile(InputStos, OutputStosPath,
                    angles_to_search=None,
                    min_travel_for_finalization=None,
                    min_alignment_overlap=None,
+                   min_cell_movement=None,
                    SaveImages=False,
                    SavePlots=False):
     '''
@@ -236,6 +242,7 @@ def RefineStosFile(InputStos, OutputStosPath,
     :param tuple grid_spacing: (width, height) of separation between control points on the grid
     :param array angles_to_search: An array of floats or None.  Images are rotated by the degrees indicated in the array.  The single best alignment across all angles is selected.
     :param float min_alighment_overlap: Limits how far control points can be translated.  The cells from fixed and target space must overlap by this minimum amount.
+    :param float min_cell_movement: Cells that moved less than this many pixels since the previous iteration reuse their previous alignment
     :param bool SaveImages: Saves registered images of each iteration in the output path for debugging purposes
     :param bool SavePlots: Saves histograms and vector plots of each iteration in the output path for debugging purposes        
     '''
@@ -272,6 +279,7 @@ def RefineStosFile(InputStos, OutputStosPath,
                                         angles_to_search=angles_to_search,
                                         min_travel_for_finalization=min_travel_for_finalization,
                                         min_alignment_overlap=min_alignment_overlap,
+                                        min_cell_movement=min_cell_movement,
                                         SaveImages=SaveImages,
                                         SavePlots=SavePlots,
                                         outputDir=outputDir)
@@ -294,6 +302,7 @@ def RefineTransform(stosTransform,
                     angles_to_search=None,
                     min_travel_for_finalization=None,
                     min_alignment_overlap=None,
+                    min_cell_movement=None,
                     SaveImages=False,
                     SavePlots=False,
                     outputDir=None):
@@ -312,6 +321,7 @@ def RefineTransform(stosTransform,
     :param tuple grid_spacing: (width, height) of separation between control points on the grid
     :param array angles_to_search: An array of floats or None.  Images are rotated by the degrees indicated in the array.  The single best alignment across all angles is selected.
     :param float min_alighment_overlap: Limits how far control points can be translated.  The cells from fixed and target space must overlap by this minimum amount.
+    :param float min_cell_movement: Cells whose corners moved less than this many pixels since the previous iteration are not aligned again, their previous alignment is reused.  Zero aligns every cell on every iteration.
     :param bool SaveImages: Saves registered images of each iteration in the output path for debugging purposes
     :param bool SavePlots: Saves histograms and vector plots of each iteration in the output path for debugging purposes     
     :param str outputDir: Directory to save images and plots if requested.  Must not be null if SaveImages or SavePlots are true   
@@ -335,6 +345,9 @@ def RefineTransform(stosTransform,
     if min_alignment_overlap is None:
         min_alignment_overlap = 0.5
         
+    if min_cell_movement is None:
+        min_cell_movement = 0.25
+        
     if SavePlots or SaveImages:
         assert(outputDir is not None)
     
@@ -356,6 +369,7 @@ def RefineTransform(stosTransform,
     final_pass_angles = np.linspace(-7.5, 7.5, 11)  # The last registration we perform on a cell is a bit more thorough
      
     finalized_points = {}
+    previous_records = None
       
     CutoffPercentilePerIteration = 10.0
     
@@ -371,10 +385,14 @@ def RefineTransform(stosTransform,
                             grid_spacing=grid_spacing,
                             finalized=finalized_points,
                             angles_to_search=angles_to_search,
-                            min_alignment_overlap=min_alignment_overlap)
+                            min_alignment_overlap=min_alignment_overlap,
+                            previous_records=previous_records,
+                            min_cell_movement=min_cell_movement)
         
         print("Pass {0} aligned {1} points".format(i, len(alignment_points)))
         
+        previous_records = {tuple(record.SourcePoint): record for record in alignment_points}
+        
         # For the first pass we use a larger cell to help get some initial registration points
         if i == 1:
             cell_size = cell_size / 2.0
@@ -409,25 +427,27 @@ def RefineTransform(stosTransform,
                                                                      percentile=percentile,
                                                                      min_travel_distance=min_travel_for_finalization)
         
-        new_finalizations = 0
+        finalizing_records = {}
         for (ir, record) in enumerate(alignment_points): 
             if not new_finalized_points[ir]:
                 continue
             
             key = tuple(record.SourcePoint)
-            if key in finalized_points:
+            if key in finalized_points or key in finalizing_records:
                 continue
             
-            # See if we can improve the final alignment
-            refined_align_record = nornir_imageregistration.stos_brute.SliceToSliceBruteForce(record.TargetROI,
-                                                                                              record.SourceROI,
-                                                                                              AngleSearchRange=final_pass_angles,
-                                                                                              MinOverlap=min_alignment_overlap,
-                                                                                              SingleThread=True,
-                                                                                              Cluster=False,
-                                                                                              TestFlip=False)
+            finalizing_records[key] = record
+            
+        finalizing_records = list(finalizing_records.values())
+            
+        # See if we can improve the final alignments
+        refined_align_records = _AlignRecordCells(finalizing_records, final_pass_angles, min_alignment_overlap)
+        
+        new_finalizations = 0
+        for (record, refined_align_record) in zip(finalizing_records, refined_align_records):
+            key = tuple(record.SourcePoint)
             
-            if refined_align_record.weight > record.weight:
+            if refined_align_record is not None and refined_align_record.weight > record.weight:
                 oldPSDDelta = record.PSDDelta
                 record = nornir_imageregistration.EnhancedAlignmentRecord(ID=record.ID,
                                                                              TargetPoint=record.TargetPoint,
@@ -489,9 +509,48 @@ def RefineTransform(stosTransform,
     return stosTransform
         
 
+def _AlignRecordCells(alignment_records, angles_to_search, min_alignment_overlap):
+    '''
+    Align the TargetROI and SourceROI cells of alignment records again, in batches of AlignmentCellsPerTask cells
+    :return: A refined EnhancedAlignmentRecord for each record, None if the cells are a single color
+    :rtype: list
+    '''
+    pool = nornir_pools.GetGlobalMultithreadingPool()
+    tasks = []
+    
+    # Cells may only be stacked with cells of the same size
+    records_by_shape = {}
+    for (i, record) in enumerate(alignment_records):
+        records_by_shape.setdefault(record.TargetROI.shape, []).append(i)
+    
+    for indicies in records_by_shape.values():
+        for iStart in range(0, len(indicies), AlignmentCellsPerTask):
+            batch = indicies[iStart:iStart + AlignmentCellsPerTask]
+            records = [alignment_records[i] for i in batch]
+            task = pool.add_task("Align %d cells" % len(batch),
+                                 AlignCellStacks,
+                                 np.stack([r.TargetROI for r in records]),
+                                 np.stack([r.SourceROI for r in records]),
+                                 [r.ID for r in records],
+                                 [r.TargetPoint for r in records],
+                                 [r.SourcePoint for r in records],
+                                 anglesToSearch=angles_to_search,
+                                 min_alignment_overlap=min_alignment_overlap)
+            task.batch = batch
+            tasks.append(task)
+            
+    refined_records = [None] * len(alignment_records)
+    for task in tasks:
+        for (i, refined_record) in zip(task.batch, task.wait_return()):
+            refined_records[i] = refined_record
+            
+    return refined_records
+            
+
 def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_mask=None,
                     source_mask=None, cell_size=(256, 256), grid_spacing=(256, 256),
-                    finalized=None, angles_to_search=None, min_alignment_overlap=0.5):
+                    finalized=None, angles_to_search=None, min_alignment_overlap=0.5,
+                    previous_records=None, min_cell_movement=None):
     '''
     Places a regular grid of control points across the target image.  These corresponding points on the
     source image are then adjusted to create a mapping from Source To Fixed Space for the source image. 
@@ -505,6 +564,8 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
     :param dict finalized: A dictionary of points, indexed by Target Space Coordinates, that are finalized and do not need to be checked
     :param array angles_to_search: An array of floats or None.  Images are rotated by the degrees indicated in the array.  The single best alignment across all angles is selected.
     :param float min_alighment_overlap: Limits how far control points can be translated.  The cells from fixed and target space must overlap by this minimum amount.    
+    :param dict previous_records: Alignment records of the previous iteration, indexed by Source Space Coordinates
+    :param float min_cell_movement: Cells that moved less than this many pixels since previous_records reuse their previous alignment
     '''
     
     if isinstance(Transform, str):
@@ -524,11 +585,6 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
         source_mask = nornir_imageregistration.ImageParamToImageArray(source_mask, dtype=np.bool)
         source_image = nornir_imageregistration.RandomNoiseMask(source_image, source_mask)
     
-#     shared_fixed_image  = nornir_imageregistration.npArrayToReadOnlySharedArray(target_image)
-#     shared_fixed_image.mode = 'r'
-#     shared_warped_image = nornir_imageregistration.npArrayToReadOnlySharedArray(source_image)
-#     shared_warped_image.mode = 'r'
-    
     # Mark a grid along the fixed image, then find the points on the warped image
     
     # grid_data = nornir_imageregistration.grid_subdivision.CenteredGridRefinementCells(target_image.shape, cell_size)
@@ -597,13 +653,75 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
     tasks = list()
     alignment_records = list()
     
-    rigid_transforms = ApproximateRigidTransform(input_transform=Transform, target_points=grid_data.TargetPoints)
+    (target_offsets, source_rotation_centers, angles) = ApproximateRigidTransformParameters(input_transform=Transform, target_points=grid_data.TargetPoints)
+    rigid_parameters = lambda i: (target_offsets[i], source_rotation_centers[i], angles[i])
+    
+    if angles_to_search is None:
+        angles_to_search = [0]
+    
+    # Cells whose transform barely changed since the last iteration keep their previous alignment
+    reused_records = []
+    if previous_records is not None and min_cell_movement is not None and min_cell_movement > 0:
+        realign = np.ones(grid_data.coords.shape[0], dtype=bool)
+        for i in range(grid_data.coords.shape[0]):
+            previous = previous_records.get(tuple(grid_data.SourcePoints[i, :]), None)
+            if previous is None or not _CanReuseAlignmentRecord(previous, cell_size, angles_to_search):
+                continue
+            
+            if _CellMovement(previous, rigid_parameters(i), grid_data.TargetPoints[i, :], cell_size) < min_cell_movement:
+                reused_records.append(_ReuseAlignmentRecord(previous, grid_data.coords[i], grid_data.TargetPoints[i, :], grid_data.SourcePoints[i, :], rigid_parameters(i)))
+                realign[i] = False
+                
+        grid_data.RemoveMaskedPoints(realign)
+        (target_offsets, source_rotation_centers, angles) = (target_offsets[realign], source_rotation_centers[realign], angles[realign])
+        
+        if len(reused_records) > 0:
+            print("Reused the alignment of {0} cells that moved less than {1} pixels".format(len(reused_records), min_cell_movement))
+    
+    # Publish the images once so workers crop and warp their cells locally instead of receiving pickled cells
+    shared_images = None
+    slab_pool = shared_buffers.GetSlabPool()
+    if slab_pool is not None and grid_data.coords.shape[0] > 0:
+        shared_images = SharedAlignmentImages.Create(slab_pool, target_image, source_image, cell_size, grid_data.coords.shape[0])
+    
+    if shared_images is not None:
+        for iStart in range(0, grid_data.coords.shape[0], AlignmentCellsPerTask):
+            iPoints = np.arange(iStart, min(iStart + AlignmentCellsPerTask, grid_data.coords.shape[0]))
+            
+            AlignTask = pool.add_task("Align cells %d-%d" % (iPoints[0], iPoints[-1]),
+                                      AlignPointsInSharedImages,
+                                      shared_images,
+                                      iPoints,
+                                      (target_offsets[iPoints], source_rotation_centers[iPoints], angles[iPoints]),
+                                      grid_data.coords[iPoints],
+                                      grid_data.TargetPoints[iPoints],
+                                      grid_data.SourcePoints[iPoints],
+                                      cell_size,
+                                      anglesToSearch=angles_to_search,
+                                      min_alignment_overlap=min_alignment_overlap)
+            AlignTask.iPoints = iPoints
+            tasks.append(AlignTask)
+            
+        for t in tasks:
+            for (iPoint, erec) in zip(t.iPoints, t.wait_return()):
+                if erec is None:
+                    # Cells of a single color are not aligned
+                    continue
+                
+                (erec.TargetROI, erec.SourceROI) = shared_images.CopyROIs(iPoint)
+                _StampAlignmentRecord(erec, rigid_parameters(iPoint), angles_to_search)
+                alignment_records.append(erec)
+                
+        shared_images.Release(slab_pool)
+        return reused_records + alignment_records
     
     for (i, coord) in enumerate(grid_data.coords):
         
         AlignTask = StartAttemptAlignPoint(pool,
                                            "Align %d,%d" % (coord[0], coord[1]),
-                                           rigid_transforms[i],
+                                           nornir_imageregistration.transforms.Rigid(target_offset=target_offsets[i],
+                                                                                     source_rotation_center=source_rotation_centers[i],
+                                                                                     angle=angles[i]),
                                            #Transform,
                                            target_image,
                                            source_image,
@@ -615,15 +733,6 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
         if AlignTask is None:
             continue
         
-#         AlignTask = pool.add_task("Align %d,%d" % (coord[0], coord[1]),
-#                                   AttemptAlignPoint,
-#                                   Transform,
-#                                   shared_fixed_image,
-#                                   shared_warped_image,
-#                                   TargetPoints[i,:],
-#                                   cell_size,
-#                                   anglesToSearch=AnglesToSearch)
-        
         AlignTask.ID = i
         AlignTask.coord = coord
         tasks.append(AlignTask)
@@ -654,8 +763,8 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
         #erec.SourcePSDScore = nornir_imageregistration.image_stats.ScoreImageWithPowerSpectralDensity(t.SourceROI)
         
         #erec.PSDDelta = abs(erec.TargetPSDScore - erec.SourcePSDScore)
-        erec.PSDDelta = (erec.TargetROI - np.mean(erec.TargetROI.flat)) - (erec.SourceROI - np.mean(erec.SourceROI.flat))
-        erec.PSDDelta = np.sum(np.abs(erec.PSDDelta))
+        erec.PSDDelta = _PSDDelta(erec.TargetROI, erec.SourceROI)
+        _StampAlignmentRecord(erec, rigid_parameters(t.ID), angles_to_search)
         # erec.CalculatedWarpedPoint = Transform.InverseTransform(erec.AdjustedTargetPoint).reshape(2)
         # arecord.ID = (iRow, iCol)
         # arecord.TargetPoint = t.TargetPoint
@@ -663,11 +772,8 @@ def _RunRefineTwoImagesIteration(Transform, target_image, source_image, target_m
         # arecord.AdjustedWarpedPoint = t.WarpedPoint + arecord.peak
          
         alignment_records.append(erec)
-#         
-#     del shared_warped_image
-#     del shared_fixed_image
     
-    return alignment_records
+    return reused_records + alignment_records
     # Cull the worst of the alignment records
     
     # Build a new transform using our alignment points
@@ -839,9 +945,66 @@ def AttemptAlignPoint(transform, fixedImage, warpedImage, controlpoint, alignmen
         # print("Auto-translate result: " + str(apoint))
         return apoint
 
-def ApproximateRigidTransform(input_transform, target_points):
+def _StampAlignmentRecord(record, rigid_parameters, angles_to_search):
     '''
-    Given an array of points, returns a set of rigid transforms for each point that estimate the angle and offset for those two points to align.
+    Record how a cell was aligned so the next iteration can decide whether the alignment can be reused
+    :param tuple rigid_parameters: (target_offset, source_rotation_center, angle) of the cell's rigid approximation
+    '''
+    record.RigidParameters = rigid_parameters
+    record.AnglesSearched = np.asarray(angles_to_search)
+    
+
+def _CanReuseAlignmentRecord(record, cell_size, angles_to_search):
+    ''':return: True if the record was aligned with the same cell size and angles'''
+    if getattr(record, 'RigidParameters', None) is None or getattr(record, 'TargetROI', None) is None:
+        return False
+    
+    if record.TargetROI.shape != (int(cell_size[0]), int(cell_size[1])):
+        return False
+    
+    return np.array_equal(record.AnglesSearched, np.asarray(angles_to_search))
+
+
+def _CellMovement(record, rigid_parameters, target_point, cell_size):
+    '''
+    :return: The largest distance a corner of the cell moved in target or source space since the record was aligned
+    '''
+    half_cell = np.asarray(cell_size, dtype=np.float64) / 2.0
+    corners = np.array(((-1, -1), (-1, 1), (1, -1), (1, 1)), dtype=np.float64) * half_cell
+    
+    previous_corners = record.TargetPoint + corners
+    target_corners = target_point + corners
+    
+    source_corners = RigidInverseTransform(target_corners[np.newaxis], *[np.asarray(p)[np.newaxis] for p in rigid_parameters])
+    previous_source_corners = RigidInverseTransform(previous_corners[np.newaxis], *[np.asarray(p)[np.newaxis] for p in record.RigidParameters])
+    
+    target_movement = np.max(np.abs(target_corners - previous_corners))
+    source_movement = np.max(np.abs(source_corners - previous_source_corners))
+    
+    return max(target_movement, source_movement)
+
+
+def _ReuseAlignmentRecord(record, ID, TargetPoint, SourcePoint, rigid_parameters):
+    ''':return: A copy of the record's alignment for a grid point at its updated position'''
+    erec = nornir_imageregistration.EnhancedAlignmentRecord(ID=ID,
+                                                            TargetPoint=TargetPoint,
+                                                            SourcePoint=SourcePoint,
+                                                            peak=record.peak,
+                                                            weight=record.weight,
+                                                            angle=record.angle,
+                                                            flipped_ud=record.flippedud)
+    erec.PSDDelta = record.PSDDelta
+    erec.TargetROI = record.TargetROI
+    erec.SourceROI = record.SourceROI
+    _StampAlignmentRecord(erec, rigid_parameters, record.AnglesSearched)
+    return erec
+
+
+def ApproximateRigidTransformParameters(input_transform, target_points):
+    '''
+    Given an array of points, estimates the angle and offset of a rigid transform at each point.  The input transform
+    is called once for all points.
+    :return: (target_offsets, source_rotation_centers, angles) arrays with one row for each point.  Angles are in radians.
     '''
 
     target_points = nornir_imageregistration.EnsurePointsAre2DNumpyArray(target_points)
@@ -857,8 +1020,10 @@ def ApproximateRigidTransform(input_transform, target_points):
     offsets = np.tile(offset, (numPoints,1))
     origins = np.tile(np.array([0,0]), (numPoints,1))
     
-    recalculated_target_points = input_transform.Transform(source_points)
-    offset_target_points = input_transform.Transform(offset_source_points)
+    # Transform the points and offset points together
+    transformed_points = input_transform.Transform(np.vstack((source_points, offset_source_points)))
+    recalculated_target_points = transformed_points[0:numPoints]
+    offset_target_points = transformed_points[numPoints:]
     
     target_delta = offset_target_points - recalculated_target_points
     
@@ -866,28 +1031,69 @@ def ApproximateRigidTransform(input_transform, target_points):
     
     target_offsets = target_points - source_points  
     
+    return (target_offsets, source_points, angles)
+
+
+def ApproximateRigidTransform(input_transform, target_points):
+    '''
+    Given an array of points, returns a set of rigid transforms for each point that estimate the angle and offset for those two points to align.
+    '''
+    
+    (target_offsets, source_points, angles) = ApproximateRigidTransformParameters(input_transform, target_points)
+    
     output_transforms = [nornir_imageregistration.transforms.Rigid(target_offset=target_offsets[i],
                                                                    source_rotation_center=source_points[i],
                                                                    angle=angles[i]) 
                         for i in range(0,len(angles))]
     
     return output_transforms
+
+
+def RigidInverseTransform(points, target_offsets, source_rotation_centers, angles):
+    '''
+    Map target space points to source space using a different rigid transform for each set of points.  Produces the 
+    same result as Rigid.InverseTransform.
+    :param ndarray points: (N, ..., 2) array of points.  The first axis selects the rigid transform.
+    :param ndarray target_offsets: Nx2 target offsets of the rigid transforms
+    :param ndarray source_rotation_centers: Nx2 source space rotation centers of the rigid transforms
+    :param ndarray angles: N angles of the rigid transforms, in radians
+    :return: Source space points with the same shape as points
+    '''
     
-def StartAttemptAlignPoint(pool, taskname, transform,
-                           targetImage, sourceImage,
-                           controlpoint,
-                           alignmentArea,
-                           anglesToSearch=None,
-                           min_alignment_overlap=0.5):
-    if anglesToSearch is None:
-        anglesToSearch = np.linspace(-7.5, 7.5, 11)
-        
+    points = np.asarray(points, dtype=np.float64)
+    param_shape = (points.shape[0],) + (1,) * (points.ndim - 2)
+    
+    target_offsets = np.asarray(target_offsets, dtype=np.float64).reshape(param_shape + (2,))
+    source_rotation_centers = np.asarray(source_rotation_centers, dtype=np.float64).reshape(param_shape + (2,))
+    angles = np.asarray(angles, dtype=np.float64).reshape(param_shape)
+    
+    centered_points = points - target_offsets - source_rotation_centers
+    
+    (cos, sin) = (np.cos(-angles), np.sin(-angles))
+    output_points = np.empty(points.shape, dtype=np.float64)
+    output_points[..., 0] = (cos * centered_points[..., 0]) - (sin * centered_points[..., 1])
+    output_points[..., 1] = (sin * centered_points[..., 0]) + (cos * centered_points[..., 1])
+    
+    output_points += source_rotation_centers
+    return output_points
+
+
+def _AlignmentCellRectangle(controlpoint, alignmentArea):
+    ''':return: The target space rectangle of the cell centered on the control point'''
     FixedRectangle = nornir_imageregistration.Rectangle.CreateFromPointAndArea(point=[controlpoint[0] - (alignmentArea[0] / 2.0),
                                                                                    controlpoint[1] - (alignmentArea[1] / 2.0)],
                                                                              area=alignmentArea)
 
     FixedRectangle = nornir_imageregistration.Rectangle.SafeRound(FixedRectangle)
-    FixedRectangle = nornir_imageregistration.Rectangle.change_area(FixedRectangle, alignmentArea)
+    return nornir_imageregistration.Rectangle.change_area(FixedRectangle, alignmentArea)
+
+    
+def _AlignmentCellROIs(transform, targetImage, sourceImage, controlpoint, alignmentArea):
+    '''
+    Crop the cell centered on the control point from the target image and warp the same cell of the source image
+    :return: (targetImageROI, sourceImageROI)
+    '''
+    FixedRectangle = _AlignmentCellRectangle(controlpoint, alignmentArea)
     
     # Pull image subregions 
     sourceImageROI = nornir_imageregistration.assemble.WarpedImageToFixedSpace(transform,
@@ -897,11 +1103,210 @@ def StartAttemptAlignPoint(pool, taskname, transform,
                                                         FixedRectangle.BottomLeft[1], FixedRectangle.BottomLeft[0],
                                                         int(FixedRectangle.Size[1]), int(FixedRectangle.Size[0]),
                                                         cval="random")
+    
+    return (targetImageROI, sourceImageROI)
+
+
+def ExtractAlignmentCells(targetImage, sourceImage, controlpoints, alignmentArea, target_offsets, source_rotation_centers, angles):
+    '''
+    Batched form of cropping and warping the cells of many control points.  The source space coordinates of every 
+    cell are calculated in one array and sampled with a single map_coordinates call.
+    :param ndarray controlpoints: Nx2 target space centers of the cells
+    :param tuple alignmentArea: (Height, Width) of the cells
+    :param ndarray target_offsets: Nx2 target offsets of each cell's rigid transform, see ApproximateRigidTransformParameters
+    :param ndarray source_rotation_centers: Nx2 rotation centers of each cell's rigid transform
+    :param ndarray angles: N angles of each cell's rigid transform, in radians
+    :return: (target_cells, source_cells) contiguous (N, Height, Width) stacks
+    '''
+    
+    cell_shape = (int(alignmentArea[0]), int(alignmentArea[1]))
+    controlpoints = nornir_imageregistration.EnsurePointsAre2DNumpyArray(controlpoints)
+    
+    origins = np.asarray([_AlignmentCellRectangle(controlpoint, alignmentArea).BottomLeft for controlpoint in controlpoints])
+    
+    # Warp the source cells.  Each cell's rigid transform is affine, so source coordinates are the source position
+    # of the cell's origin plus the rotated row and column offsets of each pixel.
+    num_cells = controlpoints.shape[0]
+    source_origins = RigidInverseTransform(origins, target_offsets, source_rotation_centers, angles)
+    (cos, sin) = (np.cos(-np.asarray(angles)), np.sin(-np.asarray(angles)))
+    (rows, cols) = (np.arange(cell_shape[0], dtype=np.float64), np.arange(cell_shape[1], dtype=np.float64))
+    
+    source_coords = np.empty((2, num_cells) + cell_shape, dtype=np.float64)
+    np.add((source_origins[:, 0:1] + (cos[:, np.newaxis] * rows))[:, :, np.newaxis], (-sin[:, np.newaxis] * cols)[:, np.newaxis, :], out=source_coords[0])
+    np.add((source_origins[:, 1:2] + (sin[:, np.newaxis] * rows))[:, :, np.newaxis], (cos[:, np.newaxis] * cols)[:, np.newaxis, :], out=source_coords[1])
+    
+    source_cells = scipy.ndimage.map_coordinates(sourceImage, source_coords.reshape((2, -1)), order=0, mode='constant', cval=0)
+    source_cells = source_cells.reshape((num_cells,) + cell_shape)
+    
+    # Like WarpedImageToFixedSpace, unmappable pixels take the minimum value of the cell instead of zero
+    source_max = np.asarray(sourceImage.shape) - 1
+    partial = np.logical_or(np.any(np.min(source_coords, axis=(2, 3)).transpose() < 0, axis=1),
+                            np.any(np.max(source_coords, axis=(2, 3)).transpose() > source_max, axis=1))
+    for i in np.flatnonzero(partial):
+        mapped = np.logical_and(np.logical_and(source_coords[0, i] >= 0, source_coords[0, i] <= source_max[0]),
+                                np.logical_and(source_coords[1, i] >= 0, source_coords[1, i] <= source_max[1]))
+        if np.any(mapped):
+            source_cells[i][np.logical_not(mapped)] = np.min(source_cells[i][mapped])
+            
+    del source_coords
+    
+    # Crop the target cells
+    origins = origins.astype(np.int64)
+    rows = origins[:, 0:1] + np.arange(cell_shape[0])
+    cols = origins[:, 1:2] + np.arange(cell_shape[1])
+    rows_inside = np.logical_and(rows >= 0, rows < targetImage.shape[0])
+    cols_inside = np.logical_and(cols >= 0, cols < targetImage.shape[1])
+    
+    target_cells = targetImage[np.clip(rows, 0, targetImage.shape[0] - 1)[:, :, np.newaxis],
+                               np.clip(cols, 0, targetImage.shape[1] - 1)[:, np.newaxis, :]]
+    
+    # Cells extending past the image are filled with noise as CropImage does
+    for i in np.flatnonzero(np.logical_not(np.logical_and(np.all(rows_inside, 1), np.all(cols_inside, 1)))):
+        inside = np.logical_and(rows_inside[i][:, np.newaxis], cols_inside[i][np.newaxis, :])
+        target_cells[i][np.logical_not(inside)] = 1
+        nornir_imageregistration.RandomNoiseMask(target_cells[i], inside, Copy=False)
+    
+    return (target_cells, source_cells)
+
+
+def _IsSingleColor(image):
+    return np.all(image == image[0][0])
+
+
+class SharedAlignmentImages(object):
+    '''
+    Picklable description of the target and source images of a refinement iteration published in a shared memory slab.
+    The slab also holds a slot for the target and source cell of every grid point, which workers fill so the cells
+    are returned without pickling them.
+    '''
+    
+    def __init__(self, shared_slab, shapes, dtypes):
+        self.shared_slab = shared_slab
+        self.shapes = shapes
+        self.dtypes = dtypes
+        
+    @classmethod
+    def Create(cls, slab_pool, target_image, source_image, cell_size, num_points):
+        '''Copy the images into a slab acquired from the slab pool'''
+        cell_shape = (int(cell_size[0]), int(cell_size[1]))
+        shapes = (target_image.shape, source_image.shape, (num_points,) + cell_shape, (num_points,) + cell_shape)
+        dtypes = (np.float32,) * 4
+        
+        shared_slab = slab_pool.Acquire(shared_buffers.PackedSize(shapes, dtypes))
+        obj = cls(shared_slab, shapes, dtypes)
+        
+        views = obj.Views()
+        views[0][:] = target_image
+        views[1][:] = source_image
+        del views
+        
+        return obj
+    
+    def Views(self):
+        ''':return: [target_image, source_image, target_cells, source_cells] views of the slab'''
+        return self.shared_slab.Views(self.shapes, self.dtypes)
+    
+    def CopyROIs(self, iPoint):
+        ''':return: Copies of the (target, source) cells written for the grid point'''
+        views = self.Views()
+        return (views[2][iPoint].copy(), views[3][iPoint].copy())
+    
+    def Release(self, slab_pool):
+        slab_pool.Release(self.shared_slab)
+        self.shared_slab = None
+        
+        
+def _PSDDelta(TargetROI, SourceROI):
+    '''Sum of the absolute difference between the mean subtracted cells'''
+    return np.sum(np.abs((TargetROI - np.mean(TargetROI.flat)) - (SourceROI - np.mean(SourceROI.flat))))
+
+
+def AlignCellStacks(target_cells, source_cells, IDs, TargetPoints, SourcePoints,
+                    anglesToSearch=None,
+                    min_alignment_overlap=0.5):
+    '''
+    Align stacks of equally sized cells with stos_brute.SliceToSliceBruteForceStack.  Rotation, padding and FFTs are
+    calculated for every cell of the stack at once instead of one cell at a time.
+    :param ndarray target_cells: (N, Height, Width) cells from the target image
+    :param ndarray source_cells: (N, Height, Width) cells from the source image, warped into target space
+    :param list IDs: ID of each cell's alignment record
+    :param ndarray TargetPoints: Nx2 target space center of each cell
+    :param ndarray SourcePoints: Nx2 source space center of each cell
+    :return: An EnhancedAlignmentRecord with PSDDelta set for each cell, or None for cells of a single color
+    :rtype: list
+    '''
+    if anglesToSearch is None:
+        anglesToSearch = np.linspace(-7.5, 7.5, 11)
+        
+    records = [None] * len(IDs)
+    
+    #Just ignore pure color regions
+    aligned = [i for i in range(len(IDs)) if not (_IsSingleColor(source_cells[i]) or _IsSingleColor(target_cells[i]))]
+    if len(aligned) == 0:
+        return records
+    
+    brute_records = nornir_imageregistration.stos_brute.SliceToSliceBruteForceStack(target_cells[aligned],
+                                                                                    source_cells[aligned],
+                                                                                    AngleSearchRange=anglesToSearch,
+                                                                                    MinOverlap=min_alignment_overlap)
+    
+    for (i, arecord) in zip(aligned, brute_records):
+        erec = nornir_imageregistration.EnhancedAlignmentRecord(ID=IDs[i],
+                                                                TargetPoint=TargetPoints[i],
+                                                                SourcePoint=SourcePoints[i],
+                                                                peak=arecord.peak,
+                                                                weight=arecord.weight,
+                                                                angle=arecord.angle,
+                                                                flipped_ud=arecord.flippedud)
+        erec.PSDDelta = _PSDDelta(target_cells[i], source_cells[i])
+        records[i] = erec
+        
+    return records
+
+
+def AlignPointsInSharedImages(shared_images, iPoints, rigid_parameters,
+                              IDs, TargetPoints, SourcePoints,
+                              alignmentArea,
+                              anglesToSearch=None,
+                              min_alignment_overlap=0.5):
+    '''
+    Align the cells of a batch of grid points using images published with SharedAlignmentImages.  The cells are 
+    extracted together with ExtractAlignmentCells, written to the slots for iPoints in the slab and aligned together 
+    with AlignCellStacks.
+    :param list iPoints: Grid point index of each cell
+    :param tuple rigid_parameters: (target_offsets, source_rotation_centers, angles) of the rigid transforms approximating the transform at each grid point, see ApproximateRigidTransformParameters
+    :return: See AlignCellStacks
+    '''
+    (targetImage, sourceImage, target_cells, source_cells) = shared_images.Views()
+    targetImage.setflags(write=False)
+    sourceImage.setflags(write=False)
+    
+    (target_cells[iPoints], source_cells[iPoints]) = ExtractAlignmentCells(targetImage, sourceImage, TargetPoints, alignmentArea, *rigid_parameters)
+    
+    records = AlignCellStacks(target_cells[iPoints], source_cells[iPoints], IDs, TargetPoints, SourcePoints,
+                              anglesToSearch=anglesToSearch,
+                              min_alignment_overlap=min_alignment_overlap)
+    
+    del targetImage, sourceImage, target_cells, source_cells
+    
+    return records
+
+
+def StartAttemptAlignPoint(pool, taskname, transform,
+                           targetImage, sourceImage,
+                           controlpoint,
+                           alignmentArea,
+                           anglesToSearch=None,
+                           min_alignment_overlap=0.5):
+    if anglesToSearch is None:
+        anglesToSearch = np.linspace(-7.5, 7.5, 11)
+        
+    (targetImageROI, sourceImageROI) = _AlignmentCellROIs(transform, targetImage, sourceImage, controlpoint, alignmentArea)
 
     #Just ignore pure color regions
-    if np.all(sourceImageROI == sourceImageROI[0][0]):
+    if _IsSingleColor(sourceImageROI):
         return None
-    if np.all(targetImageROI == targetImageROI[0][0]):
+    if _IsSingleColor(targetImageROI):
         return None
     
     # nornir_imageregistration.ShowGrayscale([targetImageROI, sourceImageROI])
@@ -97,6 +97,30 @@ class Mosaic(object):
 
         self._ImageToTransform = ImageToTransform
         self.ImageScale = 1
+        self._spatial_index = None
+        self._spatial_index_entries = None
+
+    @property
+    def SpatialIndex(self):
+        '''A RectangleIndex of the transform fixed bounding boxes, in the order of _TransformsSortedByKey.
+           The index is rebuilt after a transform changes or the set of transforms changes.'''
+        
+        entries = [(key, id(t)) for (key, t) in sorted(self.ImageToTransform.items())]
+        
+        if self._spatial_index is None or self._spatial_index_entries != entries:
+            transforms = self._TransformsSortedByKey()
+            for t in transforms:
+                if self._OnTransformChanged not in t.OnChangeEventListeners:
+                    t.AddOnChangeEventListener(self._OnTransformChanged)
+                    
+            self._spatial_index = spatial.RectangleIndex.Create([t.FixedBoundingBox for t in transforms])
+            self._spatial_index_entries = entries
+            
+        return self._spatial_index
+    
+    def _OnTransformChanged(self):
+        '''Called when one of our transforms changes, the spatial index is rebuilt on next use'''
+        self._spatial_index = None
 
     @classmethod
     def _ConvertTransformStringsToTransforms(cls, image_to_transform):
@@ -260,13 +284,17 @@ class Mosaic(object):
         score = arrange.ScoreMosaicQuality(self._TransformsSortedByKey(), self.CreateTilesPathList(tilesPath))
         return score
 
-    def AssembleImage(self, tilesPath, FixedRegion=None, usecluster=False, target_space_scale=None, source_space_scale=None):
+    def AssembleImage(self, tilesPath, FixedRegion=None, usecluster=False, target_space_scale=None, source_space_scale=None, blend_mode=None,
+                      use_coordinate_cache=False, coordinate_cache_bytes=None):
         '''Create a single image of the mosaic for the requested region.
         :param str tilesPath: Directory containing tiles referenced in our transform
         :param array FixedRegion: Rectangle object or [MinY MinX MaxY MaxX] boundary of image to assemble
         :param boolean usecluster: Offload work to other threads or nodes if true
         :param float target_space_scale: Scalar for target space, used to adjust size of assembled image
         :param float source_space_scale: Optimization parameter, eliminates need for function to compare input images with transform boundaries to determine scale
+        :param blend_mode: How overlapping tiles are combined, a name in assemble_tiles.BlendModes.  Defaults to the z-buffer.
+        :param bool use_coordinate_cache: Keep coordinate maps of warped tiles so assembling the same region again skips the transform.  See assemble_tiles.TilesToImage.
+        :param int coordinate_cache_bytes: Memory limit of each process's coordinate map cache
         '''
 
         # Left off here, I need to split this function so that FixedRegion has a consistent meaning
@@ -282,30 +310,45 @@ class Mosaic(object):
          
         if usecluster and len(tilesPathList) > 1:
             cpool = nornir_pools.GetGlobalMultithreadingPool()
-            return at.TilesToImageParallel(self._TransformsSortedByKey(), tilesPathList, pool=cpool, TargetRegion=FixedRegion, target_space_scale=target_space_scale, source_space_scale=source_space_scale)
+            return at.TilesToImageParallel(self._TransformsSortedByKey(), tilesPathList, pool=cpool, TargetRegion=FixedRegion, target_space_scale=target_space_scale, source_space_scale=source_space_scale,
+                                           spatial_index=self.SpatialIndex, blend_mode=blend_mode,
+                                           use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
         else:
             # return at.TilesToImageParallel(self.ImageToTransform.values(), tilesPathList)
-            return at.TilesToImage(self._TransformsSortedByKey(), tilesPathList, TargetRegion=FixedRegion, target_space_scale=target_space_scale, source_space_scale=source_space_scale)
+            return at.TilesToImage(self._TransformsSortedByKey(), tilesPathList, TargetRegion=FixedRegion, target_space_scale=target_space_scale, source_space_scale=source_space_scale,
+                                   spatial_index=self.SpatialIndex, blend_mode=blend_mode,
+                                   use_coordinate_cache=use_coordinate_cache, coordinate_cache_bytes=coordinate_cache_bytes)
         
     def GenerateOptimizedTiles(self, tilesPath, tile_dims=None, max_temp_image_area=None, usecluster=True, target_space_scale=None, source_space_scale=None):
         '''
         Divides the mosaic into a grid of smaller non-overlapping tiles.  Yields each tile along with their coordinates in the grid.
+        
+        The grid is assembled in scanline order, one working window of tiles at a time.  Only the input tiles that overlap
+        a window are transformed for it and each output tile is yielded as soon as its window is assembled, so memory use
+        depends on max_temp_image_area rather than the size of the mosaic.  Windows are never shorter than the tallest
+        input tile, which takes precedence over max_temp_image_area, so no input tile is transformed for more than two rows of windows.
+        
         :param str tilesPath: Directory containing tiles referenced in our transform
         :param tuple tile_dims: Size of the optimized tiles
-        :param max_image_dims: The maximum size of image we will assemble at any time.  Smaller values consume less memory, larger values run faster
+        :param int max_temp_image_area: The maximum area, in output pixels, of the working image we will assemble at any time.  Smaller values consume less memory, larger values run faster.  Defaults to the whole mosaic
         :param boolean usecluster: Offload work to other threads or nodes if true
         :param float target_space_scale: Scalar for target space, used to adjust size of assembled image
         :param float source_space_scale: Optimization parameter, eliminates need for function to compare input images with transform boundaries to determine scale
         '''
         
-        # TODO: Optimize how we search for transforms that overlap the working_image for small working image sizes 
         if tile_dims is None:
             tile_dims = (512, 512)
             
-        tile_dims = np.asarray(tile_dims)
+        tile_dims = np.asarray(tile_dims, dtype=np.int64)
+        
+        transforms = self._TransformsSortedByKey()
+        if len(transforms) == 0:
+            return
+        
+        tilesPathList = self.CreateTilesPathList(tilesPath)
             
         if source_space_scale is None:
-            source_space_scale = nornir_imageregistration.tileset.MostCommonScalar(self._TransformsSortedByKey(), self.CreateTilesPathList(tilesPath))
+            source_space_scale = nornir_imageregistration.tileset.MostCommonScalar(transforms, tilesPathList)
             
         if target_space_scale is None:
             target_space_scale = source_space_scale
@@ -320,60 +363,58 @@ class Mosaic(object):
         grid_dims = nornir_imageregistration.TileGridShape(mosaic_fixed_bounding_box.shape * target_space_scale,
                                                            tile_size=tile_dims)
         
-        # Lets build long vertical columns.  Figure out how many columns we can assemble at a time
-        scaled_mosaic_fixed_bounding_box_shape = grid_dims * tile_dims
-        
         if max_temp_image_area is None:
-            max_temp_image_area = mosaic_fixed_bounding_box.Area
-            
-        template_image_shape = None  # Shape of the image we will assemble at each step
-        template_image_grid_dims = None  # Dimensions of tiles contained within each working_image
-        if max_temp_image_area >= np.prod(scaled_mosaic_fixed_bounding_box_shape):
-            template_image_shape = mosaic_fixed_bounding_box.shape
-            template_image_grid_dims = grid_dims
-        else:
-            num_rows = grid_dims[0]
-            max_column_width = max_temp_image_area / scaled_mosaic_fixed_bounding_box_shape[0] 
-            num_columns = int(np.floor(max_column_width / tile_dims[1]))
-            if num_columns < 1:
-                num_columns = 1
-                
-            template_image_grid_dims = np.asarray((num_rows, num_columns))
-            template_image_shape = template_image_grid_dims * scaled_tile_dims
-            
+            max_temp_image_area = np.prod(grid_dims * tile_dims)
+        
+        # Working windows are at least as tall as an input tile so each input tile is transformed for at most two rows of windows.
+        # Within that constraint windows are as wide as possible, then grow downward, without exceeding max_temp_image_area
+        tile_area = np.prod(tile_dims)
+        input_tile_height = max([t.FixedBoundingBox.Height for t in transforms]) * target_space_scale
+        min_window_rows = int(min(grid_dims[0], max(1, np.ceil(input_tile_height / tile_dims[0]))))
+        window_columns = int(min(grid_dims[1], max(1, max_temp_image_area // (tile_area * min_window_rows))))
+        window_rows = int(min(grid_dims[0], max(min_window_rows, max_temp_image_area // (tile_area * window_columns))))
+        
         working_image_origin = mosaic_fixed_bounding_box.BottomLeft
         assert(working_image_origin[0] == 0 and working_image_origin[1] == 0)
         
-        iColumn = 0
-        while iColumn < grid_dims[1]:
-            # Assemble a strip of images, divide them up and save
-            origin = (0, iColumn * scaled_tile_dims[1]) + working_image_origin
-            
-            working_image_shape = template_image_shape
-            working_image_grid_dims = template_image_grid_dims
-            # If we are on the final column don't make it larger than necessary
-            if working_image_grid_dims[1] + iColumn > grid_dims[1]:
-                working_image_grid_dims[1] = grid_dims[1] - iColumn
-                working_image_shape[1] = working_image_grid_dims[1] * scaled_tile_dims[1]
-                assert(working_image_shape[1] > 0)
-            
-            fixed_region = nornir_imageregistration.Rectangle.CreateFromPointAndArea(origin, working_image_shape)
-                     
-            (working_image, _mask ) = self.AssembleImage(tilesPath=tilesPath,
-                                               FixedRegion=fixed_region,
-                                               usecluster=usecluster,
-                                               target_space_scale=target_space_scale,
-                                               source_space_scale=source_space_scale)
-        
-            del _mask
-            
-            (yield from nornir_imageregistration.ImageToTilesGenerator(source_image=working_image,
-                                                                       tile_size=tile_dims,
-                                                                       grid_shape=working_image_grid_dims,
-                                                                       coord_offset=(0, iColumn)))
+        cpool = None
+        if usecluster:
+            cpool = nornir_pools.GetGlobalMultithreadingPool()
         
-            del working_image
+        for iRow in range(0, grid_dims[0], window_rows):
+            num_rows = min(window_rows, grid_dims[0] - iRow)
+            for iColumn in range(0, grid_dims[1], window_columns):
+                num_columns = min(window_columns, grid_dims[1] - iColumn)
+                
+                window_grid_dims = np.asarray((num_rows, num_columns), dtype=np.int64)
+                window_shape = window_grid_dims * tile_dims
+                origin = np.asarray((iRow, iColumn)) * scaled_tile_dims + working_image_origin
+                fixed_region = nornir_imageregistration.Rectangle.CreateFromPointAndArea(origin, window_grid_dims * scaled_tile_dims)
+                
+                if cpool is not None:
+                    (working_image, _mask) = at.TilesToImageParallel(transforms, tilesPathList, pool=cpool, TargetRegion=fixed_region,
+                                                                     target_space_scale=target_space_scale, source_space_scale=source_space_scale,
+                                                                     spatial_index=self.SpatialIndex)
+                else:
+                    (working_image, _mask) = at.TilesToImage(transforms, tilesPathList, TargetRegion=fixed_region,
+                                                             target_space_scale=target_space_scale, source_space_scale=source_space_scale,
+                                                             spatial_index=self.SpatialIndex)
+                del _mask
+                
+                # Rounding the scaled window can add a row or column of pixels, crop or pad so tiles land on the grid
+                if not np.array_equal(working_image.shape, window_shape):
+                    working_image = nornir_imageregistration.CropImage(working_image, Xo=0, Yo=0,
+                                                                       Width=int(window_shape[1]), Height=int(window_shape[0]),
+                                                                       cval=0)
+                
+                for iWindowRow in range(num_rows):
+                    StartY = iWindowRow * tile_dims[0]
+                    for iWindowColumn in range(num_columns):
+                        StartX = iWindowColumn * tile_dims[1]
+                        # Copy so callers holding on to a tile do not keep the whole working image alive
+                        tile_image = working_image[StartY:StartY + tile_dims[0], StartX:StartX + tile_dims[1]].copy()
+                        yield (iRow + iWindowRow, iColumn + iWindowColumn, tile_image)
             
-            iColumn += working_image_grid_dims[1]
+                del working_image
           
         return
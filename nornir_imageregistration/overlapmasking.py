@@ -47,6 +47,22 @@ def GetOverlapMask(FixedImageSize, MovingImageSize, CorrelationImageSize, MinOve
     return Mask
 
 
+def GetPeakSearchMask(CorrelationImageSize, ExpectedPeak, Radius):
+    '''Defines a mask that only allows peaks within a radius of an expected offset.  Used to 
+       restrict the translation search when a coarser registration already estimated the offset.
+    :param array CorrelationImageSize: Shape of correlation image
+    :param array ExpectedPeak: Expected offset (Y,X) in the same convention as FindPeak's return value
+    :param float Radius: Distance from the expected offset, in pixels, that peaks may occur
+    :return: An mxn image mask, with 1 indicating allowed peak locations
+    '''
+    
+    # FindPeak reports the offset of a peak from the center of the correlation image
+    Center = (np.asarray(CorrelationImageSize, dtype=np.float64) / 2.0) - np.asarray(ExpectedPeak, dtype=np.float64)
+    
+    (Y, X) = np.ogrid[0:int(CorrelationImageSize[0]), 0:int(CorrelationImageSize[1])]
+    return ((Y - Center[0]) ** 2) + ((X - Center[1]) ** 2) <= Radius ** 2
+
+
 def __CreateFullMaskFromQuadrant(Mask, isOddDimension):
     '''
     Given an image, replicates the image symetrically around both the X and Y axis to create a full mask
@@ -0,0 +1,254 @@
+'''
+Created on Oct 18, 2026
+
+Phase correlation for stacks of equally sized images.  The PhaseCorrelator
+uses real-to-complex FFTs in single precision and reuses its scratch buffers
+between calls, so workers that correlate many images of the same shape do
+not reallocate on every pair.  Scratch buffers are kept for each thread, so
+threads may share a correlator.  scipy.fft caches FFT plans by shape and
+dtype internally, keeping a correlator per shape keeps those plans warm.
+
+scipy image arrays are indexed [y,x]
+'''
+
+import collections
+import threading
+
+import numpy as np
+import scipy.fft
+
+import nornir_imageregistration
+
+#Collection of correlators we have already created, indexed by shape and dtype
+__known_correlators = collections.OrderedDict()
+__known_correlators_lock = threading.Lock()
+
+#Maximum number of correlators retained by GetPhaseCorrelator
+MaxCachedCorrelators = 8
+
+
+def GetPhaseCorrelator(shape, dtype=None):
+    '''
+    Returns a process-local PhaseCorrelator for the shape, creating it if needed.
+    The least recently used correlator is released when more than MaxCachedCorrelators exist.
+    :param tuple shape: (Height, Width) of the images that will be correlated
+    :param dtype dtype: Floating point type used for the correlation, defaults to float32
+    :rtype: PhaseCorrelator
+    '''
+    global __known_correlators
+
+    if dtype is None:
+        dtype = np.float32
+
+    key = (int(shape[0]), int(shape[1]), np.dtype(dtype).str)
+
+    with __known_correlators_lock:
+        correlator = __known_correlators.get(key, None)
+        if correlator is not None:
+            __known_correlators.move_to_end(key)
+            return correlator
+
+        correlator = PhaseCorrelator(shape, dtype=dtype)
+        __known_correlators[key] = correlator
+
+        while len(__known_correlators) > MaxCachedCorrelators:
+            __known_correlators.popitem(last=False)
+
+    return correlator
+
+
+class PhaseCorrelator(object):
+    '''
+    Calculates phase correlations for stacks of image pairs that all share the same shape.
+
+    Images are passed either as a single 2D image or as a 3D (N, Height, Width) stack.
+    A 2D fixed image can be correlated against a 3D moving stack, the fixed spectrum
+    is broadcast against each moving image.
+
+    :param tuple shape: (Height, Width) of every image correlated
+    :param dtype dtype: Floating point type used for the correlation, defaults to float32
+    '''
+
+    @property
+    def shape(self):
+        '''(Height, Width) of the images this correlator accepts'''
+        return self._shape
+
+    @property
+    def dtype(self):
+        '''Floating point type of the spatial domain data'''
+        return self._dtype
+
+    @property
+    def spectrum_shape(self):
+        '''(Height, Width) of the half-spectrum produced by rfft2'''
+        return (self._shape[0], (self._shape[1] // 2) + 1)
+
+    def __init__(self, shape, dtype=None):
+
+        if dtype is None:
+            dtype = np.float32
+
+        if len(shape) != 2:
+            raise ValueError("PhaseCorrelator expects a 2D shape, got {0}".format(str(shape)))
+
+        self._shape = (int(shape[0]), int(shape[1]))
+        self._dtype = np.dtype(dtype)
+
+        if not nornir_imageregistration.IsFloatArray(self._dtype):
+            raise ValueError("PhaseCorrelator requires a floating point dtype, got {0}".format(str(self._dtype)))
+
+        self._complex_dtype = np.result_type(self._dtype, np.complex64)
+
+        #Scratch buffers of each thread, grown to the largest stack the thread has seen and reused afterwards
+        self._scratch = threading.local()
+
+    def __getstate__(self):
+        #Scratch buffers are thread-local, there is no reason to send them to another process
+        return {'_shape': self._shape, '_dtype': self._dtype, '_complex_dtype': self._complex_dtype}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._scratch = threading.local()
+
+    def __str__(self):
+        return "PhaseCorrelator {0}x{1} {2}".format(self._shape[1], self._shape[0], str(self._dtype))
+
+    def _GetScratch(self, name, count, shape, dtype):
+        '''Returns a (count, shape) view into the calling thread's named scratch buffer, reallocating only if the buffer is too small'''
+        buffer = getattr(self._scratch, name, None)
+        if buffer is None or buffer.shape[0] < count:
+            buffer = np.empty((count,) + tuple(shape), dtype=dtype)
+            setattr(self._scratch, name, buffer)
+
+        return buffer[0:count]
+
+    def _AsStack(self, images):
+        '''Ensure the image(s) are a 3D (N, Height, Width) stack of the expected shape'''
+        if images.ndim == 2:
+            images = images[np.newaxis, :, :]
+        elif images.ndim != 3:
+            raise ValueError("PhaseCorrelator expects a 2D image or 3D image stack, got {0} dimensions".format(images.ndim))
+
+        if images.shape[1:] != self._shape:
+            raise ValueError("PhaseCorrelator: image shape {0} does not match correlator shape {1}".format(str(images.shape[1:]), str(self._shape)))
+
+        return images
+
+    def FFT(self, images):
+        '''
+        Returns the half-spectrum FFT of each image after subtracting the image's mean.
+        :param ndarray images: 2D image or 3D (N, Height, Width) stack
+        :return: (N, Height, Width // 2 + 1) complex array.  The caller owns the returned array.
+        :rtype: ndarray
+        '''
+        images = self._AsStack(images)
+        count = images.shape[0]
+
+        scratch = self._GetScratch('image', count, self._shape, self._dtype)
+
+        np.copyto(scratch, images, casting='unsafe')
+        scratch -= np.mean(scratch, axis=(1, 2), dtype=np.float64, keepdims=True).astype(self._dtype)
+
+        return scipy.fft.rfft2(scratch, axes=(1, 2))
+
+    def CorrelateFFT(self, FFTFixed, FFTMoving):
+        '''
+        Returns the phase correlation images for spectra created by FFT.  The zero offset is
+        shifted to the center of each correlation image and each image is normalized to the range 0 to 1.
+        :param ndarray FFTFixed: (N, Height, Width // 2 + 1) or (1, ...) spectra of fixed images
+        :param ndarray FFTMoving: (N, Height, Width // 2 + 1) spectra of moving images
+        :return: (N, Height, Width) correlation images
+        :rtype: ndarray
+        '''
+
+        if FFTFixed.ndim == 2:
+            FFTFixed = FFTFixed[np.newaxis, :, :]
+
+        if FFTMoving.ndim == 2:
+            FFTMoving = FFTMoving[np.newaxis, :, :]
+
+        count = max(FFTFixed.shape[0], FFTMoving.shape[0])
+        if FFTFixed.shape[1:] != self.spectrum_shape or FFTMoving.shape[1:] != self.spectrum_shape:
+            raise ValueError("PhaseCorrelator: spectrum shapes {0} and {1} do not match expected shape {2}".format(str(FFTFixed.shape), str(FFTMoving.shape), str(self.spectrum_shape)))
+
+        cross_power = self._GetScratch('spectrum', count, self.spectrum_shape, self._complex_dtype)
+        magnitude = self._GetScratch('magnitude', count, self.spectrum_shape, self._dtype)
+
+        np.conjugate(FFTFixed, out=cross_power)
+        cross_power *= FFTMoving
+        np.absolute(cross_power, out=magnitude)
+        np.divide(cross_power, magnitude, out=cross_power, where=magnitude > 0)
+
+        CorrelationImages = scipy.fft.irfft2(cross_power, s=self._shape, axes=(1, 2))
+        CorrelationImages = np.fft.fftshift(CorrelationImages, axes=(1, 2))
+
+        CorrelationImages -= np.min(CorrelationImages, axis=(1, 2), keepdims=True)
+        CorrelationImages /= np.max(CorrelationImages, axis=(1, 2), keepdims=True)
+
+        return CorrelationImages
+
+    def Correlate(self, FixedImages, MovingImages):
+        '''
+        Returns the normalized, centered phase correlation images for image pairs
+        :param ndarray FixedImages: 2D image or 3D (N, Height, Width) stack
+        :param ndarray MovingImages: 2D image or 3D (N, Height, Width) stack
+        :return: (N, Height, Width) correlation images
+        :rtype: ndarray
+        '''
+        FFTFixed = self.FFT(FixedImages)
+        FFTMoving = self.FFT(MovingImages)
+
+        return self.CorrelateFFT(FFTFixed, FFTMoving)
+
+    def FindOffsets(self, FixedImages, MovingImages, MinOverlap=0.0, MaxOverlap=1.0, FixedImageShape=None, MovingImageShape=None, FFT_Required=True, ExpectedPeak=None, PeakSearchRadius=None):
+        '''
+        Return an alignment record for each image pair describing how the images overlap.  See core.FindOffset.
+
+        :param ndarray FixedImages: 2D image or 3D (N, Height, Width) stack of images in target space
+        :param ndarray MovingImages: 2D image or 3D (N, Height, Width) stack of images in source space
+        :param float MinOverlap: The minimum amount of overlap by area the registration must have
+        :param float MaxOverlap: The maximum amount of overlap by area the registration must have
+        :param bool FFT_Required: True by default, if False the inputs are spectra returned by PhaseCorrelator.FFT
+        :param tuple FixedImageShape: Size of the fixed images before padding.  Used to calculate mask for valid overlap values.
+        :param tuple MovingImageShape: Size of the moving images before padding.  Used to calculate mask for valid overlap values.
+        :param array ExpectedPeak: If not None only peaks within PeakSearchRadius of this offset are considered
+        :param float PeakSearchRadius: Radius, in pixels, of the search window around ExpectedPeak
+        :return: List of alignment records, one for each image pair
+        :rtype: list
+        '''
+
+        if FFT_Required:
+            CorrelationImages = self.Correlate(FixedImages, MovingImages)
+        else:
+            CorrelationImages = self.CorrelateFFT(FixedImages, MovingImages)
+
+        if FixedImageShape is None:
+            FixedImageShape = self._shape
+
+        if MovingImageShape is None:
+            MovingImageShape = self._shape
+
+        OverlapMask = nornir_imageregistration.GetOverlapMask(FixedImageShape, MovingImageShape, self._shape, MinOverlap, MaxOverlap)
+        SearchMask = None
+        if ExpectedPeak is not None and PeakSearchRadius is not None:
+            SearchMask = nornir_imageregistration.overlapmasking.GetPeakSearchMask(self._shape, ExpectedPeak, PeakSearchRadius)
+
+        records = []
+        for iImage in range(CorrelationImages.shape[0]):
+            (peak, weight) = nornir_imageregistration.FindPeak(CorrelationImages[iImage], OverlapMask, SearchMask=SearchMask)
+            records.append(nornir_imageregistration.AlignmentRecord(peak=peak, weight=weight))
+
+        del CorrelationImages
+
+        return records
+
+    def FindOffset(self, FixedImage, MovingImage, MinOverlap=0.0, MaxOverlap=1.0, FixedImageShape=None, MovingImageShape=None, ExpectedPeak=None, PeakSearchRadius=None):
+        '''
+        Return an alignment record describing how a single pair of images overlap.  See core.FindOffset.
+        :rtype: AlignmentRecord
+        '''
+        return self.FindOffsets(FixedImage, MovingImage,
+                                MinOverlap=MinOverlap, MaxOverlap=MaxOverlap,
+                                FixedImageShape=FixedImageShape, MovingImageShape=MovingImageShape,
+                                ExpectedPeak=ExpectedPeak, PeakSearchRadius=PeakSearchRadius)[0]
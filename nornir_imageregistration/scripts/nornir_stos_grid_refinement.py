@@ -95,6 +95,15 @@ def __CreateArgParser(ExecArgs=None):
                         dest='min_travel_for_finalization'
                         )
     
+    parser.add_argument('-movement_cutoff', '-mc',
+                        action='store',
+                        required=False,
+                        type=float,
+                        default=0.25,
+                        help='If a cell moved by less than movement_cutoff pixels since the previous iteration its previous registration is reused instead of registering the cell again.  Zero registers every cell on every iteration.',
+                        dest='min_cell_movement'
+                        )
+    
     return parser
 
 def ParseArgs(ExecArgs=None):
@@ -136,7 +145,8 @@ def Execute(ExecArgs=None):
                    grid_spacing=Args.grid_spacing,
                    angles_to_search=Args.angles_to_search,
                    min_travel_for_finalization=Args.min_travel_for_finalization,
-                   min_alignment_overlap=Args.min_alignment_overlap)
+                   min_alignment_overlap=Args.min_alignment_overlap,
+                   min_cell_movement=Args.min_cell_movement)
     
     
     # self.assertTrue(os.path.exists(stosArgs.stosOutput), "No output stos file created")
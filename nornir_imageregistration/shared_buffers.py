@@ -0,0 +1,336 @@
+'''
+Created on Oct 18, 2026
+
+Shared memory slabs used to pass large arrays between worker processes and
+the process that created the slab without writing them to the file system.
+
+The creating process owns a SharedSlabPool.  It acquires a slab for each task,
+passes the slab's SharedSlab descriptor to the worker, and releases the slab
+back to the pool once the worker's output has been consumed.  Released slabs
+are reused by later tasks, so a long assembly creates a handful of shared
+memory blocks instead of a pair of temporary files for every tile.
+
+multiprocessing.shared_memory requires Python 3.8.  On older versions
+GetSlabPool returns None and callers fall back to temporary files.
+'''
+
+import atexit
+import collections
+import logging
+import threading
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    from multiprocessing import resource_tracker
+except ImportError:
+    shared_memory = None
+    resource_tracker = None
+
+#Byte alignment of arrays packed into a slab
+SlabAlignment = 64
+
+#Maximum number of bytes of released slabs kept for reuse by the pool
+DefaultMaxFreeBytes = 1 << 30
+
+#Maximum number of slabs a process keeps attached after using them
+MaxAttachedSlabs = 64
+
+#Slab pool of this process, created on first use by GetSlabPool
+__slab_pool = None
+
+#Shared memory blocks this process has attached, indexed by name
+_attached_slabs = collections.OrderedDict()
+_attached_slabs_lock = threading.Lock()
+
+#Names of the shared memory blocks created by pools in this process
+_created_slabs = set()
+
+
+def IsSupported():
+    '''
+    :return: True if multiprocessing.shared_memory is available
+    '''
+    return shared_memory is not None
+
+
+def GetSlabPool():
+    '''
+    :return: The SharedSlabPool for this process, or None if shared memory is not supported
+    :rtype: SharedSlabPool
+    '''
+    global __slab_pool
+
+    if not IsSupported():
+        return None
+
+    if __slab_pool is None:
+        __slab_pool = SharedSlabPool()
+        atexit.register(__slab_pool.Close)
+
+    return __slab_pool
+
+
+def AlignedSize(nbytes):
+    '''Round nbytes up to a multiple of SlabAlignment'''
+    return ((int(nbytes) + SlabAlignment - 1) // SlabAlignment) * SlabAlignment
+
+
+def PackedSize(shapes, dtypes):
+    '''
+    :return: Number of bytes needed to pack arrays of the shapes and dtypes into a slab with SlabPackedViews
+    '''
+    return sum([AlignedSize(np.prod(shape) * np.dtype(dtype).itemsize) for (shape, dtype) in zip(shapes, dtypes)])
+
+
+def SlabPackedViews(buffer, shapes, dtypes):
+    '''
+    Return ndarray views of consecutive, aligned regions of the buffer
+    :param buffer: Object supporting the buffer protocol
+    :param list shapes: Shape of each array
+    :param list dtypes: dtype of each array
+    :rtype: list
+    '''
+    views = []
+    offset = 0
+    for (shape, dtype) in zip(shapes, dtypes):
+        dtype = np.dtype(dtype)
+        views.append(np.ndarray(shape, dtype=dtype, buffer=buffer, offset=offset))
+        offset += AlignedSize(np.prod(shape) * dtype.itemsize)
+
+    return views
+
+
+def _OpenSharedMemory(name):
+    '''
+    Attach to an existing shared memory block without registering it with this process's resource tracker.
+    The tracker unlinks blocks it believes were leaked when the process exits.  A worker attaching to a
+    slab owned by another process would otherwise destroy the slab when the worker exits.
+    Callers must hold _attached_slabs_lock.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        #Python earlier than 3.13 always registers the block with the tracker
+        pass
+
+    if resource_tracker is None or name in _created_slabs:
+        return shared_memory.SharedMemory(name=name)
+
+    #Unregistering after attaching is not enough.  A spawned worker shares the tracker of the process that
+    #created the slab, so unregistering would remove the creator's registration.  Skip registering this block instead.
+    register = resource_tracker.register
+
+    def _RegisterOtherResources(resource_name, rtype):
+        if rtype == 'shared_memory' and resource_name.lstrip('/') == name.lstrip('/'):
+            return
+
+        register(resource_name, rtype)
+
+    resource_tracker.register = _RegisterOtherResources
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _Attach(name):
+    '''Return a SharedMemory object for the named slab, reusing this process's handle if the slab was attached before'''
+    global _attached_slabs
+
+    with _attached_slabs_lock:
+        shm = _attached_slabs.get(name, None)
+        if shm is not None:
+            _attached_slabs.move_to_end(name)
+            return shm
+
+        shm = _OpenSharedMemory(name)
+        _attached_slabs[name] = shm
+
+        while len(_attached_slabs) > MaxAttachedSlabs:
+            (_, evicted) = _attached_slabs.popitem(last=False)
+            try:
+                evicted.close()
+            except BufferError:
+                #An array still references the block, it is unmapped when garbage collected
+                pass
+
+        return shm
+
+
+def _Detach(name):
+    '''Forget this process's handle to the named slab'''
+    with _attached_slabs_lock:
+        _attached_slabs.pop(name, None)
+
+
+class SharedSlab(object):
+    '''
+    Picklable description of a shared memory slab
+    :param str name: Name of the shared memory block
+    :param int size: Usable size of the slab in bytes
+    '''
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def size(self):
+        return self._size
+
+    def __init__(self, name, size):
+        self._name = name
+        self._size = int(size)
+
+    def __getstate__(self):
+        return {'_name': self._name, '_size': self._size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __str__(self):
+        return "SharedSlab {0} {1} bytes".format(self._name, self._size)
+
+    def Views(self, shapes, dtypes):
+        '''
+        Attach to the slab if needed and return ndarray views of the packed arrays
+        :param list shapes: Shape of each array
+        :param list dtypes: dtype of each array
+        :rtype: list
+        '''
+        if PackedSize(shapes, dtypes) > self._size:
+            raise ValueError("Arrays do not fit in {0}".format(str(self)))
+
+        shm = _Attach(self._name)
+        return SlabPackedViews(shm.buf, shapes, dtypes)
+
+
+class SharedSlabPool(object):
+    '''
+    Allocates shared memory slabs and keeps released slabs for reuse.
+    Only the process that created the pool may acquire, release or close slabs.
+
+    :param int max_free_bytes: Released slabs beyond this many bytes are freed instead of kept for reuse
+    '''
+
+    @property
+    def num_slabs(self):
+        '''Number of slabs allocated by this pool, in use or free'''
+        return len(self._slabs)
+
+    @property
+    def num_in_use(self):
+        return len(self._in_use)
+
+    @property
+    def num_free(self):
+        return len(self._free)
+
+    @property
+    def nbytes(self):
+        '''Bytes of shared memory allocated by this pool'''
+        return sum([shm.size for shm in self._slabs.values()])
+
+    def __init__(self, max_free_bytes=None):
+
+        if not IsSupported():
+            raise NotImplementedError("multiprocessing.shared_memory is not available")
+
+        if max_free_bytes is None:
+            max_free_bytes = DefaultMaxFreeBytes
+
+        self._max_free_bytes = max_free_bytes
+        self._slabs = {}
+        self._in_use = set()
+        self._free = []
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "SharedSlabPool {0} slabs, {1} free".format(self.num_slabs, self.num_free)
+
+    def Acquire(self, nbytes):
+        '''
+        Return a slab of at least nbytes.  The smallest free slab that fits is reused if available.
+        :param int nbytes: Required size in bytes
+        :rtype: SharedSlab
+        '''
+        nbytes = AlignedSize(max(nbytes, 1))
+
+        with self._lock:
+            iBest = None
+            for (i, slab) in enumerate(self._free):
+                if slab.size >= nbytes and (iBest is None or slab.size < self._free[iBest].size):
+                    iBest = i
+
+            if iBest is not None:
+                slab = self._free.pop(iBest)
+                self._free_bytes -= slab.size
+                self._in_use.add(slab.name)
+                return slab
+
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        slab = SharedSlab(shm.name, nbytes)
+
+        with self._lock:
+            self._slabs[shm.name] = shm
+            self._in_use.add(shm.name)
+
+        with _attached_slabs_lock:
+            _attached_slabs[shm.name] = shm
+            _created_slabs.add(shm.name)
+
+        return slab
+
+    def Release(self, slab):
+        '''Return a slab to the pool.  Arrays viewing the slab must not be used afterward.  Releasing a slab that is not in use has no effect.'''
+        with self._lock:
+            if slab.name not in self._in_use:
+                return
+
+            self._in_use.remove(slab.name)
+
+            self._free.append(slab)
+            self._free_bytes += slab.size
+
+            freed = []
+            while self._free_bytes > self._max_free_bytes and len(self._free) > 0:
+                evicted = self._free.pop(0)
+                self._free_bytes -= evicted.size
+                freed.append(self._slabs.pop(evicted.name))
+
+        for shm in freed:
+            SharedSlabPool._Free(shm)
+
+    @staticmethod
+    def _Free(shm):
+        _Detach(shm.name)
+        with _attached_slabs_lock:
+            _created_slabs.discard(shm.name)
+
+        try:
+            shm.close()
+        except BufferError:
+            #An array still references the block, it is unmapped when garbage collected
+            pass
+
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.getLogger(__name__).warning("Unable to unlink shared memory {0}: {1}".format(shm.name, str(e)))
+
+    def Close(self):
+        '''Free every slab allocated by the pool'''
+        with self._lock:
+            slabs = list(self._slabs.values())
+            self._slabs.clear()
+            self._in_use.clear()
+            self._free.clear()
+            self._free_bytes = 0
+
+        for shm in slabs:
+            SharedSlabPool._Free(shm)
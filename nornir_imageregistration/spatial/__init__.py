@@ -1,11 +1,11 @@
 
-# from . import index
 import numpy as np
 
 from .boundingbox import BoundingBox 
 from .indicies import *
 from .point import *
 from .rectangle import Rectangle, RectangleSet, RaiseValueErrorOnInvalidBounds, IsValidBoundingBox
+from .index import RectangleIndex
 from numpy import arctan2
 from .converters import ArcAngle, BoundsArrayFromPoints, BoundingPrimitiveFromPoints
 
@@ -2,33 +2,191 @@
 Created on Feb 28, 2014
 
 @author: u0490822
+
+A bulk loaded R-tree over rectangles, implemented with numpy arrays.
+
+Entries are packed with the sort-tile-recursive (STR) algorithm.  Each level of
+the tree is an array of bounding boxes.  Node i of a level covers the entries
+[i * max_node_entries, (i + 1) * max_node_entries) of the level below it, so
+queries walk the tree one level at a time with vectorized bounds tests.
+
+Rectangles are represented as (MinY, MinX, MaxY, MaxX)
 '''
 
-# #import rtree.index
-#
-#
-# def CreateSpatialMap(boundingBoxes, objects):
-#     '''
-#     Given a set of bounding boxes, create an rtree index pointing at objects
-#
-#     :param list boundingBoxes: list of N tuples containing (MinX, MinY, MaxX, MaxY) bounding boxes
-#     :param list objects: list of N objects to associate with bounding boxes.  Must be same length as boundingBoxes list or None
-#
-#     rtree pickles objects inserted into the tree.  This means we cannot modify returned objects, query them later, and get the modified object.
-#     If you want that behavior store a key in the spatial index and use that key with an external dictionary or list of objects
-#     '''
-#
-#     idx = rtree.index.Index()
-#
-#     for i, bb in enumerate(boundingBoxes):
-#
-#         obj = None
-#         if objects:
-#             obj = objects[i]
-#
-#         idx.insert(i, boundingBoxes[i], obj=obj)
-#
-#     return idx
-#
-# if __name__ == '__main__':
-#     pass
+import numpy as np
+
+from .indicies import iPoint, iRect
+from .rectangle import Rectangle
+
+
+class RectangleIndex(object):
+    '''
+    Spatial index for a fixed set of rectangles.  Query results are indices into
+    the list of rectangles the index was created from.  The index does not update
+    itself, create a new index if the rectangles change.
+
+    :param ndarray bounds: Nx4 array of (MinY, MinX, MaxY, MaxX) rectangle bounds
+    :param int max_node_entries: Maximum number of children of each node in the tree
+    '''
+
+    DefaultMaxNodeEntries = 16
+
+    @property
+    def bounds(self):
+        '''Nx4 array of the rectangle bounds, in the order the rectangles were passed'''
+        return self._bounds
+
+    @property
+    def max_node_entries(self):
+        return self._max_node_entries
+
+    @property
+    def depth(self):
+        '''Number of levels in the tree, including the level of entries'''
+        return len(self._levels)
+
+    def __init__(self, bounds, max_node_entries=None):
+
+        if max_node_entries is None:
+            max_node_entries = RectangleIndex.DefaultMaxNodeEntries
+
+        if max_node_entries < 2:
+            raise ValueError("RectangleIndex nodes must have at least two entries")
+
+        bounds = np.asarray(bounds, dtype=np.float64)
+        if bounds.size == 0:
+            bounds = np.empty((0, 4), dtype=np.float64)
+
+        if bounds.ndim != 2 or bounds.shape[1] != 4:
+            raise ValueError("RectangleIndex expects an Nx4 array of rectangle bounds")
+
+        self._bounds = bounds
+        self._max_node_entries = int(max_node_entries)
+        (self._order, self._levels) = RectangleIndex._Pack(bounds, self._max_node_entries)
+
+    @classmethod
+    def Create(cls, rects, max_node_entries=None):
+        '''
+        :param list rects: Rectangle objects or (MinY, MinX, MaxY, MaxX) bounds
+        :rtype: RectangleIndex
+        '''
+        bounds = np.empty((len(rects), 4), dtype=np.float64)
+        for (i, rect) in enumerate(rects):
+            bounds[i, :] = Rectangle.PrimitiveToRectange(rect).ToArray()
+
+        return RectangleIndex(bounds, max_node_entries=max_node_entries)
+
+    def __len__(self):
+        return self._bounds.shape[0]
+
+    def __str__(self):
+        return "RectangleIndex {0} rectangles, depth {1}".format(len(self), self.depth)
+
+    @staticmethod
+    def _Pack(bounds, max_node_entries):
+        '''
+        Sort the entries into STR order and build the node levels above them
+        :return: (order, levels) where order maps packed entry position to the original index and levels[0] holds the packed entry bounds
+        '''
+        num_entries = bounds.shape[0]
+        if num_entries == 0:
+            return (np.empty(0, dtype=np.int64), [bounds])
+
+        # Slice the entries into vertical slabs by center X, then sort each slab by center Y
+        num_leaves = int(np.ceil(num_entries / max_node_entries))
+        num_slabs = int(np.ceil(np.sqrt(num_leaves)))
+        slab_size = num_slabs * max_node_entries
+
+        center_x = (bounds[:, iRect.MinX] + bounds[:, iRect.MaxX]) / 2.0
+        center_y = (bounds[:, iRect.MinY] + bounds[:, iRect.MaxY]) / 2.0
+
+        x_rank = np.empty(num_entries, dtype=np.int64)
+        x_rank[np.argsort(center_x, kind='stable')] = np.arange(num_entries)
+        slab = x_rank // slab_size
+
+        order = np.lexsort((center_y, slab))
+
+        levels = [bounds[order]]
+        while levels[-1].shape[0] > 1:
+            levels.append(RectangleIndex._NodeBounds(levels[-1], max_node_entries))
+
+        return (order, levels)
+
+    @staticmethod
+    def _NodeBounds(child_bounds, max_node_entries):
+        '''Return the bounding box of each consecutive group of max_node_entries children'''
+        starts = np.arange(0, child_bounds.shape[0], max_node_entries)
+        node_bounds = np.empty((len(starts), 4), dtype=child_bounds.dtype)
+        node_bounds[:, 0:2] = np.minimum.reduceat(child_bounds[:, 0:2], starts, axis=0)
+        node_bounds[:, 2:4] = np.maximum.reduceat(child_bounds[:, 2:4], starts, axis=0)
+        return node_bounds
+
+    def _Children(self, nodes, iChildLevel):
+        '''Return the indices of the children of nodes in the level below them'''
+        children = (nodes[:, np.newaxis] * self._max_node_entries + np.arange(self._max_node_entries)).ravel()
+        return children[children < self._levels[iChildLevel].shape[0]]
+
+    def _Query(self, test):
+        '''
+        Walk the tree from the root, descending only into nodes that pass the test
+        :param func test: Called with an Mx4 bounds array, returns a bool array of length M
+        :return: Sorted indices of the rectangles that pass the test
+        '''
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.arange(self._levels[-1].shape[0])
+        for iLevel in range(len(self._levels) - 1, -1, -1):
+            candidates = candidates[test(self._levels[iLevel][candidates])]
+            if len(candidates) == 0:
+                return np.empty(0, dtype=np.int64)
+
+            if iLevel > 0:
+                candidates = self._Children(candidates, iLevel - 1)
+
+        return np.sort(self._order[candidates])
+
+    def Intersect(self, rect):
+        '''
+        Return the rectangles that overlap the rectangle with a non-zero area.  This matches Rectangle.contains.
+        :param rect: Rectangle object or (MinY, MinX, MaxY, MaxX) bounds
+        :return: Sorted indices of overlapping rectangles
+        :rtype: ndarray
+        '''
+        (minY, minX, maxY, maxX) = Rectangle.PrimitiveToRectange(rect).ToTuple()
+
+        def overlaps(b):
+            return np.logical_and.reduce((b[:, iRect.MinY] < maxY,
+                                          b[:, iRect.MinX] < maxX,
+                                          b[:, iRect.MaxY] > minY,
+                                          b[:, iRect.MaxX] > minX))
+
+        return self._Query(overlaps)
+
+    def ContainsPoint(self, point):
+        '''
+        Return the rectangles containing the point, points on a rectangle's edge are included
+        :param tuple point: (Y,X)
+        :return: Sorted indices of rectangles containing the point
+        :rtype: ndarray
+        '''
+        y = point[iPoint.Y]
+        x = point[iPoint.X]
+
+        def contains(b):
+            return np.logical_and.reduce((b[:, iRect.MinY] <= y,
+                                          b[:, iRect.MinX] <= x,
+                                          b[:, iRect.MaxY] >= y,
+                                          b[:, iRect.MaxX] >= x))
+
+        return self._Query(contains)
+
+    def EnumerateOverlapping(self):
+        '''
+        Yield each pair of rectangles that overlap with a non-zero area once.  See RectangleSet.EnumerateOverlapping.
+        :return: (A, B) tuples of rectangle indices with A < B, in sorted order
+        '''
+        for A in range(len(self)):
+            for B in self.Intersect(self._bounds[A]):
+                if B > A:
+                    yield (A, int(B))
@@ -15,6 +15,7 @@ from numpy.fft import fftshift
  
 import nornir_pools
 import numpy as np
+import scipy.ndimage
 import scipy.ndimage.interpolation as interpolation
 
 
@@ -28,9 +29,24 @@ def SliceToSliceBruteForce(FixedImageInput,
                            MinOverlap=0.75,
                            SingleThread=False,
                            Cluster=False,
-                           TestFlip=True):
+                           TestFlip=True,
+                           FourierMellin=False,
+                           FourierMellinCandidates=3,
+                           FourierMellinAngleWindow=6,
+                           Pyramid=False,
+                           PyramidCandidates=3,
+                           PyramidMinDimension=128):
     '''Given two images this function returns the rotation angle which best aligns them
-       Largest dimension determines how large the images used for alignment should be'''
+       Largest dimension determines how large the images used for alignment should be
+       
+       :param bool FourierMellin: If true and AngleSearchRange is None, estimate candidate rotations from the log-polar
+                                  FFT magnitudes and only search angles near those candidates instead of a full circle
+       :param int FourierMellinCandidates: Number of log-polar correlation peaks to search around
+       :param float FourierMellinAngleWindow: Angles within this many degrees of a candidate are searched
+       :param bool Pyramid: If true and AngleSearchRange is None, sweep all angles on a coarse image pyramid level 
+                            and refine the best candidates at each finer level.  See PyramidAngleSearch.
+       :param int PyramidCandidates: Number of candidates refined at each pyramid level
+       :param int PyramidMinDimension: The coarsest pyramid level has a largest dimension no smaller than this value'''
 
     logger = logging.getLogger(__name__ + '.SliceToSliceBruteForce')
 
@@ -59,17 +75,37 @@ def SliceToSliceBruteForce(FixedImageInput,
     imWarped = nornir_imageregistration.ReplaceImageExtramaWithNoise(imWarped, ImageMedian=0.5, ImageStdDev=0.25)
 
     UserDefinedAngleSearchRange = not AngleSearchRange is None
+    
+    if Pyramid and not UserDefinedAngleSearchRange:
+        BestRefinedMatch = PyramidAngleSearch(imFixed, imWarped, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster, TestFlip=TestFlip,
+                                              NumCandidates=PyramidCandidates, MinDimension=PyramidMinDimension)
+        return _ScaleRecordToInputImages(BestRefinedMatch, scalar)
+    
     if not UserDefinedAngleSearchRange:
         AngleSearchRange = list(range(-180, 180, 2))
+        
+    UseFourierMellin = FourierMellin and not UserDefinedAngleSearchRange
+
+    WarpedAngleSearchRange = AngleSearchRange
+    if UseFourierMellin:
+        candidates = FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=FourierMellinCandidates)
+        WarpedAngleSearchRange = AnglesNearCandidates(candidates, FourierMellinAngleWindow)
+        logger.info("Fourier-Mellin rotation candidates: {0}".format(str(candidates)))
 
-    BestMatch = FindBestAngle(imFixed, imWarped, AngleSearchRange, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster)
+    BestMatch = FindBestAngle(imFixed, imWarped, WarpedAngleSearchRange, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster)
 
     IsFlipped = False
     if TestFlip:
         imWarpedFlipped = np.copy(imWarped)
         imWarpedFlipped = np.flipud(imWarpedFlipped)
+        
+        FlippedAngleSearchRange = AngleSearchRange
+        if UseFourierMellin:
+            candidates = FourierMellinRotationCandidates(imFixed, imWarpedFlipped, NumCandidates=FourierMellinCandidates)
+            FlippedAngleSearchRange = AnglesNearCandidates(candidates, FourierMellinAngleWindow)
+            logger.info("Fourier-Mellin flipped rotation candidates: {0}".format(str(candidates)))
     
-        BestMatchFlipped = FindBestAngle(imFixed, imWarpedFlipped, AngleSearchRange, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster)
+        BestMatchFlipped = FindBestAngle(imFixed, imWarpedFlipped, FlippedAngleSearchRange, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster)
         BestMatchFlipped.flippedud = True
 
         # Determine if the best match is flipped or not
@@ -85,17 +121,165 @@ def SliceToSliceBruteForce(FixedImageInput,
     else:
         BestRefinedMatch = BestMatch
 
+   # BestRefinedMatch.CorrectPeakForOriginalImageSize(imFixed.shape, imWarped.shape)
+
+    return _ScaleRecordToInputImages(BestRefinedMatch, scalar)
+
+
+def _ScaleRecordToInputImages(record, scalar):
     if scalar > 1.0:
-        AdjustedPeak = (BestRefinedMatch.peak[0] * scalar, BestRefinedMatch.peak[1] * scalar)
-        BestRefinedMatch = nornir_imageregistration.AlignmentRecord(AdjustedPeak, BestRefinedMatch.weight, BestRefinedMatch.angle, IsFlipped)
+        AdjustedPeak = (record.peak[0] * scalar, record.peak[1] * scalar)
+        record = nornir_imageregistration.AlignmentRecord(AdjustedPeak, record.weight, record.angle, record.flippedud)
+        
+    return record
+
+
+def PyramidAngleSearch(imFixed, imWarped, MinOverlap=0.75, SingleThread=False, Cluster=False, TestFlip=True,
+                       NumCandidates=3, MinDimension=128, CoarseAngleStep=2.0, PeakSearchRadius=8.0, FinalAngleStep=0.1):
+    '''
+    Coarse-to-fine search for the rotation and translation that best aligns two images.
+    Every angle from -180 to 180 is tested at the coarsest level of an image pyramid.  The best 
+    NumCandidates results are refined at each finer level using half the angle step of the level
+    above, searching only two steps on either side of each candidate.  Translations at finer levels
+    are restricted to PeakSearchRadius pixels around the candidate's scaled offset.
+    
+    :param int NumCandidates: Number of candidates refined at each level
+    :param int MinDimension: The coarsest level has a largest dimension no smaller than this value
+    :param float CoarseAngleStep: Angle step, in degrees, of the sweep at the coarsest level
+    :param float PeakSearchRadius: Radius, in pixels, of the translation search at finer levels
+    :param float FinalAngleStep: Angle step of the last refinement at full resolution
+    :return: The best alignment record at the resolution of the input images
+    :rtype: AlignmentRecord
+    '''
+    
+    logger = logging.getLogger(__name__ + '.PyramidAngleSearch')
+    
+    FixedPyramid = nornir_imageregistration.ImagePyramid(imFixed, MinDimension=MinDimension)
+    WarpedPyramids = {False: nornir_imageregistration.ImagePyramid(imWarped, NumLevels=FixedPyramid.NumLevels, MinDimension=1)}
+    if TestFlip:
+        WarpedPyramids[True] = nornir_imageregistration.ImagePyramid(np.flipud(imWarped), NumLevels=FixedPyramid.NumLevels, MinDimension=1)
+        
+    CoarsestLevel = min([FixedPyramid.CoarsestLevel] + [p.CoarsestLevel for p in WarpedPyramids.values()])
+    
+    search_params = {'MinOverlap': MinOverlap, 'SingleThread': SingleThread, 'Cluster': Cluster}
+    
+    CoarseAngles = list(np.arange(-180.0, 180.0, CoarseAngleStep))
+    candidates = []
+    for (flipped, WarpedPyramid) in WarpedPyramids.items():
+        records = ScoreAngles(FixedPyramid[CoarsestLevel], WarpedPyramid[CoarsestLevel], CoarseAngles, **search_params)
+        for record in records:
+            record.flippedud = flipped
+        candidates.extend(records)
+    
+    candidates = sorted(candidates, key=nornir_imageregistration.AlignmentRecord.WeightKey, reverse=True)[0:NumCandidates]
+    
+    AngleStep = CoarseAngleStep
+    for level in range(CoarsestLevel - 1, -1, -1):
+        AngleStep = AngleStep / 2.0
+        candidates = [_RefinePyramidCandidate(FixedPyramid[level], WarpedPyramids[c.flippedud][level], c, 
+                                              [c.angle + (AngleStep * i) for i in range(-2, 3)],
+                                              PeakScalar=2.0, PeakSearchRadius=PeakSearchRadius, **search_params) for c in candidates]
+        candidates = sorted(candidates, key=nornir_imageregistration.AlignmentRecord.WeightKey, reverse=True)
+        logger.info("Pyramid level {0} best: {1}".format(level, str(candidates[0])))
+        
+    BestMatch = candidates[0]
+    
+    if AngleStep > FinalAngleStep:
+        NumSteps = int(np.ceil(AngleStep / FinalAngleStep))
+        BestMatch = _RefinePyramidCandidate(FixedPyramid[0], WarpedPyramids[BestMatch.flippedud][0], BestMatch,
+                                            [BestMatch.angle + (FinalAngleStep * i) for i in range(-NumSteps, NumSteps + 1)],
+                                            PeakScalar=1.0, PeakSearchRadius=PeakSearchRadius, **search_params)
+    
+    return BestMatch
 
-   # BestRefinedMatch.CorrectPeakForOriginalImageSize(imFixed.shape, imWarped.shape)
 
-    return BestRefinedMatch
+def _RefinePyramidCandidate(imFixed, imWarped, candidate, AngleList, PeakScalar, PeakSearchRadius, **kwargs):
+    '''Returns the best record for the angles in AngleList with offsets near the candidate's peak scaled by PeakScalar'''
+    ExpectedPeak = np.asarray(candidate.peak) * PeakScalar
+    BestMatch = FindBestAngle(imFixed, imWarped, AngleList, ExpectedPeak=ExpectedPeak, PeakSearchRadius=PeakSearchRadius, **kwargs)
+    BestMatch.flippedud = candidate.flippedud
+    return BestMatch
 
 
-def ScoreOneAngle(imFixed, imWarped, FixedImageShape, WarpedImageShape, angle, fixedStats=None, warpedStats=None, FixedImagePrePadded=True, MinOverlap=0.75):
-    '''Returns an alignment score for a fixed image and an image rotated at a specified angle'''
+def _LogPolarMagnitude(image, NumAngles, NumRadii):
+    '''Resample the centered FFT magnitude of a windowed image into (NumAngles, NumRadii) log-polar space.
+       Angles cover 0 to 180 degrees because the magnitude of a real image's FFT is symmetric.'''
+    
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1])).astype(np.float32)
+    magnitude = np.abs(np.fft.fftshift(np.fft.fft2((image - np.mean(image)) * window)))
+    magnitude = np.log1p(magnitude)
+    
+    center = np.asarray(magnitude.shape, dtype=np.float64) / 2.0
+    max_radius = np.min(center) - 1
+    
+    theta = np.linspace(0, np.pi, NumAngles, endpoint=False)
+    # Skip the lowest frequencies, they describe overall brightness rather than structure
+    radii = np.exp(np.linspace(np.log(2.0), np.log(max_radius), NumRadii))
+    
+    Y = center[0] + (radii[np.newaxis, :] * np.sin(theta)[:, np.newaxis])
+    X = center[1] + (radii[np.newaxis, :] * np.cos(theta)[:, np.newaxis])
+    
+    return scipy.ndimage.map_coordinates(magnitude, [Y, X], order=1)
+
+
+def FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=3, NumAngles=360):
+    '''
+    Estimate the rotation between two images from a single phase correlation of their 
+    FFT magnitudes in log-polar space.  The FFT magnitude cannot distinguish a rotation
+    from the same rotation plus 180 degrees so both angles are returned for each peak.
+    :param int NumCandidates: Number of correlation peaks to return
+    :param int NumAngles: Number of angle samples from 0 to 180 degrees
+    :return: List of candidate angles in degrees, in the same convention as FindBestAngle, strongest peaks first
+    :rtype: list
+    '''
+    
+    Dimension = int(nornir_imageregistration.NearestPowerOfTwo(max(imFixed.shape + imWarped.shape)))
+    
+    (fixedStats, warpedStats) = GetFixedAndWarpedImageStats(imFixed, imWarped)
+    PaddedFixed = nornir_imageregistration.PadImageForPhaseCorrelation(imFixed, NewWidth=Dimension, NewHeight=Dimension, ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std, MinOverlap=1.0)
+    PaddedWarped = nornir_imageregistration.PadImageForPhaseCorrelation(imWarped, NewWidth=Dimension, NewHeight=Dimension, ImageMedian=warpedStats.median, ImageStdDev=warpedStats.std, MinOverlap=1.0)
+    
+    NumRadii = Dimension // 2
+    LogPolarFixed = _LogPolarMagnitude(PaddedFixed.astype(np.float32), NumAngles, NumRadii)
+    LogPolarWarped = _LogPolarMagnitude(PaddedWarped.astype(np.float32), NumAngles, NumRadii)
+    del PaddedFixed
+    del PaddedWarped
+    
+    correlator = nornir_imageregistration.GetPhaseCorrelator(LogPolarFixed.shape)
+    CorrelationImage = correlator.Correlate(LogPolarFixed, LogPolarWarped)[0]
+    CorrelationImage = np.fft.ifftshift(CorrelationImage)
+    
+    # Sections are not scaled between slices, so only consider a log-radius shift near zero
+    AngleProfile = np.max(CorrelationImage[:, [0, 1, -1]], axis=1)
+    
+    IsLocalMaxima = np.logical_and(AngleProfile >= np.roll(AngleProfile, 1), AngleProfile >= np.roll(AngleProfile, -1))
+    iPeaks = np.flatnonzero(IsLocalMaxima)
+    iPeaks = iPeaks[np.argsort(AngleProfile[iPeaks])[::-1]][0:NumCandidates]
+    
+    candidates = []
+    for iPeak in iPeaks:
+        angle = iPeak * (180.0 / NumAngles)
+        for candidate in (angle, angle - 180.0):
+            candidates.append(float(((candidate + 180.0) % 360.0) - 180.0))
+    
+    return candidates
+
+
+def AnglesNearCandidates(candidates, AngleWindow, AngleStep=1.0):
+    '''Returns a sorted list of angles within AngleWindow degrees of any candidate angle, spaced by AngleStep'''
+    
+    offsets = np.arange(-AngleWindow, AngleWindow + AngleStep, AngleStep)
+    angles = set()
+    for candidate in candidates:
+        for angle in candidate + offsets:
+            angles.add(round(float(((angle + 180.0) % 360.0) - 180.0), 3))
+            
+    return sorted(angles)
+
+
+def ScoreOneAngle(imFixed, imWarped, FixedImageShape, WarpedImageShape, angle, fixedStats=None, warpedStats=None, FixedImagePrePadded=True, MinOverlap=0.75, ExpectedPeak=None, PeakSearchRadius=None):
+    '''Returns an alignment score for a fixed image and an image rotated at a specified angle.
+       If ExpectedPeak and PeakSearchRadius are specified only offsets near ExpectedPeak are considered.'''
 
     imFixed = nornir_imageregistration.ImageParamToImageArray(imFixed, dtype=np.float32)
     imWarped = nornir_imageregistration.ImageParamToImageArray(imWarped, dtype=np.float32)
@@ -143,26 +327,72 @@ def ScoreOneAngle(imFixed, imWarped, FixedImageShape, WarpedImageShape, angle, f
 
     assert(PaddedFixed.shape == RotatedPaddedWarped.shape)
 
-    CorrelationImage = nornir_imageregistration.ImagePhaseCorrelation(PaddedFixed, RotatedPaddedWarped)
+    correlator = nornir_imageregistration.GetPhaseCorrelator(PaddedFixed.shape)
+    unrotated_record = correlator.FindOffset(PaddedFixed, RotatedPaddedWarped,
+                                             MinOverlap=MinOverlap, MaxOverlap=1.0,
+                                             FixedImageShape=FixedImageShape, MovingImageShape=WarpedImageShape,
+                                             ExpectedPeak=ExpectedPeak, PeakSearchRadius=PeakSearchRadius)
 
     del PaddedFixed
     del RotatedPaddedWarped
 
-    CorrelationImage = fftshift(CorrelationImage)
-    CorrelationImage -= CorrelationImage.min()
-    CorrelationImage /= CorrelationImage.max()
+    record = nornir_imageregistration.AlignmentRecord(unrotated_record.peak, unrotated_record.weight, angle)
 
-    # Timer.Start('Find Peak')
+    return record
 
-    OverlapMask = nornir_imageregistration.overlapmasking.GetOverlapMask(FixedImageShape, WarpedImageShape, CorrelationImage.shape, MinOverlap, MaxOverlap=1.0)
-    (peak, weight) = nornir_imageregistration.FindPeak(CorrelationImage, OverlapMask)
-    del OverlapMask
 
-    del CorrelationImage
+def ScoreOneAngleWithFixedSpectrum(FFTFixed, imWarped, FixedImageShape, WarpedImageShape, angle, TargetShape, warpedStats=None, MinOverlap=0.75, ExpectedPeak=None, PeakSearchRadius=None):
+    '''Returns an alignment score for a fixed image spectrum and an image rotated at a specified angle.
+       FFTFixed is the PhaseCorrelator.FFT of the fixed image padded to TargetShape.  The rotated warped image is padded
+       to TargetShape as well so only the warped FFT and cross-power are calculated.'''
 
-    record = nornir_imageregistration.AlignmentRecord(peak, weight, angle)
+    FFTFixed = nornir_imageregistration.ImageParamToImageArray(FFTFixed)
+    imWarped = nornir_imageregistration.ImageParamToImageArray(imWarped, dtype=np.float32)
 
-    return record
+    if warpedStats is None:
+        warpedStats = nornir_imageregistration.ImageStats.CalcStats(imWarped)
+
+    if angle != 0:
+        imWarped = interpolation.rotate(imWarped, axes=(1, 0), angle=angle, cval=np.nan)
+        imWarpedEmptyIndicies = np.isnan(imWarped)
+        imWarped[imWarpedEmptyIndicies] = warpedStats.GenerateNoise(np.sum(imWarpedEmptyIndicies))
+
+    RotatedPaddedWarped = nornir_imageregistration.PadImageForPhaseCorrelation(imWarped, NewWidth=TargetShape[1], NewHeight=TargetShape[0], ImageMedian=warpedStats.median, ImageStdDev=warpedStats.std, MinOverlap=1.0)
+    del imWarped
+
+    correlator = nornir_imageregistration.GetPhaseCorrelator(TargetShape)
+    FFTWarped = correlator.FFT(RotatedPaddedWarped)
+    del RotatedPaddedWarped
+
+    unrotated_record = correlator.FindOffsets(FFTFixed, FFTWarped, MinOverlap=MinOverlap, MaxOverlap=1.0,
+                                              FixedImageShape=FixedImageShape, MovingImageShape=WarpedImageShape,
+                                              FFT_Required=False,
+                                              ExpectedPeak=ExpectedPeak, PeakSearchRadius=PeakSearchRadius)[0]
+    del FFTWarped
+
+    return nornir_imageregistration.AlignmentRecord(unrotated_record.peak, unrotated_record.weight, angle)
+
+
+def _RotatedShape(shape, angle):
+    '''Returns the shape of an image after scipy.ndimage.rotate with reshape=True'''
+    rangle = np.deg2rad(angle)
+    (c, s) = (np.abs(np.cos(rangle)), np.abs(np.sin(rangle)))
+    Height = (shape[0] * c) + (shape[1] * s)
+    Width = (shape[0] * s) + (shape[1] * c)
+    return (int(Height + 0.5), int(Width + 0.5))
+
+
+def AngleSweepPaddedShape(PaddedFixedShape, WarpedImageShape, angle, MinOverlap=0.75):
+    '''Returns the (Height, Width) ScoreOneAngle pads both images to when the warped image is rotated by angle'''
+    RotatedShape = _RotatedShape(WarpedImageShape, angle)
+    
+    if angle == 0:
+        RotatedShape = tuple(WarpedImageShape)
+        
+    TargetHeight = max(PaddedFixedShape[0], nornir_imageregistration.NearestPowerOfTwoWithOverlap(RotatedShape[0], MinOverlap))
+    TargetWidth = max(PaddedFixedShape[1], nornir_imageregistration.NearestPowerOfTwoWithOverlap(RotatedShape[1], MinOverlap))
+
+    return (int(TargetHeight), int(TargetWidth))
 
 
 def GetFixedAndWarpedImageStats(imFixed, imWarped):
@@ -176,9 +406,23 @@ def GetFixedAndWarpedImageStats(imFixed, imWarped):
     return (fixedStats, warpedStats)
 
 
-def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False):
+def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False, FixedSpectrumSweep=True, ExpectedPeak=None, PeakSearchRadius=None):
     '''Find the best angle to align two images.  This function can be very memory intensive.
-       Setting SingleThread=True makes debugging easier'''
+       Setting SingleThread=True makes debugging easier
+       :param bool FixedSpectrumSweep: Pad the fixed image and calculate its FFT once for each padded size
+                                       the sweep requires.  Workers then only calculate the FFT of the rotated warped image.
+       :param array ExpectedPeak: If not None only offsets within PeakSearchRadius of ExpectedPeak are considered
+       :param float PeakSearchRadius: Radius of the translation search window around ExpectedPeak'''
+    
+    AngleMatchValues = ScoreAngles(imFixed, imWarped, AngleList, MinOverlap=MinOverlap, SingleThread=SingleThread, Cluster=Cluster,
+                                   FixedSpectrumSweep=FixedSpectrumSweep, ExpectedPeak=ExpectedPeak, PeakSearchRadius=PeakSearchRadius)
+
+    BestMatch = max(AngleMatchValues, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+    return BestMatch
+
+
+def ScoreAngles(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=False, Cluster=False, FixedSpectrumSweep=True, ExpectedPeak=None, PeakSearchRadius=None):
+    '''Returns an alignment record for every angle in AngleList.  See FindBestAngle for parameters.'''
 
     Debug = False
     pool = None
@@ -212,33 +456,68 @@ def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=Fa
     PaddedFixed = nornir_imageregistration.PadImageForPhaseCorrelation(imFixed, MinOverlap=MinOverlap, ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std)
 
     # Create a shared read-only memory map for the Padded fixed image
+    UseSharedMemory = not (Cluster or SingleThread)
+    temp_files = []
 
-    if not (Cluster or SingleThread):
-        temp_padded_fixed_memmap = nornir_imageregistration.CreateTemporaryReadonlyMemmapFile(PaddedFixed)
+    if UseSharedMemory:
         temp_shared_warp_memmap = nornir_imageregistration.CreateTemporaryReadonlyMemmapFile(imWarped)
-
-        temp_padded_fixed_memmap.mode = 'r' #We do not want functions we pass the memmap modifying the original data
         temp_shared_warp_memmap.mode = 'r' #We do not want functions we pass the memmap modifying the original data
+        temp_files.append(temp_shared_warp_memmap.path)
+        SharedWarped = temp_shared_warp_memmap
 
         # SharedPaddedFixed = nornir_imageregistration.npArrayToReadOnlySharedArray(PaddedFixed)
         # SharedWarped = nornir_imageregistration.npArrayToReadOnlySharedArray(imWarped)
         # SharedPaddedFixed = np.save(PaddedFixed, )
     else:
-        SharedPaddedFixed = PaddedFixed
         SharedWarped = imWarped
 
+    # For each angle determine the fixed image parameter and score function to pass to the worker 
+    AngleTaskParams = {}
+    if FixedSpectrumSweep:
+        # Most angles in a sweep share one or two padded sizes.  Calculate the fixed spectrum once for each size.
+        SharedSpectrums = {}
+        for theta in AngleList:
+            TargetShape = AngleSweepPaddedShape(PaddedFixed.shape, imWarped.shape, theta, MinOverlap=MinOverlap)
+            if TargetShape not in SharedSpectrums:
+                TargetPaddedFixed = nornir_imageregistration.PadImageForPhaseCorrelation(PaddedFixed, NewWidth=TargetShape[1], NewHeight=TargetShape[0], ImageMedian=fixedStats.median, ImageStdDev=fixedStats.std, MinOverlap=1.0)
+                FFTFixed = nornir_imageregistration.GetPhaseCorrelator(TargetShape).FFT(TargetPaddedFixed)
+                del TargetPaddedFixed
+                
+                if UseSharedMemory:
+                    temp_fft_memmap = nornir_imageregistration.CreateTemporaryReadonlyMemmapFile(FFTFixed)
+                    temp_fft_memmap.mode = 'r'
+                    temp_files.append(temp_fft_memmap.path)
+                    del FFTFixed
+                    FFTFixed = temp_fft_memmap
+                    
+                SharedSpectrums[TargetShape] = FFTFixed
+                
+            AngleTaskParams[theta] = (ScoreOneAngleWithFixedSpectrum, SharedSpectrums[TargetShape], {'TargetShape': TargetShape, 'warpedStats': warpedStats, 'MinOverlap': MinOverlap, 'ExpectedPeak': ExpectedPeak, 'PeakSearchRadius': PeakSearchRadius})
+    else:
+        SharedPaddedFixed = PaddedFixed
+        if UseSharedMemory:
+            temp_padded_fixed_memmap = nornir_imageregistration.CreateTemporaryReadonlyMemmapFile(PaddedFixed)
+            temp_padded_fixed_memmap.mode = 'r' #We do not want functions we pass the memmap modifying the original data
+            temp_files.append(temp_padded_fixed_memmap.path)
+            SharedPaddedFixed = temp_padded_fixed_memmap
+            
+        for theta in AngleList:
+            AngleTaskParams[theta] = (ScoreOneAngle, SharedPaddedFixed, {'fixedStats': fixedStats, 'warpedStats': warpedStats, 'MinOverlap': MinOverlap, 'ExpectedPeak': ExpectedPeak, 'PeakSearchRadius': PeakSearchRadius})
+
     CheckTaskInterval = 16
 
     fixed_shape = imFixed.shape
     warped_shape = imWarped.shape
 
     for i, theta in enumerate(AngleList):
+        
+        (ScoreFunction, SharedFixed, ScoreKwargs) = AngleTaskParams[theta]
 
         if SingleThread:
-            record = ScoreOneAngle(SharedPaddedFixed, SharedWarped, fixed_shape, warped_shape, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap)
+            record = ScoreFunction(SharedFixed, SharedWarped, fixed_shape, warped_shape, theta, **ScoreKwargs)
             AngleMatchValues.append(record)
         else:
-            task = pool.add_task(str(theta), ScoreOneAngle, temp_padded_fixed_memmap, temp_shared_warp_memmap, fixed_shape, warped_shape, theta, fixedStats=fixedStats, warpedStats=warpedStats, MinOverlap=MinOverlap)
+            task = pool.add_task(str(theta), ScoreFunction, SharedFixed, SharedWarped, fixed_shape, warped_shape, theta, **ScoreKwargs)
             taskList.append(task)
 
         if not i % CheckTaskInterval == 0:
@@ -281,15 +560,160 @@ def FindBestAngle(imFixed, imWarped, AngleList, MinOverlap=0.75, SingleThread=Fa
         pool.wait_completion()
 
     del PaddedFixed
+    del AngleTaskParams
+
+    for path in temp_files:
+        os.remove(path)
+
+    return AngleMatchValues
+
+
+def _StackStats(images):
+    ''':return: (median, std, min, max) of each image in a (N, Height, Width) stack as (N,1,1) float32 arrays'''
+    flat = images.reshape((images.shape[0], -1))
+    stats = (np.median(flat, axis=1), np.std(flat, axis=1, dtype=np.float64),
+             np.min(flat, axis=1), np.max(flat, axis=1))
+    return tuple(np.asarray(stat, dtype=np.float32).reshape((-1, 1, 1)) for stat in stats)
+
+
+def _StackNoise(rng, count, median, std, min_val, max_val):
+    '''
+    (N, count) noise for each image of a stack, clipped to that image's range.  See core.GenRandomData
+    :param Generator rng: Source of random numbers
+    :param ndarray median: (N,1) or scalar values, as are std, min_val and max_val
+    '''
+    noise = rng.standard_normal((len(min_val), count), dtype=np.float32)
+    noise *= std
+    noise += median
+    np.clip(noise, min_val, max_val, out=noise)
+    return noise
+
+
+def _ReplaceStackExtremaWithNoise(rng, images, ImageMedian, ImageStdDev):
+    '''Stack version of core.ReplaceImageExtramaWithNoise'''
+    images = images.copy()
+    for image in images:
+        (min_val, max_val) = (image.min(), image.max())
+        extrema = np.logical_or(image == min_val, image == max_val)
+        noise = rng.standard_normal(np.count_nonzero(extrema), dtype=np.float32)
+        noise *= ImageStdDev
+        noise += ImageMedian
+        image[extrema] = np.clip(noise, min_val, max_val)
+        
+    return images
 
-    if not (Cluster or SingleThread):
-        os.remove(temp_shared_warp_memmap.path)
-        os.remove(temp_padded_fixed_memmap.path)
-        # del SharedPaddedFixed
-        # del SharedWarped
 
-    BestMatch = max(AngleMatchValues, key=nornir_imageregistration.AlignmentRecord.WeightKey)
-    return BestMatch
+def _FillStackNaNsWithNoise(rng, images, median, std, min_val, max_val):
+    '''Stack version of filling the empty rotated pixels with ImageStats.GenerateNoise'''
+    (iImage, iY, iX) = np.nonzero(np.isnan(images))
+    (median, std, min_val, max_val) = (median.flat[iImage], std.flat[iImage], min_val.flat[iImage], max_val.flat[iImage])
+    
+    noise = rng.standard_normal(iImage.shape[0], dtype=np.float32)
+    noise *= std
+    noise += median
+    noise = np.where(np.logical_and(noise < min_val, median - (std * 2) < min_val), min_val, noise)
+    noise = np.where(np.logical_and(noise > max_val, median + (std * 2) > max_val), max_val, noise)
+    images[iImage, iY, iX] = noise
+    return images
+
+
+def _PadStackForPhaseCorrelation(rng, images, NewShape, median, std, Offset=None):
+    '''
+    Stack version of core.PadImageForPhaseCorrelation.  Each image is centered in noise matching its statistics.
+    :param tuple Offset: (Y,X) position of the images in the padded images, centered if None
+    '''
+    (Height, Width) = images.shape[1:]
+    NewShape = tuple(NewShape)
+    
+    if NewShape == (Height, Width):
+        return images
+    
+    if Offset is None:
+        Offset = ((NewShape[0] - Height) // 2, (NewShape[1] - Width) // 2)
+    
+    Border = np.ones(NewShape, dtype=bool)
+    Border[Offset[0]:Offset[0] + Height, Offset[1]:Offset[1] + Width] = False
+    
+    (min_val, max_val) = (np.min(images, axis=(1, 2)), np.max(images, axis=(1, 2)))
+    PaddedImages = np.empty((images.shape[0],) + NewShape, dtype=np.float32)
+    PaddedImages[:, Border] = _StackNoise(rng, np.count_nonzero(Border), median.reshape((-1, 1)), std.reshape((-1, 1)),
+                                          min_val.reshape((-1, 1)), max_val.reshape((-1, 1)))
+    PaddedImages[:, Offset[0]:Offset[0] + Height, Offset[1]:Offset[1] + Width] = images
+    return PaddedImages
+
+
+def SliceToSliceBruteForceStack(FixedImages, WarpedImages, AngleSearchRange, MinOverlap=0.75):
+    '''
+    Align each pair of images in two stacks of equally sized images.  Equivalent to calling SliceToSliceBruteForce 
+    with TestFlip=False for each pair, but rotation, padding, FFT and cross-power are calculated for the entire stack
+    at each angle.
+    :param ndarray FixedImages: (N, Height, Width) stack of fixed images
+    :param ndarray WarpedImages: (N, Height, Width) stack of warped images
+    :param list AngleSearchRange: Angles, in degrees, to test
+    :param float MinOverlap: The minimum amount of overlap by area the registration must have
+    :return: The best AlignmentRecord for each pair
+    :rtype: list
+    '''
+    
+    FixedImages = np.asarray(FixedImages, dtype=np.float32)
+    WarpedImages = np.asarray(WarpedImages, dtype=np.float32)
+    
+    if FixedImages.ndim != 3 or FixedImages.shape[0] != WarpedImages.shape[0]:
+        raise ValueError("SliceToSliceBruteForceStack expects two (N, Height, Width) stacks, got {0} and {1}".format(str(FixedImages.shape), str(WarpedImages.shape)))
+    
+    # Draw noise from a generator seeded by numpy's global state so np.random.seed still reproduces results
+    rng = np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+    
+    FixedImages = _ReplaceStackExtremaWithNoise(rng, FixedImages, ImageMedian=0.5, ImageStdDev=0.25)
+    WarpedImages = _ReplaceStackExtremaWithNoise(rng, WarpedImages, ImageMedian=0.5, ImageStdDev=0.25)
+    
+    fixed_shape = FixedImages.shape[1:]
+    warped_shape = WarpedImages.shape[1:]
+    
+    (fixed_median, fixed_std, _, _) = _StackStats(FixedImages)
+    (warped_median, warped_std, warped_min, warped_max) = _StackStats(WarpedImages)
+    
+    # ScoreAngles pads the fixed image for the overlap first, then pads the result to the size needed by each angle
+    PaddedFixedShape = (int(nornir_imageregistration.NearestPowerOfTwoWithOverlap(fixed_shape[0], MinOverlap)),
+                        int(nornir_imageregistration.NearestPowerOfTwoWithOverlap(fixed_shape[1], MinOverlap)))
+    
+    BestMatches = [None] * FixedImages.shape[0]
+    FixedSpectrums = {}
+    
+    # Calculate the spline coefficients of the warped images once instead of once per angle
+    WarpedCoefficients = None
+    if np.any(np.asarray(AngleSearchRange) != 0):
+        WarpedCoefficients = scipy.ndimage.spline_filter1d(WarpedImages, order=3, axis=1, mode='constant', output=np.float64)
+        WarpedCoefficients = scipy.ndimage.spline_filter1d(WarpedCoefficients, order=3, axis=2, mode='constant', output=np.float64)
+    
+    for theta in AngleSearchRange:
+        TargetShape = AngleSweepPaddedShape(PaddedFixedShape, warped_shape, theta, MinOverlap=MinOverlap)
+        correlator = nornir_imageregistration.GetPhaseCorrelator(TargetShape)
+        
+        FFTFixed = FixedSpectrums.get(TargetShape, None)
+        if FFTFixed is None:
+            Offset = tuple(((PaddedFixedShape[i] - fixed_shape[i]) // 2) + ((TargetShape[i] - PaddedFixedShape[i]) // 2) for i in range(2))
+            FFTFixed = correlator.FFT(_PadStackForPhaseCorrelation(rng, FixedImages, TargetShape, fixed_median, fixed_std, Offset=Offset))
+            FixedSpectrums[TargetShape] = FFTFixed
+        
+        RotatedWarped = WarpedImages
+        if theta != 0:
+            RotatedWarped = interpolation.rotate(WarpedCoefficients, axes=(2, 1), angle=theta, cval=np.nan, prefilter=False, output=np.float32)
+            RotatedWarped = _FillStackNaNsWithNoise(rng, RotatedWarped, warped_median, warped_std, warped_min, warped_max)
+        
+        FFTWarped = correlator.FFT(_PadStackForPhaseCorrelation(rng, RotatedWarped, TargetShape, warped_median, warped_std))
+        del RotatedWarped
+        
+        records = correlator.FindOffsets(FFTFixed, FFTWarped, MinOverlap=MinOverlap, MaxOverlap=1.0,
+                                         FixedImageShape=fixed_shape, MovingImageShape=warped_shape,
+                                         FFT_Required=False)
+        del FFTWarped
+        
+        for (i, record) in enumerate(records):
+            if BestMatches[i] is None or record.weight > BestMatches[i].weight:
+                BestMatches[i] = nornir_imageregistration.AlignmentRecord(record.peak, record.weight, theta)
+    
+    return BestMatches
 
 
 def __ExecuteProfiler():
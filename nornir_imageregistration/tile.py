@@ -7,6 +7,7 @@ Created on Feb 21, 2014
 import logging
 import os 
 import nornir_imageregistration 
+import nornir_imageregistration.image_cache
 import numpy as np
 
 
@@ -77,31 +78,24 @@ class Tile(object):
 
     @property
     def Image(self):
+        '''The tile's image.  The array is shared through the image cache and is read-only'''
         if self._image is None:
-            self._image = nornir_imageregistration.LoadImage(self._imagepath)
+            self._image = nornir_imageregistration.image_cache.LoadImageCached(self._imagepath)
         
         return self._image
         
-    @property
-    def PaddedImage(self):
-        if self._paddedimage is None:
-            self._paddedimage = nornir_imageregistration.PadImageForPhaseCorrelation(self.Image)
-
-        return self._paddedimage
-
     @property
     def ImagePath(self):
         return self._imagepath
-
-    @property
-    def FFTImage(self):
-        if self._fftimage is None:
-            self._fftimage = np.fft.rfft2(self.PaddedImage)
-
-        return self._fftimage
     
-    def PrecalculateImages(self):
-        temp = self.FFTImage.shape
+    def PrecalculateImages(self, spill_dir=None):
+        '''
+        Decode the tile's image into the image cache and write its spill file so workers in this and 
+        other processes memory-map the decoded pixels instead of decoding the image file again.
+        :param str spill_dir: Image cache spill directory shared by the processes of this run
+        :return: Shape of the tile's image
+        '''
+        return nornir_imageregistration.image_cache.LoadImageCached(self._imagepath, spill_dir=spill_dir, spill=True).shape
 
     @property
     def ID(self):
@@ -158,8 +152,6 @@ class Tile(object):
         self._transform = transform
         self._imagepath = imagepath
         self._image = None
-        self._paddedimage = None
-        self._fftimage = None
 
         if ID is None:
             self._ID = Tile.__nextID
@@ -181,8 +173,6 @@ class Tile(object):
     def __setstate__(self, dictionary):         
         self.__dict__.update(dictionary)
         self._image = None
-        self._paddedimage = None
-        self._fftimage = None
 
     def __repr__(self):
         return "%d: %s" % (self._ID, self._imagepath)
@@ -6,9 +6,9 @@ def _IterateOverlappingTiles(list_tiles, min_overlap=None):
     '''Return all tiles which overlap'''
     
     list_rects = [tile.FixedBoundingBox for tile in list_tiles]        
-    rset = nornir_imageregistration.RectangleSet.Create(list_rects)
+    rindex = nornir_imageregistration.RectangleIndex.Create(list_rects)
     
-    for (A, B) in rset.EnumerateOverlapping():
+    for (A, B) in rindex.EnumerateOverlapping():
         if min_overlap is None:
             yield (list_tiles[A], list_tiles[B])
         elif nornir_imageregistration.Rectangle.overlap(list_rects[A], list_rects[B]) > min_overlap:
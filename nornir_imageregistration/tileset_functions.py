@@ -9,17 +9,28 @@ moving it to the final output directory.  This saves trips over the network as
 we build the pyramid, which tends to be slow for sometimes hundreds of thousands 
 of small files.  This also helps the image I/O, which at this time is implemented
 by pillow as lots of small I/O requests against the image file. 
+
+BuildTilePyramid builds every level in one pass from tiles held in memory,
+without reading the previous level back from disk.
 '''
 
+import collections
 import numpy
 from PIL import Image
 import threading
 import tempfile
 import os
 import shutil
+import nornir_imageregistration
 import nornir_pools
 #import nornir_shared.prettyoutput as prettyoutput
 
+#zlib compression level, 0-9, of the PNG tiles written by BuildTilePyramid.  Higher levels write smaller files more slowly.
+DefaultPNGCompressLevel = 1
+
+#Filename of the tile at a row and column of a pyramid level
+DefaultTileNameFormat = 'X{column:03d}_Y{row:03d}.png'
+
 def ClearTempDirectories(level_paths):
     '''Deletes temporary directories used to generate levels'''
     
@@ -148,9 +159,10 @@ def CreateOneTilesetTileWithPillowOverNetwork(TileDims, TopLeft, TopRight, Botto
 #    thread.run()       
     
 
-def CreateOneTilesetTileWithPillow(TileDims, TopLeft, TopRight, BottomLeft, BottomRight, OutputFileFullPath ):
+def CreateOneTilesetTileWithPillow(TileDims, TopLeft, TopRight, BottomLeft, BottomRight, OutputFileFullPath, compress_level=None):
     '''Create a single tile by merging four tiles from a higher resolution and downsampling
-    :param tuple TileDims: (Height, Width) of tiles'''
+    :param tuple TileDims: (Height, Width) of tiles
+    :param int compress_level: zlib compression level of the PNG.  If None the PNG is optimized, which is slow.'''
     
     TileSize = numpy.asarray((TileDims[1], TileDims[0]), dtype=numpy.int64) #Pillow uses the opposite ordering of axis
     DoubleTileSize = TileSize * 2 #Double the size 
@@ -196,7 +208,10 @@ def CreateOneTilesetTileWithPillow(TileDims, TopLeft, TopRight, BottomLeft, Bott
     if imComposite is not None:    
         with imComposite.resize(imTopLeft.size, resample=Image.LANCZOS) as imFinal:
             try:  
-                imFinal.save(OutputFileFullPath, optimize=True) 
+                if compress_level is None:
+                    imFinal.save(OutputFileFullPath, optimize=True)
+                else:
+                    imFinal.save(OutputFileFullPath, compress_level=compress_level)
             except FileExistsError:
                 pass
             
@@ -205,5 +220,157 @@ def CreateOneTilesetTileWithPillow(TileDims, TopLeft, TopRight, BottomLeft, Bott
     return 
     
 
+def DownsampleTileQuad(TileDims, TopLeft, TopRight, BottomLeft, BottomRight):
+    '''Merge four uint8 tiles from a higher resolution and downsample them to a single tile, as CreateOneTilesetTileWithPillow does for files.
+    :param tuple TileDims: (Height, Width) of tiles
+    :param ndarray TopLeft: Tile image, or None if the tile is outside the grid
+    :return: Downsampled uint8 tile
+    '''
+    (Height, Width) = (int(TileDims[0]), int(TileDims[1]))
+    composite = numpy.zeros((Height * 2, Width * 2), dtype=numpy.uint8)
+    
+    for (tile, iRow, iColumn) in ((TopLeft, 0, 0), (TopRight, 0, 1), (BottomLeft, 1, 0), (BottomRight, 1, 1)):
+        if tile is not None:
+            composite[iRow * Height:(iRow + 1) * Height, iColumn * Width:(iColumn + 1) * Width] = tile
+            
+    with Image.fromarray(composite) as imComposite:
+        with imComposite.resize((Width, Height), resample=Image.LANCZOS) as imFinal:
+            return numpy.array(imFinal)
+        
+
+def SavePyramidTile(image, OutputFileFullPath, compress_level=None):
+    '''Save a uint8 tile as a PNG
+    :param int compress_level: zlib compression level, defaults to DefaultPNGCompressLevel'''
+    
+    if compress_level is None:
+        compress_level = DefaultPNGCompressLevel
+        
+    with Image.fromarray(image) as im:
+        im.save(OutputFileFullPath, compress_level=compress_level)
+        
+        
+def CreatePyramidTile(TileDims, children, OutputFileFullPath, compress_level=None):
+    '''Downsample four child tiles into a tile of the next level and save it.  See DownsampleTileQuad.
+    :param list children: [TopLeft, TopRight, BottomLeft, BottomRight] tile images or None
+    :return: The downsampled tile, used to build the next level'''
+    
+    image = DownsampleTileQuad(TileDims, *children)
+    SavePyramidTile(image, OutputFileFullPath, compress_level)
+    return image
+
+
+def PyramidGridShapes(grid_dims, num_levels):
+    '''
+    :param tuple grid_dims: (Rows, Columns) of tiles in the full resolution level
+    :return: (Rows, Columns) of tiles in each level, each level is half the resolution of the previous
+    '''
+    shapes = [(int(grid_dims[0]), int(grid_dims[1]))]
+    while len(shapes) < num_levels:
+        (rows, columns) = shapes[-1]
+        shapes.append(((rows + 1) // 2, (columns + 1) // 2))
+        
+    return shapes
+
+
+def BuildTilePyramid(tiles, grid_dims, level_paths, tile_dims=None, pool=None, compress_level=None, tile_name_format=None):
+    '''
+    Save full resolution tiles and every lower resolution level of the pyramid in one pass.
+    
+    A tile of the next level is queued on the pool as soon as its four children are available.  Workers return the
+    downsampled tile, which is held in memory until its own parent is queued, so no level is read back from disk.
+    Tiles arriving in scanline order, as Mosaic.GenerateOptimizedTiles yields them, keep about two rows of tiles
+    per level in memory.
+    
+    :param tiles: Iterable of (iRow, iColumn, image) for the full resolution level, such as Mosaic.GenerateOptimizedTiles
+    :param tuple grid_dims: (Rows, Columns) of tiles in the full resolution level
+    :param list level_paths: Output directory for each level, starting with the full resolution level
+    :param tuple tile_dims: (Height, Width) of tiles, defaults to the shape of the first tile
+    :param pool: Pool the tiles are encoded and downsampled on, defaults to the global multithreading pool
+    :param int compress_level: zlib compression level of the PNG tiles, defaults to DefaultPNGCompressLevel
+    :param str tile_name_format: Format of tile filenames with row and column fields, defaults to DefaultTileNameFormat
+    :return: (Rows, Columns) of tiles in each level
+    '''
+    
+    if pool is None:
+        pool = nornir_pools.GetGlobalMultithreadingPool()
+        
+    if compress_level is None:
+        compress_level = DefaultPNGCompressLevel
+        
+    if tile_name_format is None:
+        tile_name_format = DefaultTileNameFormat
+        
+    num_levels = len(level_paths)
+    shapes = PyramidGridShapes(grid_dims, num_levels)
+    
+    for level_path in level_paths:
+        os.makedirs(level_path, exist_ok=True)
+    
+    #Children collected for each level's tiles, keyed by (row, column) of the tile in that level
+    pending = [{} for iLevel in range(num_levels)]
+    
+    #Tasks creating lower resolution tiles, in the order they were queued
+    downsample_tasks = collections.deque()
+    save_tasks = collections.deque()
+    
+    def TilePath(iLevel, iRow, iColumn):
+        return os.path.join(level_paths[iLevel], tile_name_format.format(row=iRow, column=iColumn))
+    
+    def AddTile(iLevel, iRow, iColumn, image):
+        '''Record a tile of iLevel and queue its parent if all of the parent's children are now available'''
+        iParentLevel = iLevel + 1
+        if iParentLevel >= num_levels:
+            return
+        
+        parent = (iRow // 2, iColumn // 2)
+        (rows, columns) = shapes[iLevel]
+        num_children = (min(rows, parent[0] * 2 + 2) - parent[0] * 2) * (min(columns, parent[1] * 2 + 2) - parent[1] * 2)
+        
+        children = pending[iParentLevel].setdefault(parent, [None] * 4)
+        children[(iRow % 2) * 2 + (iColumn % 2)] = image
+        if sum(child is not None for child in children) == num_children:
+            QueueTile(iParentLevel, parent)
+            
+    def QueueTile(iLevel, tile):
+        '''Queue creation of a tile from the children collected for it'''
+        children = pending[iLevel].pop(tile)
+        task = pool.add_task("Pyramid tile {0} {1}".format(iLevel, tile),
+                             CreatePyramidTile, tile_dims, children, TilePath(iLevel, tile[0], tile[1]), compress_level)
+        task.pyramid_tile = (iLevel, tile[0], tile[1])
+        downsample_tasks.append(task)
+        
+    def CollectCompletedTasks(wait=False):
+        '''Add tiles from finished downsample tasks to the next level.  If wait is true wait for all queued tasks.'''
+        while len(downsample_tasks) > 0 and (wait or downsample_tasks[0].iscompleted):
+            task = downsample_tasks.popleft()
+            (iLevel, iRow, iColumn) = task.pyramid_tile
+            AddTile(iLevel, iRow, iColumn, task.wait_return())
+            
+        while len(save_tasks) > 0 and (wait or save_tasks[0].iscompleted):
+            save_tasks.popleft().wait_return()
+    
+    for (iRow, iColumn, image) in tiles:
+        #Convert to 8-bit once, as SaveImage does, and keep the result to build the next level
+        image = nornir_imageregistration.core._Image_To_Uint8(image)
+        if tile_dims is None:
+            tile_dims = image.shape
+            
+        save_tasks.append(pool.add_task("Pyramid tile 0 {0}".format((iRow, iColumn)),
+                                        SavePyramidTile, image, TilePath(0, iRow, iColumn), compress_level))
+        AddTile(0, iRow, iColumn, image)
+        CollectCompletedTasks()
+        
+    CollectCompletedTasks(wait=True)
+    
+    #Tiles missing from the input leave tiles in lower levels incomplete, create them from the children that exist
+    for iLevel in range(1, num_levels):
+        for tile in sorted(pending[iLevel].keys()):
+            QueueTile(iLevel, tile)
+            
+        CollectCompletedTasks(wait=True)
+    
+    return shapes
+    
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
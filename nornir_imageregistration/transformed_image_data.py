@@ -3,7 +3,7 @@ Created on Jul 18, 2019
 
 @author: u0490822
 
-A helper class to marshal large images using the file system instead of in-memory. 
+A helper class to marshal large images using the file system or shared memory instead of in-memory. 
 '''
 import os
 import tempfile
@@ -11,10 +11,13 @@ import numpy as np
 import nornir_pools
 import logging
 
+import nornir_imageregistration.shared_buffers as shared_buffers
+
 
 class TransformedImageData(object):
     '''
-    Returns data from multiprocessing thread processes.  Uses memory mapped files when there is too much data for pickle to be efficient
+    Returns data from multiprocessing thread processes.  Uses memory mapped files when there is too much data for pickle to be efficient.
+    If the caller passes a shared memory slab the images are written into the slab instead and read in place by the caller.
     '''
 
     memmap_threshold = 64 * 64
@@ -42,6 +45,10 @@ class TransformedImageData(object):
     @property
     def image(self):
         if self._image is None:
+            if self._shared_slab is not None:
+                self._AttachSharedSlab()
+                return self._image
+            
             if self._image_path is None:
                 return None 
              
@@ -52,6 +59,10 @@ class TransformedImageData(object):
     @property
     def centerDistanceImage(self):
         if self._centerDistanceImage is None:
+            if self._shared_slab is not None:
+                self._AttachSharedSlab()
+                return self._centerDistanceImage
+            
             if self._centerDistanceImage_path is None:
                 return None
             
@@ -82,8 +93,16 @@ class TransformedImageData(object):
             
         return self._tempdir
 
+    @property
+    def shared_slab(self):
+        '''The SharedSlab holding the images, None if the images are not in shared memory'''
+        return self._shared_slab
+
     @classmethod
-    def Create(cls, image, centerDistanceImage, transform, source_space_scale, target_space_scale, SingleThreadedInvoke):
+    def Create(cls, image, centerDistanceImage, transform, source_space_scale, target_space_scale, SingleThreadedInvoke, shared_slab=None):
+        '''
+        :param SharedSlab shared_slab: Optional slab to copy the images into.  Temporary files are used if the images do not fit or the slab cannot be attached.
+        '''
         o = TransformedImageData()
         o._image = image
         o._centerDistanceImage = centerDistanceImage
@@ -95,10 +114,43 @@ class TransformedImageData(object):
         #o._transform = transform
         
         if not SingleThreadedInvoke:
-            o.ConvertToMemmapIfLarge()
+            if shared_slab is None or not o.CopyToSharedSlab(shared_slab):
+                o.ConvertToMemmapIfLarge()
         
         return o
     
+    def CopyToSharedSlab(self, shared_slab, dtype=np.float16):
+        '''
+        Copy the images into the shared slab, converting to dtype.  
+        :return: True if the images were copied, False if they do not fit or the slab is not available
+        '''
+        shapes = (self._image.shape, self._centerDistanceImage.shape)
+        dtypes = (dtype, dtype)
+        if shared_buffers.PackedSize(shapes, dtypes) > shared_slab.size:
+            return False
+        
+        try:
+            (image_view, distance_view) = shared_slab.Views(shapes, dtypes)
+        except (OSError, ValueError) as e:
+            logging.getLogger(__name__).warning("Unable to attach {0}, using temporary files: {1}".format(str(shared_slab), str(e)))
+            return False
+        
+        np.copyto(image_view, self._image, casting='unsafe')
+        np.copyto(distance_view, self._centerDistanceImage, casting='unsafe')
+        del image_view
+        del distance_view
+        
+        self._shared_slab = shared_slab
+        self._shared_shapes = shapes
+        self._shared_dtype = np.dtype(dtype)
+        self._image = None
+        self._centerDistanceImage = None
+        return True
+    
+    def _AttachSharedSlab(self):
+        (self._image, self._centerDistanceImage) = self._shared_slab.Views(self._shared_shapes,
+                                                                          (self._shared_dtype, self._shared_dtype))
+    
     def ConvertToMemmapIfLarge(self): 
         if np.prod(self._image.shape) > TransformedImageData.memmap_threshold:
             self._image_path = self.CreateMemoryMappedFilesForImage("Image", self._image)
@@ -136,6 +188,9 @@ class TransformedImageData(object):
         self._target_space_scale = None
         self._transform = None
         
+        #The caller that acquired the slab releases it back to its pool
+        self._shared_slab = None
+        
         if not self._centerDistanceImage_path is None or not self._image_path is None:
             pool = nornir_pools.GetGlobalMultithreadingPool()
             pool.add_task(self._image_path, TransformedImageData._RemoveTempFiles, self._centerDistanceImage_path, self._image_path, self._tempdir)
@@ -175,6 +230,9 @@ class TransformedImageData(object):
         self._image_path = None
         self._centerDistanceImage_path = None
         self._tempdir = None
+        self._shared_slab = None
+        self._shared_shapes = None
+        self._shared_dtype = None
         #self._image_shape = None
         #self._centerDistanceImage_shape = None
         #self._image_dtype = None
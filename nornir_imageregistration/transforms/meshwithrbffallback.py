@@ -156,6 +156,27 @@ class MeshWithRBFFallback(triangulation.Triangulation):
         TransformedPoints[InvalidIndicies] = FixedPoints
         return TransformedPoints
 
+    def InverseCoordinateMap(self, botleft, area, **kwargs):
+        '''
+        Map every pixel of a fixed space region to warped space, see Triangulation.InverseCoordinateMap.
+        Only pixels outside the convex hull of the control points are passed to the RBF transform.
+        
+        :param bool extrapolate: Set to false if pixels falling outside the convex hull of control points should be NaN
+        '''
+        
+        coord_map = super(MeshWithRBFFallback, self).InverseCoordinateMap(botleft, area)
+        extrapolate = kwargs.get('extrapolate', True)
+        if not extrapolate:
+            return coord_map
+        
+        invalid = numpy.isnan(coord_map).any(axis=2)
+        if not numpy.any(invalid):
+            return coord_map
+        
+        BadPoints = numpy.argwhere(invalid).astype(numpy.float32) + numpy.asarray(botleft, dtype=numpy.float32)
+        coord_map[invalid] = self.ReverseRBFInstance.Transform(BadPoints)
+        return coord_map
+
     def __init__(self, pointpairs):
         '''
         Constructor
@@ -21,6 +21,9 @@ from . import utils
 
 class RBFWithLinearCorrection(triangulation.Triangulation):
 
+    # InverseTransform does not interpolate within the triangles, so the regions cannot be rasterized
+    InverseCoordinateMap = None
+
     def __getstate__(self):
         odict = super(RBFWithLinearCorrection, self).__getstate__()
 
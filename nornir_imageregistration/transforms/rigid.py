@@ -25,6 +25,10 @@ class RigidNoRotation(base.Base):
         mapped_corners = self.InverseTransform(rect.Corners)
         return Rectangle.CreateBoundingRectangleForPoints(mapped_corners)
     
+    @property
+    def angle(self):
+        return self._angle
+    
     @property
     def MappedBoundingBox(self):
         if self._mapped_bounding_box is None:
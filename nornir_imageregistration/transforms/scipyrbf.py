@@ -6,6 +6,7 @@ Created on Oct 18, 2012
 
 import math
 
+import nornir_imageregistration
 from nornir_imageregistration.spatial import iPoint
 from nornir_imageregistration.transforms import triangulation
 import numpy
@@ -19,6 +20,9 @@ from . import utils
 
 class ScipyRbf(triangulation.Triangulation):
 
+    # InverseTransform does not interpolate within the triangles, so the regions cannot be rasterized
+    InverseCoordinateMap = None
+
     def __getstate__(self):
         odict = super(ScipyRbf, self).__getstate__()
 
@@ -68,7 +72,7 @@ class ScipyRbf(triangulation.Triangulation):
         self._ReverseRbfiY = None
 
 
-    def Transform(self, Points, MaxChunkSize=65536):
+    def Transform(self, Points, MaxChunkSize=65536, **kwargs):
 
         Points = nornir_imageregistration.EnsurePointsAre2DNumpyArray(Points)
 
@@ -103,7 +107,7 @@ class ScipyRbf(triangulation.Triangulation):
 
             return transformedData
 
-    def InverseTransform(self, Points):
+    def InverseTransform(self, Points, **kwargs):
 
         Points = nornir_imageregistration.EnsurePointsAre2DNumpyArray(Points)
 
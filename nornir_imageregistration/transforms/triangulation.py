@@ -134,6 +134,193 @@ def _AddAndEnrichTransforms(BToC_Unaltered_Transform, AToB_mapped_Transform, eps
         return AToB_mapped_Transform
 
 
+def AffineTriangleMatrices(from_points, to_points, simplices):
+    '''
+    Solve the affine transform of each triangle
+    :param ndarray from_points: Nx2 array of (Y,X) points the triangles are defined in
+    :param ndarray to_points: Nx2 array of (Y,X) points the triangles map onto
+    :param ndarray simplices: Tx3 array of point indices for each triangle
+    :return: Tx3x2 array of matrices, [Y X 1] * matrix maps a point inside the triangle.  Degenerate triangles are NaN.
+    :rtype: ndarray
+    '''
+    from_tris = np.concatenate((from_points[simplices], np.ones((simplices.shape[0], 3, 1))), axis=2)
+    to_tris = to_points[simplices].astype(np.float64)
+
+    matrices = np.full((simplices.shape[0], 3, 2), np.nan)
+    valid = np.abs(np.linalg.det(from_tris)) > 1e-9
+    if np.any(valid):
+        matrices[valid] = np.linalg.solve(from_tris[valid], to_tris[valid])
+
+    return matrices
+
+
+def RasterizeTriangles(vertices, matrices, botleft, shape):
+    '''
+    Evaluate each triangle's affine transform at the pixels the triangle covers.
+    Each row of each triangle is a scanline span the transform is linear along, so the transform is only
+    evaluated at the ends of spans and no per-pixel point location search is needed.
+    The triangles must tile a convex region without overlapping, such as a Delaunay triangulation.
+    :param ndarray vertices: Tx3x2 array of (Y,X) triangle vertices
+    :param ndarray matrices: Tx3x2 affine matrices from AffineTriangleMatrices
+    :param 1x2_array botleft: The (Y,X) coordinates of pixel [0,0] of the region
+    :param 1x2_array shape: The (Height, Width) of the region
+    :return: (Height, Width, 2) float32 array of mapped coordinates, NaN for pixels outside every triangle
+    :rtype: ndarray
+    '''
+    epsilon = 1e-6
+    shape = (int(shape[0]), int(shape[1]))
+    coord_map = np.full((shape[0], shape[1], 2), np.nan, dtype=np.float32)
+    if coord_map.size == 0 or matrices.shape[0] == 0:
+        return coord_map
+
+    # Vertices relative to the region so pixel [r,c] is at (r,c)
+    vertices = vertices - np.asarray(botleft, dtype=np.float64)
+
+    minY = np.min(vertices[:, :, 0], axis=1)
+    maxY = np.max(vertices[:, :, 0], axis=1)
+    firstRow = np.maximum(np.ceil(minY - epsilon), 0).astype(np.int64)
+    lastRow = np.minimum(np.floor(maxY + epsilon), shape[0] - 1).astype(np.int64)
+
+    inRegion = np.logical_and.reduce((lastRow >= firstRow,
+                                      np.max(vertices[:, :, 1], axis=1) >= -epsilon,
+                                      np.min(vertices[:, :, 1], axis=1) <= shape[1] - 1 + epsilon,
+                                      ~np.isnan(matrices[:, 0, 0])))
+    iTris = np.flatnonzero(inRegion)
+    if len(iTris) == 0:
+        return coord_map
+
+    # One entry for each row of each triangle
+    numRows = lastRow[iTris] - firstRow[iTris] + 1
+    spanTri = np.repeat(iTris, numRows)
+    spanRow = np.repeat(firstRow[iTris] - np.cumsum(numRows) + numRows, numRows) + np.arange(np.sum(numRows))
+    y = spanRow.astype(np.float64)
+
+    # Find where the row crosses each edge of the triangle
+    spanMinX = np.full(len(spanTri), np.inf)
+    spanMaxX = np.full(len(spanTri), -np.inf)
+    tris = vertices[spanTri]
+    for (iA, iB) in ((0, 1), (1, 2), (2, 0)):
+        A = tris[:, iA, :]
+        B = tris[:, iB, :]
+        dY = B[:, 0] - A[:, 0]
+        crosses = np.logical_and(np.minimum(A[:, 0], B[:, 0]) - epsilon <= y, np.maximum(A[:, 0], B[:, 0]) + epsilon >= y)
+        crosses = np.logical_and(crosses, dY != 0)
+        x = A[crosses, 1] + (y[crosses] - A[crosses, 0]) * (B[crosses, 1] - A[crosses, 1]) / dY[crosses]
+        spanMinX[crosses] = np.minimum(spanMinX[crosses], x)
+        spanMaxX[crosses] = np.maximum(spanMaxX[crosses], x)
+
+    firstCol = np.maximum(np.ceil(spanMinX - epsilon), 0)
+    lastCol = np.minimum(np.floor(spanMaxX + epsilon), shape[1] - 1)
+    keep = lastCol >= firstCol
+    if not np.any(keep):
+        return coord_map
+
+    spanTri = spanTri[keep]
+    spanStart = spanRow[keep] * shape[1] + firstCol[keep].astype(np.int64)
+    spanEnd = spanRow[keep] * shape[1] + lastCol[keep].astype(np.int64) + 1
+
+    # Evaluate the affine transform at both ends of every span
+    M = matrices[spanTri]
+    spanY = y[keep][:, np.newaxis] + botleft[0]
+    xStart = firstCol[keep][:, np.newaxis] + botleft[1]
+    xEnd = lastCol[keep][:, np.newaxis] + botleft[1]
+    startValues = spanY * M[:, 0, :] + xStart * M[:, 1, :] + M[:, 2, :]
+    endValues = spanY * M[:, 0, :] + xEnd * M[:, 1, :] + M[:, 2, :]
+
+    # The map is linear along each span, so pixels are interpolated between the span ends.
+    # Spans of neighboring triangles can share an edge pixel, keep one value for each pixel.
+    (knots, iUnique) = np.unique(np.concatenate((spanStart, spanEnd - 1)), return_index=True)
+    knotValues = np.concatenate((startValues, endValues))[iUnique]
+
+    # The triangles cover a convex region, so the covered pixels of each row are one interval
+    numPixels = shape[0] * shape[1]
+    knotRows = knots // shape[1]
+    (rows, iFirstKnot) = np.unique(knotRows, return_index=True)
+    iLastKnot = np.append(iFirstKnot[1:], len(knots)) - 1
+    rowFirst = np.full(shape[0], numPixels, dtype=np.int64)
+    rowLast = np.full(shape[0], -1, dtype=np.int64)
+    rowFirst[rows] = knots[iFirstKnot]
+    rowLast[rows] = knots[iLastKnot]
+
+    pixels = np.arange(numPixels).reshape(shape)
+    covered = np.logical_and(pixels >= rowFirst[:, np.newaxis], pixels <= rowLast[:, np.newaxis])
+    for iAxis in range(2):
+        coord_map[:, :, iAxis] = np.where(covered, np.interp(pixels, knots, knotValues[:, iAxis]), np.nan)
+
+    return coord_map
+
+
+# Attributes of a Delaunay triangulation that are rebuilt on demand or restored from the transform's points
+_DelaunayDerivedAttributes = frozenset(('_qhull', '_points', '_vertices', '_transform', '_vertex_to_simplex', '_vertex_neighbor_vertices'))
+
+# Names of the attributes DelaunayState keeps for the installed scipy, False if scipy's layout is not supported.  Set on first use.
+_DelaunayLayout = None
+
+
+def _GetDelaunayLayout():
+    '''
+    Pickled triangulations rely on scipy's private Delaunay attributes.  Inspect a small triangulation once
+    so a scipy release that changes them falls back to rebuilding triangulations instead of failing.
+    :return: frozenset of the attribute names DelaunayState keeps, or None if the layout is not supported
+    '''
+    global _DelaunayLayout
+    if _DelaunayLayout is None:
+        _DelaunayLayout = False
+        try:
+            tri = scipy.spatial.Delaunay(np.asarray(((0, 0), (0, 1), (1, 0), (1, 1)), dtype=np.float64), incremental=False)
+            attributes = frozenset(tri.__dict__.keys())
+            if _DelaunayDerivedAttributes.issubset(attributes) and 'simplices' in attributes:
+                _DelaunayLayout = attributes - _DelaunayDerivedAttributes
+        except (AttributeError, TypeError):
+            pass
+
+    if _DelaunayLayout is False:
+        return None
+
+    return _DelaunayLayout
+
+
+def DelaunayState(tri):
+    '''
+    Compact form of a Delaunay triangulation for pickling.  Only the arrays describing the triangles (simplices, 
+    neighbors, equations, ...) are kept, the points are expected to be stored with the transform.
+    :param Delaunay tri: A triangulation built with incremental=False, or None
+    :return: Dictionary of the triangulation's arrays, or None if the triangulation cannot be serialized
+    '''
+    if tri is None or not hasattr(tri, '__dict__') or getattr(tri, '_qhull', None) is not None:
+        return None
+    
+    layout = _GetDelaunayLayout()
+    if layout is None:
+        return None
+    
+    return {key: value for (key, value) in tri.__dict__.items() if key in layout}
+
+
+def RestoreDelaunay(points, state):
+    '''
+    Recreate a Delaunay triangulation from DelaunayState without running qhull
+    :param ndarray points: Nx2 points the triangulation was built from
+    :param dict state: Result of DelaunayState
+    :return: Delaunay triangulation, or None if the state does not match the installed scipy and the triangulation must be rebuilt
+    '''
+    layout = _GetDelaunayLayout()
+    if layout is None or not isinstance(state, dict) or frozenset(state.keys()) != layout:
+        return None
+    
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    simplices = np.asarray(state['simplices'])
+    if simplices.ndim != 2 or simplices.shape[1] != 3 or (simplices.size > 0 and simplices.max() >= points.shape[0]):
+        return None
+    
+    tri = scipy.spatial.Delaunay.__new__(scipy.spatial.Delaunay)
+    tri.__dict__.update(state)
+    tri.__dict__.update(dict.fromkeys(_DelaunayDerivedAttributes))
+    tri._points = points
+    tri._vertices = tri.simplices
+    return tri
+    
+
 class Triangulation(Base):
     '''
     Triangulation transform has an nx4 array of points, with rows organized as
@@ -143,13 +330,27 @@ class Triangulation(Base):
     def __getstate__(self):
         odict = {}
         odict['_points'] = self._points
+        
+        # Send the triangulations along so the receiver does not have to rebuild them
+        odict['_fixedtri'] = DelaunayState(self._fixedtri)
+        odict['_warpedtri'] = DelaunayState(self._warpedtri)
 
         return odict
 
     def __setstate__(self, dictionary):
+        fixedtri_state = dictionary.pop('_fixedtri', None)
+        warpedtri_state = dictionary.pop('_warpedtri', None)
+        
         self.__dict__.update(dictionary)
         self.OnChangeEventListeners = []
         self.OnTransformChanged()
+        
+        # Triangulations that cannot be restored are left as None and rebuilt when first used
+        if fixedtri_state is not None:
+            self._fixedtri = RestoreDelaunay(self.TargetPoints, fixedtri_state)
+            
+        if warpedtri_state is not None:
+            self._warpedtri = RestoreDelaunay(self.SourcePoints, warpedtri_state)
 
     @classmethod
     def FindDuplicates(cls, points, new_points):
@@ -252,6 +453,14 @@ class Triangulation(Base):
 
         return self._warpedtri
     
+    @property
+    def InverseAffineMatrices(self):
+        '''Affine matrices mapping each fixed space triangle onto warped space, see AffineTriangleMatrices'''
+        if self._InverseAffineMatrices is None:
+            self._InverseAffineMatrices = AffineTriangleMatrices(self.TargetPoints, self.SourcePoints, self.fixedtri.simplices)
+
+        return self._InverseAffineMatrices
+
     @property
     def NumControlPoints(self):
         if self._points is None:
@@ -325,6 +534,18 @@ class Triangulation(Base):
 
         return transPoints
 
+    def InverseCoordinateMap(self, botleft, area, **kwargs):
+        '''
+        Map every pixel of a fixed space region to warped space.  Equivalent to calling InverseTransform on
+        every pixel, but the mapping is affine within each triangle so pixels are filled one triangle at a time.
+        :param 1x2_array botleft: The (Y,X) coordinates of the bottom left corner
+        :param 1x2_array area: The (Height, Width) of the region of interest
+        :return: (Height, Width, 2) float32 array of (Y,X) warped space coordinates, NaN outside the convex hull of the control points
+        :rtype: ndarray
+        '''
+        simplices = self.fixedtri.simplices
+        return RasterizeTriangles(self.TargetPoints[simplices], self.InverseAffineMatrices, botleft, area)
+
     def FindDuplicateFixedPoints(self, new_points, epsilon=0):
         '''Using our control point KDTree, ensure the new points are not duplicates
         :return: An index array of duplicates
@@ -451,6 +672,7 @@ class Triangulation(Base):
         self._FixedBoundingBox = None
         self._ForwardInterpolator = None
         self._InverseInterpolator = None
+        self._InverseAffineMatrices = None
 
         super(Triangulation, self).OnTransformChanged()
 
@@ -460,6 +682,7 @@ class Triangulation(Base):
         self._warpedtri = None
         self._ForwardInterpolator = None
         self._InverseInterpolator = None
+        self._InverseAffineMatrices = None
 
         super(Triangulation, self).OnTransformChanged()
 
@@ -479,6 +702,7 @@ class Triangulation(Base):
         self._MappedBoundingBox = None
         self._ForwardInterpolator = None
         self._InverseInterpolator = None
+        self._InverseAffineMatrices = None
 
     def NearestFixedPoint(self, points):
         '''Return the fixed points nearest to the query points
@@ -697,6 +921,7 @@ class Triangulation(Base):
         self._FixedKDTree = None
         self._FixedBoundingBox = None
         self._MappedBoundingBox = None 
+        self._InverseAffineMatrices = None
 
     @classmethod
     def load(cls, variableParams, fixedParams):
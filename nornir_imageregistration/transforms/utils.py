@@ -4,8 +4,32 @@ Created on Apr 4, 2013
 @author: u0490822
 '''
 
+import hashlib
+import pickle
+
 import nornir_imageregistration
 import numpy as np
+
+
+def TransformChecksum(transform):
+    '''
+    :return: A checksum of the transform's type and control points.  Transforms without control points use their pickled state.
+             Cached state, such as triangulations, does not change the checksum.
+    :rtype: str
+    '''
+    checksum = hashlib.sha1()
+    checksum.update((type(transform).__module__ + '.' + type(transform).__name__).encode())
+    
+    points = getattr(transform, 'points', None)
+    if points is None:
+        checksum.update(pickle.dumps(transform, protocol=4))
+    else:
+        points = np.ascontiguousarray(points)
+        checksum.update(str((points.shape, points.dtype.str)).encode())
+        checksum.update(points.tobytes())
+        
+    return checksum.hexdigest()
+
  
 def InvalidIndicies(points):
     '''Removes rows with a NAN value and returns a list of indicies'''
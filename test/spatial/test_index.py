@@ -0,0 +1,62 @@
+'''
+Created on Oct 18, 2026
+
+@author: u0490822
+'''
+import unittest
+
+import nornir_imageregistration.spatial as spatial
+import numpy as np
+
+
+class Test(unittest.TestCase):
+
+    def CreateRandomRectangles(self, num_rects, seed=0):
+        rng = np.random.RandomState(seed)
+        origins = rng.uniform(0, 1000, size=(num_rects, 2))
+        areas = rng.uniform(1, 100, size=(num_rects, 2))
+        return [spatial.Rectangle.CreateFromPointAndArea(origins[i], areas[i]) for i in range(num_rects)]
+
+    def testIntersect(self):
+        rects = self.CreateRandomRectangles(500)
+        rindex = spatial.RectangleIndex.Create(rects, max_node_entries=4)
+        self.assertGreater(rindex.depth, 2)
+
+        queries = self.CreateRandomRectangles(100, seed=1)
+        for query in queries:
+            expected = [i for (i, r) in enumerate(rects) if spatial.Rectangle.contains(r, query)]
+            found = rindex.Intersect(query)
+            self.assertEqual(expected, list(found), "Index should return the same rectangles as a brute force search")
+
+    def testContainsPoint(self):
+        rects = self.CreateRandomRectangles(200)
+        rindex = spatial.RectangleIndex.Create(rects)
+
+        rng = np.random.RandomState(2)
+        for point in rng.uniform(0, 1000, size=(100, 2)):
+            expected = [i for (i, r) in enumerate(rects) if np.all(r.BottomLeft <= point) and np.all(r.TopRight >= point)]
+            self.assertEqual(expected, list(rindex.ContainsPoint(point)))
+
+        # Points on an edge are contained
+        self.assertTrue(0 in rindex.ContainsPoint(rects[0].BottomLeft))
+
+    def testEnumerateOverlapping(self):
+        rects = self.CreateRandomRectangles(200)
+        rindex = spatial.RectangleIndex.Create(rects)
+        rset = spatial.RectangleSet.Create(rects)
+
+        expected = sorted(rset.EnumerateOverlapping())
+        found = list(rindex.EnumerateOverlapping())
+        self.assertEqual(expected, found, "Index should find the same overlapping pairs as RectangleSet")
+
+    def testEmpty(self):
+        rindex = spatial.RectangleIndex.Create([])
+        self.assertEqual(len(rindex), 0)
+        self.assertEqual(len(rindex.Intersect((0, 0, 10, 10))), 0)
+        self.assertEqual(len(rindex.ContainsPoint((0, 0))), 0)
+        self.assertEqual(len(list(rindex.EnumerateOverlapping())), 0)
+
+
+if __name__ == "__main__":
+    # import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -6,6 +6,7 @@ Created on Mar 21, 2013
 import logging
 import os
 import unittest
+from unittest import mock
 
 from nornir_imageregistration import alignment_record
 import nornir_imageregistration
@@ -16,6 +17,8 @@ import nornir_imageregistration.core as core
 import nornir_imageregistration.scripts.nornir_rotate_translate
 import nornir_imageregistration.stos_brute as stos_brute
 import nornir_shared.images as images
+import numpy as np
+import scipy.ndimage
 
 from . import setup_imagetest
 
@@ -200,6 +203,95 @@ class TestStosBrute(setup_imagetest.ImageTestBase):
 
 
 
+class TestAngleSearch(setup_imagetest.ImageTestBase):
+    
+    @classmethod
+    def CreateRotatedPair(cls, angle, sigma=2):
+        '''Returns a fixed image and the same texture, smoothed by sigma, rotated by angle degrees about the fixed image center'''
+        rng = np.random.RandomState(0)
+        texture = scipy.ndimage.gaussian_filter(rng.rand(384, 384), sigma).astype(np.float32)
+        texture = (texture - texture.min()) / (texture.max() - texture.min())
+        
+        rotated = scipy.ndimage.rotate(texture, angle, reshape=False, order=1)
+        return (texture[64:320, 64:320], rotated[64:320, 64:320])
+    
+    def testFourierMellinCandidatesIncludeTrueAngle(self):
+        '''The Fourier-Mellin candidates and the angles searched around them should include the angle that undoes the rotation'''
+        
+        for rotation in (30.0, -75.0, 132.0):
+            (imFixed, imWarped) = self.CreateRotatedPair(rotation)
+            # FindBestAngle reports the angle applied to the warped image, which undoes the rotation
+            expected_angle = -rotation
+            
+            candidates = stos_brute.FourierMellinRotationCandidates(imFixed, imWarped, NumCandidates=3)
+            self.assertEqual(len(candidates), 6, "Each peak should be returned with its 180 degree twin")
+            self.assertLessEqual(np.min(np.abs(np.asarray(candidates) - expected_angle)), 1.0,
+                                 "Candidates %s should include %g" % (str(candidates), expected_angle))
+            
+            search_range = stos_brute.AnglesNearCandidates(candidates, AngleWindow=6)
+            self.assertLess(len(search_range), 180, "Searching near candidates should test fewer angles than the full circle")
+            self.assertLessEqual(np.min(np.abs(np.asarray(search_range) - expected_angle)), 0.5)
+    
+    def testFixedSpectrumSweepMatchesScoreOneAngle(self):
+        '''Reusing the fixed image spectrum across a sweep should score each angle exactly as ScoreOneAngle does'''
+        
+        (imFixed, imWarped) = self.CreateRotatedPair(30.0)
+        # Use a smaller warped image so the images are padded to different shapes
+        imWarped = imWarped[16:236, 0:240]
+        
+        # The two paths draw padding noise in a different order.  Pad with the image median instead so both see identical images.
+        CreateStats = nornir_imageregistration.ImageStats.Create
+        def NoiselessStats(image):
+            stats = CreateStats(image)
+            stats.std = 0
+            return stats
+        
+        AngleList = [float(a) for a in range(-180, 180, 15)] + [-31.0, -30.0, -29.0]
+        with mock.patch.object(nornir_imageregistration.ImageStats, 'CalcStats', staticmethod(NoiselessStats)):
+            sweep_records = stos_brute.ScoreAngles(imFixed, imWarped, AngleList, SingleThread=True, FixedSpectrumSweep=True)
+            records = stos_brute.ScoreAngles(imFixed, imWarped, AngleList, SingleThread=True, FixedSpectrumSweep=False)
+        
+        self.assertEqual([r.angle for r in sweep_records], AngleList)
+        self.assertEqual([r.angle for r in records], AngleList)
+        for (sweep_record, record) in zip(sweep_records, records):
+            np.testing.assert_array_equal(sweep_record.peak, record.peak, err_msg="Peaks differ at angle %g" % record.angle)
+            self.assertAlmostEqual(sweep_record.weight, record.weight, delta=1e-6 * abs(record.weight),
+                                   msg="Weights differ at angle %g" % record.angle)
+        
+        sweep_best = max(sweep_records, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+        best = max(records, key=nornir_imageregistration.AlignmentRecord.WeightKey)
+        self.assertEqual(sweep_best.angle, best.angle)
+        self.assertAlmostEqual(best.angle, -30.0, delta=1.0)
+    
+    def testPyramidSearchMatchesFullSearch(self):
+        '''The coarse-to-fine pyramid search should recover the rotation and offset found by the full angle sweep'''
+        
+        for rotation in (30.0, -100.0):
+            (imFixed, imWarped) = self.CreateRotatedPair(rotation, sigma=4)
+            imWarped = imWarped[16:236, 0:240]
+            
+            np.random.seed(0)
+            full = stos_brute.SliceToSliceBruteForce(imFixed, imWarped, SingleThread=True, TestFlip=False)
+            np.random.seed(0)
+            pyramid = stos_brute.SliceToSliceBruteForce(imFixed, imWarped, SingleThread=True, TestFlip=True,
+                                                        Pyramid=True, PyramidMinDimension=64)
+            
+            self.assertFalse(pyramid.flippedud)
+            self.assertAlmostEqual(pyramid.angle, -rotation, delta=1.5)
+            self.assertAlmostEqual(pyramid.angle, full.angle, delta=1.0, msg="Pyramid angle %g should match full search angle %g" % (pyramid.angle, full.angle))
+            np.testing.assert_allclose(pyramid.peak, full.peak, atol=1.0)
+    
+    def testAnglesNearCandidatesWrap(self):
+        '''Angles near a candidate should wrap into the -180 to 180 range without duplicates'''
+        
+        angles = stos_brute.AnglesNearCandidates([178.0, -179.0], AngleWindow=3)
+        self.assertEqual(angles, sorted(set(angles)))
+        self.assertTrue(all(-180.0 <= a < 180.0 for a in angles))
+        self.assertIn(-178.0, angles)
+        self.assertIn(175.0, angles)
+        self.assertEqual(len(angles), 10)
+
+
 class TestStosBruteToSameImage(setup_imagetest.ImageTestBase):
 
 #    def testSameSimpleImage(self):
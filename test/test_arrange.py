@@ -6,6 +6,8 @@ Created on Dec 13, 2013
 
 import glob
 import os
+import shutil
+import tempfile
 import unittest
 
 import matplotlib
@@ -16,6 +18,7 @@ import nornir_imageregistration.layout
 from nornir_imageregistration.mosaic import Mosaic
 import nornir_imageregistration.mosaic
 from scipy import stats
+import scipy.ndimage
 from scipy.misc import imsave
 
 import nornir_imageregistration.arrange_mosaic as arrange
@@ -98,6 +101,84 @@ class TestBasicTileAlignment(setup_imagetest.TransformTestBase):
         # self.assertAlmostEqual(alignrecord.peak[0], ExpectedOffset[0], delta=2, msg="Y dimension incorrect: " + str(alignrecord.peak) + " != " + str(ExpectedOffset))
 
 
+class TestOverlapStrips(unittest.TestCase):
+    '''Overlap strips and spectra cached for TranslateTiles2 tile alignment'''
+
+    def setUp(self):
+        self.TempPath = tempfile.mkdtemp(prefix='test_overlap_strips_')
+
+        rng = np.random.RandomState(0)
+        image = scipy.ndimage.gaussian_filter(rng.rand(128, 192), 2)
+        image = ((image - image.min()) * (255.0 / (image.max() - image.min()))).astype(np.uint8)
+
+        #Two tiles overlapping by 64 columns, positioned exactly where the stage reported them
+        self.ImagePathA = os.path.join(self.TempPath, 'A.png')
+        self.ImagePathB = os.path.join(self.TempPath, 'B.png')
+        core.SaveImage(self.ImagePathA, image[:, 0:128])
+        core.SaveImage(self.ImagePathB, image[:, 64:192])
+
+        self.OverlapRectA = nornir_imageregistration.Rectangle.CreateFromPointAndArea((0, 64), (128, 64))
+        self.OverlapRectB = nornir_imageregistration.Rectangle.CreateFromPointAndArea((0, 0), (128, 64))
+
+    def tearDown(self):
+        nornir_imageregistration.image_cache.GetImageCache().Clear()
+        shutil.rmtree(self.TempPath, ignore_errors=True)
+
+    def testStripIsDeterministic(self):
+        image = core.LoadImage(self.ImagePathA)
+        strip_rect = arrange._OverlapStripRect(self.OverlapRectA, excess_scalar=3.0)
+
+        stripA = arrange._CreateOverlapStrip(image, strip_rect, seed=1)
+        stripB = arrange._CreateOverlapStrip(image, strip_rect, seed=1)
+        np.testing.assert_array_equal(stripA, stripB, "Strips with the same seed must be identical")
+
+        #The strip extends past the tile, pixels inside the tile are copied and the rest are noise within the tile's range 
+        (Yo, Xo) = strip_rect.BottomLeft.astype(np.int64)
+        inside = stripA[-Yo:-Yo + image.shape[0], -Xo:-Xo + image.shape[1]]
+        np.testing.assert_array_equal(inside, image)
+        self.assertGreaterEqual(stripA.min(), image.min())
+        self.assertLessEqual(stripA.max(), image.max())
+
+    def testCachedSpectraMatchFindOffset(self):
+        cache = nornir_imageregistration.image_cache.GetImageCache()
+
+        strip_rect_A = arrange._OverlapStripRect(self.OverlapRectA, excess_scalar=3.0)
+        strip_rect_B = arrange._OverlapStripRect(self.OverlapRectB, excess_scalar=3.0)
+
+        stripA = arrange._GetOverlapStrip(self.ImagePathA, strip_rect_A)
+        stripB = arrange._GetOverlapStrip(self.ImagePathB, strip_rect_B)
+        FFT_A = arrange._GetOverlapStripFFT(self.ImagePathA, strip_rect_A)
+        FFT_B = arrange._GetOverlapStripFFT(self.ImagePathB, strip_rect_B)
+
+        correlator = nornir_imageregistration.GetPhaseCorrelator(stripA.shape)
+        record = correlator.FindOffsets(FFT_A, FFT_B, FFT_Required=False)[0]
+        expected = core.FindOffset(stripA, stripB)
+
+        np.testing.assert_allclose(record.peak, expected.peak, atol=1e-3)
+        self.assertAlmostEqual(record.weight, expected.weight, delta=1e-3)
+        np.testing.assert_allclose(record.peak, (0, 0), atol=1.0)
+
+        #Later requests for the same strip are answered from the cache
+        misses = cache.misses
+        arrange._GetOverlapStripFFT(self.ImagePathA, strip_rect_A)
+        arrange._GetOverlapStrip(self.ImagePathA, strip_rect_A)
+        self.assertEqual(cache.misses, misses)
+
+    def testFeatureScoresPrepareStrips(self):
+        cache = nornir_imageregistration.image_cache.GetImageCache()
+
+        params = [arrange.TileOverlapDetails(overlap_ID=(0, 1), iTile=0, overlapping_rect=self.OverlapRectA)]
+        scores = arrange._CalculateTileFeatures(self.ImagePathA, params)
+        cache.Clear()
+
+        strip_scores = arrange._CalculateTileFeatures(self.ImagePathA, params, excess_scalar=3.0)
+        self.assertEqual(scores[0].feature_score, strip_scores[0].feature_score, "Preparing strips must not change the feature score")
+
+        misses = cache.misses
+        arrange._GetOverlapStripFFT(self.ImagePathA, arrange._OverlapStripRect(self.OverlapRectA, excess_scalar=3.0))
+        self.assertEqual(cache.misses, misses, "Scoring should have prepared the strip spectrum")
+
+
 class TestMosaicArrange(setup_imagetest.TransformTestBase, setup_imagetest.PickleHelper):
 
     @property
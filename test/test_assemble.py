@@ -13,6 +13,7 @@ from scipy.misc import imsave
 from scipy.ndimage import interpolation
 
 import nornir_imageregistration.assemble as assemble 
+import nornir_imageregistration.coordinate_map_cache as coordinate_map_cache
 import nornir_imageregistration.spatial as spatial
 import nornir_shared.images as images
 
@@ -88,6 +89,95 @@ class TestTransformROI(setup_imagetest.ImageTestBase):
         self.assertAlmostEqual(min(points[:, spatial.iPoint.X]), 0, delta=0.01)
         self.assertAlmostEqual(max(points[:, spatial.iPoint.X]), 1, delta=0.01)
 
+    def test_coordinate_map_cache(self):
+        '''Cached and upsampled coordinate maps should match transforming every pixel'''
+        
+        # A gently warped grid of control points, the region extends past the grid so some pixels cannot be mapped
+        (g_y, g_x) = numpy.meshgrid(numpy.linspace(0, 200, 5), numpy.linspace(0, 200, 5), indexing='ij')
+        warped_points = numpy.vstack((g_y.flat, g_x.flat)).transpose()
+        fixed_points = warped_points + numpy.sin(warped_points[:, ::-1] / 50.0) * 3
+        transform = nornir_imageregistration.transforms.triangulation.Triangulation(numpy.hstack((fixed_points, warped_points)))
+        
+        botleft = (10, 20)
+        area = (230, 190)
+        (expected_fixed, expected_warped) = assemble.DestinationROI_to_SourceROI(transform, botleft, area)
+        
+        cache = coordinate_map_cache.CoordinateMapCache()
+        for i in range(2):
+            (fixedpoints, points) = assemble.DestinationROI_to_SourceROI(transform, botleft, area, coordinate_cache=cache)
+            self.assertTrue(numpy.array_equal(numpy.round(expected_fixed), fixedpoints))
+            self.assertTrue(numpy.array_equal(expected_warped, points))
+        
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        
+        cache.max_bytes = 0
+        self.assertEqual(len(cache), 0, "Lowering the memory limit should remove maps over the limit")
+        cache.max_bytes = coordinate_map_cache.DefaultMaxCacheBytes
+        
+        transform.TranslateFixed((1, 1))
+        assemble.DestinationROI_to_SourceROI(transform, botleft, area, coordinate_cache=cache)
+        self.assertEqual(cache.misses, 2, "Changing the transform should change the cache key")
+        transform.TranslateFixed((-1, -1))
+        
+        coarse_cache = coordinate_map_cache.CoordinateMapCache(grid_spacing=8, tolerance=0.25)
+        (fixedpoints, points) = assemble.DestinationROI_to_SourceROI(transform, botleft, area, coordinate_cache=coarse_cache)
+        self.assertTrue(numpy.array_equal(numpy.round(expected_fixed), fixedpoints), "Upsampled map should map the same pixels")
+        self.assertLessEqual(numpy.max(numpy.abs(expected_warped - points)), 0.25)
+
+    def test_rigid_fast_path(self):
+        '''Rigid transforms are warped without coordinate arrays, check the result matches the coordinate path'''
+        
+        rng = numpy.random.RandomState(0)
+        image = rng.uniform(10, 200, (120, 90)).astype(numpy.float32)
+        area = (70, 80)
+        
+        transforms = [nornir_imageregistration.transforms.RigidNoRotation((12.4, -30.6)),
+                      nornir_imageregistration.transforms.Rigid((-5, 20), (60, 45), 0.3),
+                      nornir_imageregistration.transforms.CenteredSimilarity2DTransform((8, -3), (60, 45), -0.2, 1.5)]
+        
+        for transform in transforms:
+            for botleft in ((0, 0), (-20.5, 35.25)):
+                self.assertIsNotNone(assemble._InverseAffineParameters(transform, botleft))
+                fast = assemble.WarpedImageToFixedSpace(transform, None, image, botleft=botleft, area=area, cval=0)
+                
+                (fixed_coords, warped_coords) = assemble.DestinationROI_to_SourceROI(transform, botleft, area)
+                WarpedImageUsingCoords = getattr(assemble, '__WarpedImageUsingCoords')
+                expected = WarpedImageUsingCoords(fixed_coords, warped_coords, area, image, area, cval=0)
+                
+                # Nearest neighbor ties may round differently with float32 coordinates, translations must match exactly
+                mismatch = numpy.mean(fast != expected)
+                if isinstance(transform, nornir_imageregistration.transforms.Rigid):
+                    self.assertLess(mismatch, 0.01)
+                else:
+                    self.assertEqual(mismatch, 0)
+
+    def test_row_blocks(self):
+        '''Warping a region in blocks of rows should match warping it all at once'''
+        
+        self.assertEqual([b[0] for b in assemble.ROIRowBlocks((5, 7), (10, 4), max_block_pixels=12)], [0, 3, 6, 9])
+        self.assertEqual(sum([b[2][0] for b in assemble.ROIRowBlocks((5, 7), (10, 4), max_block_pixels=3)]), 10)
+        
+        (g_y, g_x) = numpy.meshgrid(numpy.linspace(0, 100, 4), numpy.linspace(0, 100, 4), indexing='ij')
+        warped_points = numpy.vstack((g_y.flat, g_x.flat)).transpose()
+        rng = numpy.random.RandomState(1)
+        fixed_points = warped_points * 1.2 + 10 + rng.uniform(-3, 3, warped_points.shape)
+        transform = nornir_imageregistration.transforms.triangulation.Triangulation(numpy.hstack((fixed_points, warped_points)))
+        
+        image = rng.uniform(10, 200, (101, 101)).astype(numpy.float32)
+        botleft = (-12.5, 30)
+        area = (140, 110)
+        
+        # The region extends past the transform, so some pixels cannot be mapped and keep cval
+        (fixed_coords, warped_coords) = assemble.DestinationROI_to_SourceROI(transform, botleft, area)
+        self.assertLess(fixed_coords.shape[0], numpy.prod(area))
+        WarpedImageUsingCoords = getattr(assemble, '__WarpedImageUsingCoords')
+        expected = WarpedImageUsingCoords(fixed_coords, warped_coords, area, image, area, cval=0)
+        
+        for max_block_pixels in (1, 1000, None):
+            warped = assemble.WarpedImageToFixedSpace(transform, None, image, botleft=botleft, area=area, cval=0, max_block_pixels=max_block_pixels)
+            self.assertTrue(numpy.array_equal(expected, warped))
+
 class TestAssemble(setup_imagetest.ImageTestBase):
     
     def test_TransformImageIdentity(self):
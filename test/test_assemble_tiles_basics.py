@@ -1,5 +1,10 @@
+import concurrent.futures
 import glob
+import multiprocessing
 import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
 from nornir_imageregistration.files.mosaicfile import MosaicFile
@@ -10,13 +15,31 @@ from scipy.misc import imsave
 import nornir_imageregistration
 import nornir_imageregistration.assemble_tiles as at
 import nornir_imageregistration.core as core
+import nornir_imageregistration.shared_buffers as shared_buffers
 import nornir_imageregistration.tileset as tiles
 import nornir_imageregistration.transforms.factory as tfactory
+from nornir_imageregistration.transformed_image_data import TransformedImageData
 from nornir_shared.tasktimer import TaskTimer
+import nornir_pools
 import numpy as np
 
 import test_assemble_tiles
 
+
+class ProcessPool(object):
+    '''The add_task interface of a nornir_pools pool, backed by spawned worker processes'''
+    
+    def __init__(self, num_processes):
+        self._executor = concurrent.futures.ProcessPoolExecutor(num_processes, mp_context=multiprocessing.get_context('spawn'))
+        
+    def add_task(self, name, func, *args, **kwargs):
+        task = self._executor.submit(func, *args, **kwargs)
+        task.wait_return = task.result
+        return task
+    
+    def Shutdown(self):
+        self._executor.shutdown(wait=True)
+
   
 class BasicTests(test_assemble_tiles.TestMosaicAssemble):
 
@@ -95,3 +118,176 @@ class BasicTests(test_assemble_tiles.TestMosaicAssemble):
             self.assertIsNotNone(mosaic.FixedBoundingBox, "No bounding box returned for mosiac")
 
             self.Logger.info(m + " fixed bounding box: " + str(mosaic.FixedBoundingBox))
+
+
+class TileAssemblyTests(unittest.TestCase):
+    '''Assembly tests that build their own synthetic tiles and do not require the test data set'''
+
+    def test_SharedSlabTransport(self):
+        '''Warped tile data written into a shared slab should be read back in place and the slab reused after release'''
+        
+        if not shared_buffers.IsSupported():
+            self.skipTest("multiprocessing.shared_memory is not available")
+        
+        slab_pool = shared_buffers.SharedSlabPool()
+        try:
+            shape = (100, 120)
+            image = np.random.rand(*shape).astype(np.float32)
+            distance = at.CreateDistanceImage2(shape)
+            
+            slab = slab_pool.Acquire(shared_buffers.PackedSize((shape, shape), (np.float16, np.float16)))
+            data = TransformedImageData.Create(image, distance, None, 1.0, 1.0, SingleThreadedInvoke=False, shared_slab=slab)
+            self.assertIsNone(data._image_path, "Data should not be written to temporary files when a slab is provided")
+            
+            # Simulate returning the result from a worker process
+            data = pickle.loads(pickle.dumps(data))
+            self.assertTrue(np.array_equal(data.image, image.astype(np.float16)))
+            self.assertTrue(np.array_equal(data.centerDistanceImage, distance.astype(np.float16)))
+            
+            data.Clear()
+            slab_pool.Release(slab)
+            slab_pool.Release(slab)
+            self.assertEqual(slab_pool.num_free, 1, "Releasing a slab twice should not add it to the free list twice")
+            
+            reused = slab_pool.Acquire(slab.size // 2)
+            self.assertEqual(reused.name, slab.name, "A free slab large enough for the request should be reused")
+            self.assertEqual(slab_pool.num_slabs, 1)
+            
+            # A slab too small for the data falls back to temporary files
+            small = slab_pool.Acquire(64)
+            data = TransformedImageData.Create(image, distance, None, 1.0, 1.0, SingleThreadedInvoke=False, shared_slab=small)
+            self.assertIsNone(data.shared_slab)
+            self.assertTrue(np.array_equal(data.image, image))
+            data.Clear()
+        finally:
+            slab_pool.Close()
+        
+    def test_CompositeInWorkers(self):
+        '''Workers compositing into a shared output image should match assembling on a single thread'''
+        
+        if not shared_buffers.IsSupported():
+            self.skipTest("multiprocessing.shared_memory is not available")
+        
+        tiles_dir = tempfile.mkdtemp('_CompositeInWorkers')
+        try:
+            rng = np.random.RandomState(0)
+            transforms = []
+            imagepaths = []
+            for iY in range(3):
+                for iX in range(3):
+                    imagepath = os.path.join(tiles_dir, '%03d.png' % (iY * 3 + iX))
+                    nornir_imageregistration.SaveImage(imagepath, (rng.rand(128, 128) * 255).astype(np.uint8))
+                    imagepaths.append(imagepath)
+                    transforms.append(tfactory.CreateRigidTransform((iY * 100.0, iX * 100.0), 0, (128, 128), (128, 128)))
+            
+            original_band_height = at.CanvasBandHeight
+            at.CanvasBandHeight = 50
+            process_pool = ProcessPool(2)
+            try:
+                (expected, expected_mask) = at.TilesToImage(transforms, imagepaths, target_space_scale=1.0, source_space_scale=1.0)
+                
+                for pool in (nornir_pools.GetGlobalSerialPool(), process_pool):
+                    (result, mask) = at.TilesToImageParallel(transforms, imagepaths, pool=pool,
+                                                             target_space_scale=1.0, source_space_scale=1.0,
+                                                             composite_in_workers=True)
+                    
+                    self.assertTrue(np.array_equal(expected, result), "Compositing in workers should produce the same image")
+                    self.assertTrue(np.array_equal(expected_mask, mask), "Compositing in workers should produce the same mask")
+            finally:
+                at.CanvasBandHeight = original_band_height
+                process_pool.Shutdown()
+                
+            self.assertEqual(multiprocessing.active_children(), [], "The band lock manager should be shut down after compositing")
+        finally:
+            shutil.rmtree(tiles_dir)
+        
+    def test_BlendModes(self):
+        '''Each blend mode should combine overlapping tiles as described and match when compositing in workers'''
+
+        tiles_dir = tempfile.mkdtemp('_BlendModes')
+        try:
+            shape = (64, 80)
+            imagepaths = []
+            transforms = []
+            for (i, value) in enumerate((64, 192)):
+                imagepath = os.path.join(tiles_dir, '%03d.png' % i)
+                nornir_imageregistration.SaveImage(imagepath, np.full(shape, value, dtype=np.uint8))
+                imagepaths.append(imagepath)
+                transforms.append(tfactory.CreateRigidTransform((0, i * 40.0), 0, shape, shape))
+
+            (zbuffer, zbuffer_mask) = at.TilesToImage(transforms, imagepaths, target_space_scale=1.0, source_space_scale=1.0)
+            (named, named_mask) = at.TilesToImage(transforms, imagepaths, target_space_scale=1.0, source_space_scale=1.0, blend_mode='zbuffer')
+            self.assertTrue(np.array_equal(zbuffer, named))
+            self.assertTrue(np.array_equal(zbuffer_mask, named_mask))
+
+            low = zbuffer[0, 0]
+            high = zbuffer[0, -1]
+            self.assertLess(low, high)
+
+            # The seam falls halfway through the overlapping columns 40-79
+            self.assertTrue(np.all(zbuffer[:, :60] == low))
+            self.assertTrue(np.all(zbuffer[:, 60:] == high))
+
+            (maximum, max_mask) = at.TilesToImage(transforms, imagepaths, target_space_scale=1.0, source_space_scale=1.0, blend_mode='max')
+            self.assertTrue(np.array_equal(max_mask, zbuffer_mask))
+            self.assertTrue(np.all(maximum[:, :40] == low))
+            self.assertTrue(np.all(maximum[:, 40:] == high))
+
+            (feather, feather_mask) = at.TilesToImage(transforms, imagepaths, target_space_scale=1.0, source_space_scale=1.0, blend_mode=at.FeatherBlend)
+            self.assertTrue(np.array_equal(feather_mask, zbuffer_mask))
+            self.assertTrue(np.allclose(feather[:, :40], low, rtol=1e-3))
+            self.assertTrue(np.allclose(feather[:, 80:], high, rtol=1e-3))
+            overlap = feather[shape[0] // 2, 40:80].astype(np.float32)
+            self.assertTrue(np.all(np.diff(overlap) >= 0), "Feathering should ramp smoothly across the overlap")
+            self.assertTrue(np.all((overlap > low) & (overlap < high)))
+
+            if shared_buffers.IsSupported():
+                (result, mask) = at.TilesToImageParallel(transforms, imagepaths, pool=nornir_pools.GetGlobalSerialPool(),
+                                                         target_space_scale=1.0, source_space_scale=1.0,
+                                                         composite_in_workers=True, blend_mode='feather')
+                self.assertTrue(np.array_equal(feather, result), "Compositing in workers should produce the same image")
+                self.assertTrue(np.array_equal(feather_mask, mask))
+
+            # The z-buffer weights computed from source coordinates match the distance image
+            data = at.TransformTile(transforms[0], imagepaths[0], target_space_scale=1.0, SingleThreadedInvoke=True)
+            self.assertTrue(np.array_equal(data.centerDistanceImage, at.CreateDistanceImage2(shape).astype(np.float16)))
+            data.Clear()
+
+            self.assertRaises(ValueError, at.GetBlendMode, 'unknown')
+        finally:
+            shutil.rmtree(tiles_dir)
+
+    def test_GenerateOptimizedTiles(self):
+        '''Optimized tiles should match cropping the assembled mosaic regardless of the working window size'''
+
+        tiles_dir = tempfile.mkdtemp('_GenerateOptimizedTiles')
+        try:
+            rng = np.random.RandomState(0)
+            transforms = {}
+            for iY in range(4):
+                for iX in range(4):
+                    imagename = '%03d.png' % (iY * 4 + iX)
+                    nornir_imageregistration.SaveImage(os.path.join(tiles_dir, imagename), (rng.rand(256, 256) * 255).astype(np.uint8))
+                    transforms[imagename] = tfactory.CreateRigidTransform((iY * 200.0, iX * 200.0), 0, (256, 256), (256, 256))
+
+            mosaic = Mosaic(transforms)
+            (full, _mask) = mosaic.AssembleImage(tiles_dir, usecluster=False, target_space_scale=1.0, source_space_scale=1.0)
+
+            tile_dims = (128, 128)
+            # The smallest area is less than one input tile tall, the window must still grow to cover an input tile
+            for max_temp_image_area in (128 * 128, 128 * 128 * 6, None):
+                num_tiles = 0
+                for (iRow, iColumn, tile_image) in mosaic.GenerateOptimizedTiles(tiles_dir, tile_dims=tile_dims, max_temp_image_area=max_temp_image_area,
+                                                                                 usecluster=False, target_space_scale=1.0, source_space_scale=1.0):
+                    self.assertEqual(tile_image.shape, tile_dims)
+                    expected = full[iRow * tile_dims[0]:(iRow + 1) * tile_dims[0], iColumn * tile_dims[1]:(iColumn + 1) * tile_dims[1]]
+                    self.assertTrue(np.array_equal(expected, tile_image[:expected.shape[0], :expected.shape[1]]),
+                                    "Tile %d,%d differs from the assembled mosaic with max_temp_image_area %s" % (iRow, iColumn, str(max_temp_image_area)))
+                    num_tiles += 1
+
+                self.assertEqual(num_tiles, 49, "A 856x856 mosaic should divide into a 7x7 grid of 128x128 tiles")
+
+            # A mosaic without transforms has no tiles to yield
+            self.assertEqual(list(Mosaic({}).GenerateOptimizedTiles(tiles_dir, tile_dims=tile_dims, usecluster=False)), [])
+        finally:
+            shutil.rmtree(tiles_dir)
@@ -8,6 +8,7 @@ import os
 import unittest
 
 from pylab import *
+import scipy.ndimage
 
 import nornir_shared.images
 import nornir_imageregistration
@@ -235,6 +236,172 @@ class TestCore(setup_imagetest.ImageTestBase):
         self.assertNotEqual(updatedImage[0][0], image[0][0], "Masked off pixel should not be the same as input image value after the test")
         self.assertEqual(updatedImage[32][32], image[32][32], "Unmasked pixel should equal input image")
 
+    def testPhaseCorrelatorMatchesFFTPhaseCorrelation(self):
+        '''The batched real-to-complex correlator should find the same peak as the original complex FFT path'''
+        
+        image = np.random.rand(256, 256).astype(np.float32)
+        image = scipy.ndimage.gaussian_filter(image, 2)
+        
+        FixedImage = image[20:148, 30:158]
+        MovingImage = image[27:155, 18:146]
+        
+        CorrelationImage = nornir_imageregistration.FFTPhaseCorrelation(np.fft.fft2(FixedImage - FixedImage.mean()),
+                                                                        np.fft.fft2(MovingImage - MovingImage.mean()))
+        CorrelationImage = np.fft.fftshift(CorrelationImage)
+        CorrelationImage -= CorrelationImage.min()
+        CorrelationImage /= CorrelationImage.max()
+        (expected_peak, expected_weight) = nornir_imageregistration.FindPeak(CorrelationImage)
+        
+        correlator = nornir_imageregistration.PhaseCorrelator(FixedImage.shape)
+        records = correlator.FindOffsets(np.stack((FixedImage, FixedImage)), np.stack((MovingImage, FixedImage)))
+        
+        self.assertEqual(len(records), 2)
+        np.testing.assert_allclose(records[0].peak, expected_peak, atol=0.01)
+        self.assertAlmostEqual(records[0].weight, expected_weight, places=2)
+        np.testing.assert_allclose(records[1].peak, (0, 0), atol=0.01)
+        
+        # A single fixed image is broadcast against a stack of moving images
+        records = correlator.FindOffsets(FixedImage, np.stack((MovingImage, FixedImage)))
+        np.testing.assert_allclose(records[0].peak, expected_peak, atol=0.01)
+        np.testing.assert_allclose(records[1].peak, (0, 0), atol=0.01)
+        
+        record = nornir_imageregistration.FindOffset(FixedImage, MovingImage)
+        np.testing.assert_allclose(record.peak, expected_peak, atol=0.01)
+
+    def testPhaseCorrelatorThreads(self):
+        '''Threads sharing the cached correlator for a shape must not overwrite each other's scratch buffers'''
+        import concurrent.futures
+
+        image = np.random.rand(512, 512).astype(np.float32)
+        image = scipy.ndimage.gaussian_filter(image, 2)
+
+        pairs = []
+        for i in range(16):
+            (dy, dx) = (i - 8, 7 - i)
+            pairs.append((image[100:228, 100:228], image[100 + dy:228 + dy, 100 + dx:228 + dx]))
+
+        correlator = nornir_imageregistration.GetPhaseCorrelator((128, 128))
+        expected = [correlator.FindOffsets(np.stack([p[0]] * 4), np.stack([p[1]] * 4))[0].peak for p in pairs]
+
+        def Correlate(i):
+            (fixed, moving) = pairs[i % len(pairs)]
+            shared = nornir_imageregistration.GetPhaseCorrelator((128, 128))
+            return shared.FindOffsets(np.stack([fixed] * 4), np.stack([moving] * 4))[0].peak
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            peaks = list(executor.map(Correlate, range(len(pairs) * 8)))
+
+        for (i, peak) in enumerate(peaks):
+            np.testing.assert_array_equal(peak, expected[i % len(pairs)])
+
+    def testFindPeak(self):
+        '''FindPeak should locate the strongest peak and never measure the thresholded background'''
+        
+        Y, X = np.mgrid[0:128, 0:128]
+        
+        # A single peak, the common case for a correlation image at the correct angle
+        image = np.exp(-((Y - 40.0) ** 2 + (X - 70.0) ** 2) / 8.0)
+        (peak, weight) = nornir_imageregistration.FindPeak(image)
+        np.testing.assert_allclose(peak, (64 - 40, 64 - 70), atol=0.01)
+        self.assertGreater(weight, 0)
+        
+        # The strongest of several peaks is found even when it has the last label
+        image = image * 0.5 + np.exp(-((Y - 100.0) ** 2 + (X - 20.0) ** 2) / 8.0)
+        (peak, weight) = nornir_imageregistration.FindPeak(image, Cutoff=0.99)
+        np.testing.assert_allclose(peak, (64 - 100, 64 - 20), atol=0.01)
+
+    def testFindPeakSearchMask(self):
+        '''FindPeak should ignore peaks outside the search mask, and ignore a search mask that contains no peak'''
+        
+        shape = (128, 128)
+        Y, X = np.mgrid[0:shape[0], 0:shape[1]]
+        image = np.exp(-((Y - 40.0) ** 2 + (X - 70.0) ** 2) / 8.0) + 0.5 * np.exp(-((Y - 100.0) ** 2 + (X - 20.0) ** 2) / 8.0)
+        strong_peak = (64 - 40, 64 - 70)
+        weak_peak = (64 - 100, 64 - 20)
+        
+        (peak, weight) = nornir_imageregistration.FindPeak(image, Cutoff=0.99)
+        np.testing.assert_allclose(peak, strong_peak, atol=0.01)
+        
+        # The mask is centered on the expected offset, in FindPeak's convention
+        SearchMask = nornir_imageregistration.overlapmasking.GetPeakSearchMask(shape, weak_peak, 5)
+        self.assertTrue(SearchMask[100, 20])
+        self.assertFalse(SearchMask[40, 70])
+        self.assertEqual(np.sum(SearchMask), np.sum((Y - 100.0) ** 2 + (X - 20.0) ** 2 <= 25))
+        
+        (masked_peak, masked_weight) = nornir_imageregistration.FindPeak(image, Cutoff=0.99, SearchMask=SearchMask)
+        np.testing.assert_allclose(masked_peak, weak_peak, atol=0.01)
+        self.assertLess(masked_weight, weight, "Weights should not be renormalized to the search window")
+        
+        # No pixel in the window passes the threshold, so the whole image is searched
+        EmptyMask = nornir_imageregistration.overlapmasking.GetPeakSearchMask(shape, (-50, -50), 5)
+        self.assertTrue(np.any(EmptyMask))
+        (peak, empty_weight) = nornir_imageregistration.FindPeak(image, Cutoff=0.99, SearchMask=EmptyMask)
+        np.testing.assert_allclose(peak, strong_peak, atol=0.01)
+        self.assertEqual(empty_weight, weight)
+
+    def testImagePyramid(self):
+        image = np.random.rand(300, 517).astype(np.float32)
+        pyramid = nornir_imageregistration.ImagePyramid(image, MinDimension=64)
+        
+        self.assertEqual(pyramid.NumLevels, 4)
+        self.assertEqual(pyramid[0].shape, image.shape)
+        self.assertEqual(pyramid[1].shape, (150, 258))
+        self.assertEqual(pyramid[3].shape, (37, 64))
+        self.assertEqual(nornir_imageregistration.ImagePyramid.Downsample(3), 8)
+        self.assertAlmostEqual(pyramid[1][0, 0], np.mean(image[0:2, 0:2]), places=5)
+
+    def testImageCache(self):
+        import nornir_imageregistration.image_cache
+
+        ImagePath = os.path.join(self.TestOutputPath, "ImageCacheInput.png")
+        image = (np.random.rand(64, 96) * 255).astype(np.uint8)
+        nornir_imageregistration.SaveImage(ImagePath, image)
+
+        SpillDir = os.path.join(self.TestOutputPath, "ImageCacheSpill")
+        os.makedirs(SpillDir, exist_ok=True)
+        cache = nornir_imageregistration.image_cache.ImageCache(spill_dir=SpillDir)
+        cache.RemoveSpillFiles()
+
+        first = cache.GetImage(ImagePath)
+        second = cache.GetImage(ImagePath)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertTrue(first is second)
+        self.assertFalse(first.flags.writeable)
+        self.assertEqual(len(os.listdir(SpillDir)), 0, "Images are only spilled when evicted or when requested")
+
+        #A second process sharing the spill directory memory-maps the decoded image once it is spilled
+        cache.GetImage(ImagePath, spill=True)
+        other = nornir_imageregistration.image_cache.ImageCache(spill_dir=SpillDir)
+        spilled = other.GetImage(ImagePath)
+        self.assertEqual(other.spill_hits, 1)
+        self.assertEqual(other.misses, 0)
+        np.testing.assert_array_equal(spilled, first)
+        cache.RemoveSpillFiles()
+
+        #Entries larger than the limit are evicted in least recently used order
+        small = nornir_imageregistration.image_cache.ImageCache(max_bytes=first.nbytes * 5 - 1, spill_dir=False)
+        small.GetImage(ImagePath)
+        small.GetImage(ImagePath, dtype=np.float32)
+        self.assertEqual(len(small), 1)
+        small.GetImage(ImagePath)
+        self.assertEqual(len(small), 1)
+        self.assertEqual(small.misses, 3)
+        self.assertEqual(small.hits, 0)
+
+        #Evicted entries are spilled to a private directory, which is removed when the cache is closed
+        private = nornir_imageregistration.image_cache.ImageCache(max_bytes=first.nbytes * 5 - 1)
+        self.assertIsNone(private.spill_dir)
+        private.GetImage(ImagePath)
+        private.GetImage(ImagePath, dtype=np.float32)
+        private_dir = private.spill_dir
+        self.assertTrue(os.path.isdir(private_dir))
+        private.GetImage(ImagePath)
+        self.assertEqual(private.misses, 2)
+        self.assertEqual(private.spill_hits, 1)
+        private.Close()
+        self.assertFalse(os.path.exists(private_dir))
+
 #    def testPadImage(self):
 #
 #        self.FixedImagePath = os.path.join(self.ImportedDataPath, "PadImageTestPattern.png")
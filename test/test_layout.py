@@ -549,6 +549,164 @@ class TestLayout(setup_imagetest.TestBase):
         _Relax_Layout(layout, MovieImageDir=self.TestOutputPath, 
                       max_tension_cutoff=0.1, max_iter=1000)
 
+    @classmethod
+    def _CreateGridLayout(cls, num_rows, num_cols, tile_dims, weight_func=None, rng=None):
+        '''Create a layout with random node positions and correct offsets between four-adjacent tiles'''
+        if rng is None:
+            rng = np.random
+            
+        grid_dims = (num_rows, num_cols)
+        layout = nornir_imageregistration.layout.Layout()
+        positions = rng.rand(num_cols * num_rows, 2) * np.asarray(grid_dims * tile_dims, dtype=np.float64)
+        
+        pos_to_tileid = {}
+        iTile = 0
+        for iRow in range(0,num_rows):
+            for iCol in range(0,num_cols): 
+                layout.CreateNode(iTile, positions[iTile,:], tile_dims)
+                pos_to_tileid[(iRow, iCol)] = iTile
+                iTile = iTile + 1 
+                
+        for iRow in range(0,num_rows):
+            for iCol in range(0,num_cols):
+                pos = np.asarray((iRow, iCol))
+                pos_tile_id = pos_to_tileid[(iRow, iCol)]
+                for adj in TestLayout.enumerate_four_adjacent(pos, grid_dims):
+                    offset = (adj - pos) * tile_dims
+                    adj_tile_id = pos_to_tileid[tuple(adj)]
+                    weight = 1.0 if weight_func is None else weight_func()
+                    layout.SetOffset(pos_tile_id, adj_tile_id, offset, weight=weight)
+                    
+        return (layout, pos_to_tileid)
+    
+    def _CheckGridPositions(self, layout, pos_to_tileid, tile_dims, atol):
+        origin = layout.GetPosition(pos_to_tileid[(0,0)])
+        for (grid_pos, tile_id) in pos_to_tileid.items():
+            expected = origin + np.asarray(grid_pos) * tile_dims
+            np.testing.assert_allclose(layout.GetPosition(tile_id), expected, atol=atol)
+    
+    def test_layout_solve_into_grid(self):
+        '''Solve a 10x10 grid of randomly placed tiles with correct offsets.  The solution should be exact.'''
+        tile_dims = np.asarray((10,10))
+        rng = np.random.RandomState(0)
+        (layout, pos_to_tileid) = self._CreateGridLayout(10, 10, tile_dims, weight_func=rng.rand, rng=rng)
+        average_center = layout.average_center
+        
+        nornir_imageregistration.layout.SolveLayout(layout)
+        
+        self._CheckGridPositions(layout, pos_to_tileid, tile_dims, atol=1e-6)
+        self.assertLess(layout.MaxWeightedNetTensionMagnitude[1], 1e-6)
+        np.testing.assert_allclose(layout.average_center, average_center, atol=1e-6)
+        
+    def test_layout_solve_with_outlier(self):
+        '''A single badly wrong offset should be ignored by the reweighted solve'''
+        tile_dims = np.asarray((10,10))
+        (layout, pos_to_tileid) = self._CreateGridLayout(6, 6, tile_dims, rng=np.random.RandomState(1))
+        
+        A = pos_to_tileid[(2,2)]
+        B = pos_to_tileid[(2,3)]
+        layout.SetOffset(A, B, np.asarray((0, 10)) + np.asarray((25, -30)), weight=1.0)
+        
+        nornir_imageregistration.layout.SolveLayout(layout, robust_iterations=5)
+        
+        self._CheckGridPositions(layout, pos_to_tileid, tile_dims, atol=0.5)
+
+    def test_layout_edges(self):
+        '''The vectorized LayoutEdges tension vectors should match the per-node calculations'''
+        tile_dims = np.asarray((10,10))
+        (layout, pos_to_tileid) = self._CreateGridLayout(5, 7, tile_dims, weight_func=np.random.rand)
+        
+        edges = layout.ToLayoutEdges()
+        self.assertEqual(edges.num_nodes, 35)
+        self.assertEqual(edges.num_edges, 2 * ((4 * 7) + (5 * 6)))
+        self.assertEqual(np.sum(edges.UniqueEdges()), (4 * 7) + (5 * 6))
+        
+        IDs = sorted(layout.nodes.keys())
+        expected_weighted = np.vstack([layout.WeightedNetTensionVector(ID) for ID in IDs])
+        expected_net = np.vstack([layout.NetTensionVector(ID) for ID in IDs])
+        np.testing.assert_allclose(layout.WeightedNetTensionVectors()[:,1:], expected_weighted)
+        np.testing.assert_allclose(layout.NetTensionVectors()[:,1:], expected_net)
+        
+        sorted_offsets = OffsetsSortedByWeight(layout)
+        self.assertEqual(sorted_offsets.shape, ((4 * 7) + (5 * 6), 5))
+        self.assertTrue(np.all(sorted_offsets[:,0] < sorted_offsets[:,1]))
+        self.assertTrue(np.all(np.diff(sorted_offsets[:,4]) <= 0))
+        
+        ScaleOffsetWeightsByPopulationRank(layout, min_allowed_weight=0.25, max_allowed_weight=1.0)
+        (minWeight, maxWeight) = layout.GetOffsetWeightExtrema()
+        self.assertAlmostEqual(minWeight, 0.25)
+        self.assertAlmostEqual(maxWeight, 1.0)
+
+    def test_layout_edges_snapshot_reuse(self):
+        '''Snapshots share their structure until an offset is added or removed and always copy current values'''
+        tile_dims = np.asarray((10,10))
+        (layout, pos_to_tileid) = self._CreateGridLayout(3, 3, tile_dims)
+        
+        A = pos_to_tileid[(0,0)]
+        B = pos_to_tileid[(0,1)]
+        C = pos_to_tileid[(2,2)]
+        
+        first = layout.ToLayoutEdges()
+        second = layout.ToLayoutEdges()
+        self.assertIs(first.target, second.target, "Unchanged layout should reuse the snapshot structure")
+        
+        #Changing an existing offset or a position does not change the structure, the values must still be current
+        layout.SetOffset(A, B, np.asarray((1, 12)), weight=0.5)
+        layout.nodes[C].Position = layout.nodes[C].Position + 3
+        updated = layout.ToLayoutEdges()
+        self.assertIs(first.target, updated.target)
+        iEdge = np.flatnonzero((updated.IDs[updated.source] == A) & (updated.IDs[updated.target] == B))
+        np.testing.assert_allclose(updated.offsets[iEdge], [[1, 12]])
+        np.testing.assert_allclose(updated.weights[iEdge], [0.5])
+        np.testing.assert_allclose(updated.positions[list(updated.IDs).index(C)], layout.GetPosition(C))
+        
+        layout.SetOffset(A, C, np.asarray((20, 20)))
+        added = layout.ToLayoutEdges()
+        self.assertIsNot(first.target, added.target, "Adding an offset should rebuild the structure")
+        self.assertEqual(added.num_edges, first.num_edges + 2)
+        
+        layout.RemoveOverlap((A, C))
+        removed = layout.ToLayoutEdges()
+        self.assertEqual(removed.num_edges, first.num_edges)
+        np.testing.assert_allclose(layout.NetTensionVectors()[:,1:], 
+                                   np.vstack([layout.NetTensionVector(ID) for ID in sorted(layout.nodes.keys())]))
+        
+        #Copies do not share nodes or offsets with the original
+        layout_copy = layout.copy()
+        layout_copy.SetOffset(A, B, np.asarray((0, 10)), weight=1.0)
+        layout_copy.nodes[A].Position = layout_copy.nodes[A].Position + 5
+        np.testing.assert_allclose(layout.nodes[A].GetOffset(B), (1, 12))
+        self.assertFalse(np.allclose(layout.GetPosition(A), layout_copy.GetPosition(A)))
+
+    def test_build_layout_with_highest_weights_first(self):
+        '''Nodes are placed by the strongest offsets, disconnected groups become separate layouts'''
+        layout = nornir_imageregistration.layout.Layout()
+        for ID in range(0,6):
+            layout.CreateNode(ID, np.zeros(2))
+            
+        #A triangle with one inconsistent, weak offset
+        layout.SetOffset(0, 1, np.asarray((0, 10)), weight=1.0)
+        layout.SetOffset(1, 2, np.asarray((10, 0)), weight=0.9)
+        layout.SetOffset(0, 2, np.asarray((50, 50)), weight=0.1)
+        
+        #A separate pair
+        layout.SetOffset(4, 5, np.asarray((-5, 5)), weight=0.5)
+        
+        layouts = BuildLayoutWithHighestWeightsFirst(layout)
+        self.assertEqual(len(layouts), 2)
+        
+        (first, second) = layouts
+        self.assertEqual(list(first.nodes.keys()), [0, 1, 2])
+        self.assertEqual(list(second.nodes.keys()), [4, 5])
+        
+        np.testing.assert_allclose(first.GetPosition(1) - first.GetPosition(0), (0, 10))
+        np.testing.assert_allclose(first.GetPosition(2) - first.GetPosition(0), (10, 10))
+        np.testing.assert_allclose(second.GetPosition(5) - second.GetPosition(4), (-5, 5))
+        
+        #The weak offset is not used for placement but is kept in the layout
+        self.assertTrue(first.ContainsOffset((0, 2)))
+        np.testing.assert_allclose(first.nodes[2].GetOffset(0), (-50, -50))
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
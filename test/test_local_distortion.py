@@ -11,6 +11,7 @@ import nornir_pools
 import nornir_shared.plot
 import nornir_shared.plot as plot
 import numpy as np
+import scipy.ndimage
 import nornir_imageregistration 
 
 from nornir_imageregistration.local_distortion_correction import _RunRefineTwoImagesIteration, RefineStosFile
@@ -368,9 +369,184 @@ class TestSliceToSliceRefinement(setup_imagetest.TransformTestBase, setup_imaget
             test_target_points = t.Transform(CalculatedSourcePoints)
             np.testing.assert_allclose(test_target_points, InitialTargetPoints, atol=.001, err_msg="Transform Iteration {0}".format(i))
             
+        #The batched inverse transform must agree with each rigid transform
+        (target_offsets, source_rotation_centers, angles) = local_distortion_correction.ApproximateRigidTransformParameters(reference_transform, InitialTargetPoints)
+        batched_points = np.tile(InitialTargetPoints, (len(local_rigid_transforms), 1, 1))
+        batched_source_points = local_distortion_correction.RigidInverseTransform(batched_points, target_offsets, source_rotation_centers, angles)
+        for i, t in enumerate(local_rigid_transforms):
+            np.testing.assert_allclose(batched_source_points[i], t.InverseTransform(InitialTargetPoints), atol=.001, err_msg="Batched Inverse Transform Iteration {0}".format(i))
+            
         return
+    
+    def testExtractAlignmentCells(self):
+        '''
+        Cells extracted together must match the cells cropped and warped one at a time
+        '''
+        
+        rng = np.random.RandomState(3)
+        target_image = scipy.ndimage.gaussian_filter(rng.rand(300, 340), 2).astype(np.float32)
+        source_image = scipy.ndimage.gaussian_filter(rng.rand(320, 330), 2).astype(np.float32)
+        
+        reference_transform = nornir_imageregistration.transforms.MeshWithRBFFallback([[0, 0, 5, -3],
+                                                                                        [299, 0, 290, 10],
+                                                                                        [0, 339, 12, 330],
+                                                                                        [299, 339, 305, 340],
+                                                                                        [150, 170, 160, 165]])
+        cell_size = (48, 64)
+        target_points = np.array([[y, x] for y in range(40, 261, 55) for x in range(40, 301, 65)], dtype=np.float64)
+        
+        rigid_parameters = local_distortion_correction.ApproximateRigidTransformParameters(reference_transform, target_points)
+        rigid_transforms = local_distortion_correction.ApproximateRigidTransform(reference_transform, target_points)
+        
+        (target_cells, source_cells) = local_distortion_correction.ExtractAlignmentCells(target_image, source_image, target_points, cell_size, *rigid_parameters)
+        self.assertEqual(target_cells.shape, (target_points.shape[0],) + cell_size)
+        self.assertEqual(source_cells.shape, (target_points.shape[0],) + cell_size)
+        
+        for (i, target_point) in enumerate(target_points):
+            (expected_target, expected_source) = local_distortion_correction._AlignmentCellROIs(rigid_transforms[i], target_image, source_image, target_point, cell_size)
+            np.testing.assert_array_equal(target_cells[i], expected_target, err_msg="Target cell {0}".format(i))
+            np.testing.assert_array_equal(source_cells[i], expected_source, err_msg="Source cell {0}".format(i))
         
     
+    def testSharedImageAlignPoint(self):
+        '''
+        Aligning cells from images published in shared memory must match aligning the cell passed to the task directly
+        '''
+        
+        slab_pool = nornir_imageregistration.shared_buffers.GetSlabPool()
+        if slab_pool is None:
+            self.skipTest("Shared memory is not supported on this platform")
+        
+        rng = np.random.RandomState(1)
+        target_image = np.asarray(rng.rand(256, 256), dtype=np.float32)
+        source_image = np.roll(target_image, (3, -5), axis=(0, 1))
+        
+        transform = nornir_imageregistration.transforms.Rigid(target_offset=(0, 0), source_rotation_center=(128, 128), angle=0)
+        self.CheckSharedImageAlignPoint(slab_pool, transform, target_image, source_image,
+                                        target_points=np.array(((96, 96), (128, 160))), cell_size=(64, 64), angles=[0])
+        
+        # The cells are warped by a rotated transform and the search must find the rotation that undoes it
+        target_image = scipy.ndimage.gaussian_filter(target_image, 1)
+        source_image = np.roll(target_image, (3, -5), axis=(0, 1))
+        
+        transform = nornir_imageregistration.transforms.Rigid(target_offset=(0, 0), source_rotation_center=(128, 128), angle=np.deg2rad(6.0))
+        records = self.CheckSharedImageAlignPoint(slab_pool, transform, target_image, source_image,
+                                                  target_points=np.array(((112, 112), (128, 144))), cell_size=(96, 96), angles=[-6.0, 0, 6.0])
+        for record in records:
+            self.assertEqual(record.angle, -6.0)
+        
+    def CheckSharedImageAlignPoint(self, slab_pool, transform, target_image, source_image, target_points, cell_size, angles):
+        '''
+        Align the cells of target_points from shared images and check the records and cells against StartAttemptAlignPoint
+        :return: The records aligned from shared images
+        '''
+        
+        np.random.seed(0)
+        shared_images = local_distortion_correction.SharedAlignmentImages.Create(slab_pool, target_image, source_image, cell_size, 3)
+        try:
+            rigid_parameters = local_distortion_correction.ApproximateRigidTransformParameters(transform, target_points)
+            actual = local_distortion_correction.AlignPointsInSharedImages(shared_images, [1, 2], rigid_parameters,
+                                                                           [(0, 0), (0, 1)], target_points, target_points,
+                                                                           cell_size, anglesToSearch=angles)
+            ROIs = [shared_images.CopyROIs(iPoint) for iPoint in [1, 2]]
+        finally:
+            shared_images.Release(slab_pool)
+        
+        pool = nornir_pools.GetGlobalSerialPool()
+        for (i, target_point) in enumerate(target_points):
+            expected_task = local_distortion_correction.StartAttemptAlignPoint(pool, "Direct", transform, target_image, source_image,
+                                                                               target_point, cell_size, anglesToSearch=angles)
+            expected = expected_task.wait_return()
+            
+            np.testing.assert_allclose(actual[i].peak, expected.peak, atol=0.25)
+            self.assertEqual(actual[i].angle, expected.angle)
+            np.testing.assert_array_equal(ROIs[i][0], expected_task.TargetROI)
+            np.testing.assert_array_equal(ROIs[i][1], expected_task.SourceROI)
+            
+        return actual
+            
+    def testAlignCellStacks(self):
+        '''
+        Cells aligned as a stack must find the offset and rotation of each cell and agree with aligning each cell
+        on its own.  Cells of a single color are not aligned.
+        '''
+        
+        rng = np.random.RandomState(2)
+        image = scipy.ndimage.gaussian_filter(rng.rand(512, 512), 2).astype(np.float32)
+        
+        cell_shape = (96, 96)
+        corners = np.array(((100, 100), (300, 120), (150, 320), (320, 320)))
+        offsets = np.array(((4, -7), (-10, 3), (0, 12), (8, 8)))
+        angles = [-6.0, 0, 6.0]
+        
+        def SourceCell(y, x, rotation):
+            '''The cell at y, x rotated about its own center'''
+            if rotation == 0:
+                return image[y:y + cell_shape[0], x:x + cell_shape[1]]
+            
+            (pad_y, pad_x) = (cell_shape[0] // 2, cell_shape[1] // 2)
+            padded_cell = image[y - pad_y:y + cell_shape[0] + pad_y, x - pad_x:x + cell_shape[1] + pad_x]
+            rotated = scipy.ndimage.rotate(padded_cell, rotation, reshape=False, order=1)
+            return rotated[pad_y:pad_y + cell_shape[0], pad_x:pad_x + cell_shape[1]]
+        
+        target_cells = np.stack([image[y:y + cell_shape[0], x:x + cell_shape[1]] for (y, x) in corners])
+        
+        for rotation in (0, 6.0, -6.0):
+            source_cells = np.stack([SourceCell(y + dy, x + dx, rotation) for ((y, x), (dy, dx)) in zip(corners, offsets)])
+            source_cells[3] = 0.5
+            
+            np.random.seed(0)
+            IDs = list(range(corners.shape[0]))
+            records = local_distortion_correction.AlignCellStacks(target_cells, source_cells, IDs, corners, corners,
+                                                                  anglesToSearch=angles, min_alignment_overlap=0.5)
+            
+            self.assertIsNone(records[3], "Single color cells should not be aligned")
+            for (i, (record, offset)) in enumerate(zip(records[:3], offsets[:3])):
+                expected = nornir_imageregistration.stos_brute.SliceToSliceBruteForce(target_cells[i], source_cells[i],
+                                                                                      AngleSearchRange=angles, MinOverlap=0.5,
+                                                                                      SingleThread=True, Cluster=False, TestFlip=False)
+                self.assertEqual(record.angle, -rotation)
+                self.assertEqual(record.angle, expected.angle)
+                np.testing.assert_allclose(record.peak, offset, atol=0.75)
+                np.testing.assert_allclose(expected.peak, offset, atol=0.75)
+                self.assertTrue(record.PSDDelta > 0)
+            
+    def testUnmovedCellsReuseAlignment(self):
+        '''
+        Cells that did not move since the previous iteration must reuse the previous alignment
+        '''
+        
+        rng = np.random.RandomState(3)
+        target_image = scipy.ndimage.gaussian_filter(rng.rand(512, 512), 2).astype(np.float32)
+        source_image = np.roll(target_image, (4, -3), axis=(0, 1))
+        
+        transform = nornir_imageregistration.transforms.MeshWithRBFFallback([[0, 0, 0, 0],
+                                                                             [511, 0, 511, 0],
+                                                                             [0, 511, 0, 511],
+                                                                             [511, 511, 511, 511]])
+        
+        first_records = _RunRefineTwoImagesIteration(transform, target_image, source_image,
+                                                     cell_size=(128, 128), grid_spacing=(128, 128))
+        self.assertTrue(len(first_records) > 0)
+        
+        previous_records = {tuple(record.SourcePoint): record for record in first_records}
+        second_records = _RunRefineTwoImagesIteration(transform, target_image, source_image,
+                                                      cell_size=(128, 128), grid_spacing=(128, 128),
+                                                      previous_records=previous_records, min_cell_movement=0.25)
+        
+        self.assertEqual(len(first_records), len(second_records))
+        for record in second_records:
+            previous = previous_records[tuple(record.SourcePoint)]
+            np.testing.assert_array_equal(record.peak, previous.peak)
+            self.assertTrue(record.TargetROI is previous.TargetROI, "Alignment should be reused, not recalculated")
+            
+        # Cells are aligned again when the cells differ in size from the previous iteration
+        third_records = _RunRefineTwoImagesIteration(transform, target_image, source_image,
+                                                     cell_size=(64, 64), grid_spacing=(128, 128),
+                                                     previous_records=previous_records, min_cell_movement=0.25)
+        for record in third_records:
+            self.assertEqual(record.TargetROI.shape, (64, 64))
+        
     def testAlignmentRecordsToTransforms(self):
         '''
         Converts a set of alignment records into a transform
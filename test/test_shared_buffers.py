@@ -0,0 +1,77 @@
+'''
+Created on Oct 18, 2026
+
+@author: u0490822
+'''
+import multiprocessing
+from multiprocessing import resource_tracker
+import unittest
+
+import nornir_imageregistration.shared_buffers as shared_buffers
+import numpy as np
+
+
+def _FillSlab(slab, shape, value):
+    '''
+    Worker task, attach to the slab and fill it with value
+    :return: Sum of the slab and the resource tracker calls made while attaching
+    '''
+    tracker_calls = []
+    (register, unregister) = (resource_tracker.register, resource_tracker.unregister)
+    resource_tracker.register = lambda name, rtype: tracker_calls.append(('register', rtype))
+    resource_tracker.unregister = lambda name, rtype: tracker_calls.append(('unregister', rtype))
+    try:
+        (view,) = slab.Views((shape,), (np.float32,))
+    finally:
+        (resource_tracker.register, resource_tracker.unregister) = (register, unregister)
+        
+    view[:] = value
+    return (float(view.sum()), tracker_calls)
+
+
+class TestSharedSlabs(unittest.TestCase):
+
+    def testAttachFromWorkerProcesses(self):
+        '''Slabs written by worker processes should survive the workers exiting'''
+
+        if not shared_buffers.IsSupported():
+            self.skipTest("multiprocessing.shared_memory is not available")
+
+        # Forked workers started before a slab exists have their own resource tracker, spawned workers share this process's tracker
+        for method in ('fork', 'spawn'):
+            if method in multiprocessing.get_all_start_methods():
+                self.RunWorkerProcesses(multiprocessing.get_context(method))
+
+    def RunWorkerProcesses(self, context):
+
+        shape = (64, 48)
+        slab_pool = shared_buffers.SharedSlabPool()
+        try:
+            with context.Pool(2, maxtasksperchild=1) as pool:
+                slabs = [slab_pool.Acquire(shared_buffers.PackedSize((shape,), (np.float32,))) for _ in range(4)]
+                results = pool.starmap(_FillSlab, [(slab, shape, float(i + 1)) for (i, slab) in enumerate(slabs)])
+                pool.close()
+                pool.join()
+
+            self.assertEqual([r[0] for r in results], [float((i + 1) * np.prod(shape)) for i in range(4)])
+            # A worker's tracker holding the slab would unlink it when the worker exits.  Unregistering would remove
+            # the registration of the creating process when the tracker is shared.
+            self.assertEqual([r[1] for r in results], [[]] * 4, "Workers should not register or unregister slabs they attach to")
+
+            for (i, slab) in enumerate(slabs):
+                # Reopen by name so a slab unlinked when the workers exited is detected
+                shm = shared_buffers.shared_memory.SharedMemory(name=slab.name)
+                try:
+                    view = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                    self.assertTrue(np.all(view == i + 1), "Slab contents should be visible to the creating process")
+                    del view
+                finally:
+                    shm.close()
+                
+                slab_pool.Release(slab)
+        finally:
+            slab_pool.Close()
+
+
+if __name__ == "__main__":
+    unittest.main()
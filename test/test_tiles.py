@@ -8,6 +8,9 @@ import unittest
 
 import nornir_imageregistration as nir
 import nornir_imageregistration.tileset as tiles
+import nornir_imageregistration.tileset_functions as tileset_functions
+import nornir_pools
+import numpy as np
 
 from . import setup_imagetest
 
@@ -58,6 +61,35 @@ class TestTiles(setup_imagetest.ImageTestBase):
 
         self.ExamineBrightfieldShading(ShadedImagePath, ShadingReferencePath)
 
+    def testBuildTilePyramid(self):
+        '''Each level built in memory should match building it from the saved files of the previous level'''
+
+        grid_dims = (5, 7)
+        tile_dims = (64, 64)
+        rng = np.random.RandomState(0)
+        full_image = rng.rand(grid_dims[0] * tile_dims[0], grid_dims[1] * tile_dims[1]).astype(np.float16)
+        level_tiles = [(iRow, iCol, full_image[iRow * 64:(iRow + 1) * 64, iCol * 64:(iCol + 1) * 64])
+                       for iRow in range(grid_dims[0]) for iCol in range(grid_dims[1])]
+
+        level_paths = [os.path.join(self.TestOutputPath, 'Pyramid', '%03d' % (1 << iLevel)) for iLevel in range(4)]
+        shapes = tileset_functions.BuildTilePyramid(iter(level_tiles), grid_dims, level_paths, pool=nornir_pools.GetGlobalSerialPool())
+        self.assertEqual(shapes, [(5, 7), (3, 4), (2, 2), (1, 1)])
+
+        TilePath = lambda iLevel, iRow, iCol: os.path.join(level_paths[iLevel], tileset_functions.DefaultTileNameFormat.format(row=iRow, column=iCol))
+        expected_path = os.path.join(self.TestOutputPath, 'expected_tile.png')
+        for iLevel in range(1, len(level_paths)):
+            for iRow in range(shapes[iLevel][0]):
+                for iCol in range(shapes[iLevel][1]):
+                    children = [TilePath(iLevel - 1, iRow * 2 + dY, iCol * 2 + dX) for dY in (0, 1) for dX in (0, 1)]
+                    tileset_functions.CreateOneTilesetTileWithPillow(tile_dims, *children, OutputFileFullPath=expected_path)
+                    self.assertTrue(np.array_equal(nir.LoadImage(expected_path), nir.LoadImage(TilePath(iLevel, iRow, iCol))),
+                                    "Level {0} tile {1},{2} does not match".format(iLevel, iRow, iCol))
+
+        # Tiles missing from the input still produce the lower resolution levels
+        missing_paths = [os.path.join(self.TestOutputPath, 'PyramidMissing', '%03d' % (1 << iLevel)) for iLevel in range(4)]
+        tileset_functions.BuildTilePyramid(iter(level_tiles[1:]), grid_dims, missing_paths, pool=nornir_pools.GetGlobalSerialPool())
+        self.assertTrue(os.path.exists(os.path.join(missing_paths[3], tileset_functions.DefaultTileNameFormat.format(row=0, column=0))))
+
     def ExamineBrightfieldShading(self, ShadedImagePath, ShadingReferencePath):
 
         self.assertTrue(os.path.exists(ShadedImagePath))
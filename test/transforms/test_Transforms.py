@@ -3,10 +3,13 @@ Created on Mar 18, 2013
 
 @author: u0490822
 '''
+import copy
 import os
+import pickle
 import unittest
 
 import nornir_imageregistration.transforms
+import nornir_imageregistration.transforms.scipyrbf
 from nornir_imageregistration.transforms import *
 from . import TransformCheck, ForwardTransformCheck, NearestFixedCheck, NearestWarpedCheck, \
               IdentityTransformPoints, TranslateTransformPoints, MirrorTransformPoints, OffsetTransformPoints
@@ -258,6 +261,101 @@ class TestTransforms(unittest.TestCase):
         TransformCheck(self, T, warpedPoints, -warpedPoints)
 
 
+    def testInverseCoordinateMap(self):
+        '''Rasterizing the triangles should match transforming each pixel'''
+        
+        (g_y, g_x) = np.meshgrid(np.linspace(0, 100, 6), np.linspace(0, 150, 7), indexing='ij')
+        fixed_points = np.vstack((g_y.flat, g_x.flat)).transpose()
+        rng = np.random.RandomState(0)
+        fixed_points[:, :] += rng.uniform(-5, 5, size=fixed_points.shape)
+        warped_points = fixed_points * 1.1 + rng.uniform(-3, 3, size=fixed_points.shape) + 20
+        pointpairs = np.hstack((fixed_points, warped_points))
+        
+        # The region extends past the control points so some pixels are outside the convex hull
+        botleft = (-10.5, 15)
+        area = (130, 120)
+        pixels = nornir_imageregistration.assemble.GetROICoords(botleft, area)
+        
+        for T in (triangulation.Triangulation(pointpairs), meshwithrbffallback.MeshWithRBFFallback(pointpairs)):
+            for extrapolate in (False, True):
+                expected = T.InverseTransform(pixels, extrapolate=extrapolate).reshape((area[0], area[1], 2))
+                coord_map = T.InverseCoordinateMap(botleft, area, extrapolate=extrapolate)
+                
+                self.assertEqual(coord_map.shape, expected.shape)
+                self.assertTrue(np.array_equal(np.isnan(expected), np.isnan(coord_map)), "Same pixels should be outside the convex hull")
+                valid = ~np.isnan(expected)
+                self.assertTrue(np.allclose(expected[valid], coord_map[valid], atol=1e-3))
+
+    def testRBFCoordinateMap(self):
+        '''RBF transforms subclass Triangulation but must be evaluated at every pixel instead of rasterizing triangles'''
+        
+        rng = np.random.RandomState(1)
+        fixed_points = rng.uniform(0, 100, size=(12, 2))
+        warped_points = fixed_points * 1.1 + rng.uniform(-3, 3, size=fixed_points.shape) + 20
+        T = nornir_imageregistration.transforms.scipyrbf.ScipyRbf(warped_points, fixed_points)
+        
+        self.assertIsNone(T.InverseCoordinateMap)
+        self.assertIsNone(rbftransform.RBFWithLinearCorrection(warped_points, fixed_points).InverseCoordinateMap)
+        
+        botleft = (10, 15)
+        area = (40, 50)
+        pixels = nornir_imageregistration.assemble.GetROICoords(botleft, area)
+        expected = T.InverseTransform(pixels).reshape((area[0], area[1], 2))
+        
+        coord_map = nornir_imageregistration.coordinate_map_cache.InverseCoordinateMap(T, botleft, area)
+        np.testing.assert_allclose(coord_map, expected, atol=1e-3)
+        
+        (fixed_coords, warped_coords) = nornir_imageregistration.assemble.DestinationROI_to_SourceROI(T, botleft, area)
+        np.testing.assert_allclose(warped_coords, T.InverseTransform(fixed_coords + botleft), atol=1e-3)
+
+    def testPickleTriangulation(self):
+        '''Pickled and copied triangulation transforms should keep their triangulations and map points identically'''
+        
+        rng = np.random.RandomState(0)
+        fixed_points = rng.uniform(0, 100, size=(40, 2))
+        warped_points = fixed_points * 1.1 + rng.uniform(-3, 3, size=fixed_points.shape) + 20
+        pointpairs = np.hstack((fixed_points, warped_points))
+        test_points = rng.uniform(10, 90, size=(200, 2))
+        
+        for T in (triangulation.Triangulation(pointpairs), meshwithrbffallback.MeshWithRBFFallback(pointpairs)):
+            expected_inverse = T.InverseTransform(test_points)
+            expected_forward = T.Transform(T.SourcePoints)
+            
+            for copied in (pickle.loads(pickle.dumps(T)), copy.deepcopy(T)):
+                self.assertIsNotNone(copied._fixedtri, "Triangulation should survive pickling")
+                self.assertIsNotNone(copied._warpedtri, "Triangulation should survive pickling")
+                np.testing.assert_array_equal(copied.fixedtri.simplices, T.fixedtri.simplices)
+                np.testing.assert_array_equal(copied.fixedtri.find_simplex(test_points), T.fixedtri.find_simplex(test_points))
+                np.testing.assert_allclose(copied.InverseTransform(test_points), expected_inverse)
+                np.testing.assert_allclose(copied.Transform(T.SourcePoints), expected_forward)
+                
+                # Changing the copy's points must not use the restored triangulation
+                copied.TranslateFixed((5, 5))
+                np.testing.assert_allclose(copied.InverseTransform(test_points + 5), expected_inverse, atol=1e-3)
+                
+        # The checksum depends only on the control points, not on whether the triangulation has been built
+        T = triangulation.Triangulation(pointpairs)
+        checksum = utils.TransformChecksum(T)
+        T.InverseTransform(test_points)
+        self.assertIsNotNone(T._fixedtri)
+        self.assertEqual(checksum, utils.TransformChecksum(T))
+        self.assertEqual(checksum, utils.TransformChecksum(pickle.loads(pickle.dumps(T))))
+        self.assertNotEqual(checksum, utils.TransformChecksum(meshwithrbffallback.MeshWithRBFFallback(pointpairs)))
+        T.TranslateFixed((1, 0))
+        self.assertNotEqual(checksum, utils.TransformChecksum(T))
+        
+        # A triangulation state that does not match the installed scipy is rebuilt instead of restored
+        T = triangulation.Triangulation(pointpairs)
+        expected_inverse = T.InverseTransform(test_points)
+        T.Transform(T.SourcePoints)
+        state = T.__getstate__()
+        state['_fixedtri'] = {'simplices': state['_fixedtri']['simplices']}
+        copied = triangulation.Triangulation.__new__(triangulation.Triangulation)
+        copied.__setstate__(state)
+        self.assertIsNone(copied._fixedtri)
+        self.assertIsNotNone(copied._warpedtri)
+        np.testing.assert_allclose(copied.InverseTransform(test_points), expected_inverse)
+
     def test_OriginAtZero(self):
         global IdentityTransformPoints
         global OffsetTransformPoints